@@ -0,0 +1,62 @@
+# An asyncio event loop on a thread of its own, shared by the asyncio
+# transports of a process
+import asyncio
+import threading
+
+
+class EventLoopThread(object):
+    '''
+    An asyncio event loop running on its own daemon thread, so that any
+    number of asyncio transports (`xmpp_async.OpenADR2` clients, the
+    `localapi.LocalAPI`) can share it.
+
+    Member Variables:
+    --------
+    loop -- The asyncio event loop
+    thread -- The thread running it
+    '''
+
+    def __init__(self, name='oadr2-loop'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(name=name, target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        '''
+        Run `coro` on the loop.
+
+        Returns: A concurrent.futures.Future for its result
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call(self, func, *args):
+        '''
+        Call `func(*args)` on the loop thread.
+        '''
+        self.loop.call_soon_threadsafe(func, *args)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+_shared_loop = None
+_shared_loop_lock = threading.Lock()
+
+
+def shared_loop():
+    '''
+    Returns: The process wide EventLoopThread, started on first use
+    '''
+
+    global _shared_loop
+    with _shared_loop_lock:
+        if _shared_loop is None:
+            _shared_loop = EventLoopThread()
+        return _shared_loop
@@ -0,0 +1,144 @@
+'''
+Which of several overlapping events sets the signal level.  Following the
+OpenADR rule for overlapping events, the event with the highest priority
+wins, and among events of the same priority the one which started first;
+the higher level, then the lower event ID, break any remaining tie, so the
+choice never depends on the order the events come in.
+'''
+import heapq
+
+from oadr2 import timeline
+
+_START, _END, _EXPIRE = range(3)
+
+
+def rank(evt, interval):
+    '''
+    Returns: The sort key of an (event, current interval) pair, lowest wins
+    '''
+    return (-evt.priority, evt.start, -interval.level, evt.id or '')
+
+
+def select(current):
+    '''
+    returns a 2-tuple of (signal_level, event setting it) out of
+    (event, current interval) pairs, or (0, None) if there are none
+    '''
+    if not current:
+        return 0, None
+    evt, interval = min(current, key=lambda candidate: rank(*candidate))
+    return interval.level, evt
+
+
+class Arbiter(object):
+    '''
+    Keeps the winning interval among the events of one control pass up to
+    date as time passes, without going through all the events again: the
+    interval starts and ends, and the event ends, wait in a heap by time,
+    and the intervals which have started sit in a heap by `rank()`.  Each
+    boundary costs O(log n), and finding the winner O(1).  Events can be
+    added and removed as they change, see `EventController`.
+
+    An interval is current after its start up to and including its end, and
+    an event has ended after its end, like `EventSchema.get_current_interval()`.
+
+    Member Variables:
+    --------
+    events -- The events arbitrated
+    now -- Time of the last `advance()`
+    '''
+
+    def __init__(self, events):
+        self.events = events
+        self.now = None
+        self._boundaries = []  # heap of (time, sequence, kind, entry)
+        self._started = []  # heap of (rank, sequence, event, interval)
+        self._current = set()  # sequence numbers of the current intervals
+        self._sequence = 0
+        self._live = {}  # event ID -> the event object arbitrated
+
+        for evt in events:
+            self.add(evt)
+
+    def add(self, evt):
+        '''
+        Arbitrate `evt` too, replacing any event with the same ID.  Its
+        boundaries before `now` are caught up with on the next `advance()`.
+        '''
+
+        self._live[evt.id] = evt
+        if evt.status is None:
+            return
+        self._sequence += 1
+        if evt.end is not None and (evt.signals or evt.status.lower() == "cancelled"):
+            heapq.heappush(self._boundaries, (evt.end, self._sequence, _EXPIRE, evt))
+        if evt.test_event or not evt.signals:
+            return
+        for start, end, interval in timeline.event_intervals(evt):
+            self._sequence += 1
+            entry = (rank(evt, interval), self._sequence, evt, interval)
+            heapq.heappush(self._boundaries, (start, self._sequence, _START, entry))
+            if end is not None:
+                heapq.heappush(self._boundaries, (end, self._sequence, _END, entry))
+
+    def remove(self, event_id):
+        '''
+        Stop arbitrating an event.  Its entries are dropped as they come up.
+        '''
+        self._live.pop(event_id, None)
+        self._drop_stale()
+
+    def advance(self, now):
+        '''
+        Move to `now`, which may not be earlier than the last time.
+
+        Returns: The IDs of the events which ended since the last time
+        '''
+
+        if self.now is not None and now < self.now:
+            raise ValueError("Can't go back from %s to %s" % (self.now, now))
+        self.now = now
+
+        ended = []
+        while self._boundaries and self._boundaries[0][0] < now:
+            _, sequence, kind, entry = heapq.heappop(self._boundaries)
+            if kind == _START:
+                if self._is_live(entry[2]):
+                    heapq.heappush(self._started, entry)
+                    self._current.add(sequence)
+            elif kind == _END:
+                self._current.discard(sequence)
+            elif self._is_live(entry):
+                ended.append(entry.id)
+
+        self._drop_stale()
+        return ended
+
+    def winner(self):
+        '''
+        Returns: A 2-tuple of (signal_level, event setting it), or (0, None)
+                 if no interval is current
+        '''
+        if not self._started:
+            return 0, None
+        _, _, evt, interval = self._started[0]
+        return interval.level, evt
+
+    def current(self):
+        '''
+        Returns: The (event, current interval) pairs, in no particular order
+        '''
+        return [(evt, interval) for _, sequence, evt, interval in self._started
+                if sequence in self._current and self._is_live(evt)]
+
+    def _is_live(self, evt):
+        return self._live.get(evt.id) is evt
+
+    def _drop_stale(self):
+        '''
+        Drop the intervals which have ended, or whose event was removed or
+        replaced, once they reach the top
+        '''
+        while self._started and (
+                self._started[0][1] not in self._current or not self._is_live(self._started[0][2])):
+            self._current.discard(heapq.heappop(self._started)[1])
@@ -15,6 +15,7 @@ class BaseHandler(object):
     --------
     event_handler -- The event.EventHandler instance
     event_controller -- A control.EventController object.
+    clock -- The clock.Clock of both, `event_config['clock']` if given
     _exit -- A threading object via threading.Event()
     --------
     '''
@@ -33,6 +34,7 @@ class BaseHandler(object):
         # Get an EventHandler and an EventController
         self.event_handler = event.EventHandler(**event_config)
         self.event_controller = controller.EventController(self.event_handler, **control_opts)
+        self.clock = self.event_handler.clock
 
         # Add an exit thread for the module
         self._exit = threading.Event()
@@ -0,0 +1,61 @@
+'''
+Where the VEN gets the time from.  The event handler, the controller and
+the poller ask their Clock rather than the system, so that the same code
+can run in virtual time, see `simulation.Simulation`.
+'''
+import time
+from datetime import datetime
+
+
+class Clock(object):
+    '''
+    The system clock, the default of everything taking a clock.
+    '''
+
+    def now(self):
+        '''
+        Returns: The current UTC datetime, naive like the event times
+        '''
+        return datetime.utcnow()
+
+    def monotonic(self):
+        '''
+        Returns: Seconds from an arbitrary start, never going back, for
+                 measuring how long things take
+        '''
+        return time.monotonic()
+
+
+class SimulatedClock(Clock):
+    '''
+    A clock which only moves when told to.  It is not meant to be shared
+    by threads: whatever advances it runs the passes of its VENs itself.
+
+    Member Variables:
+    --------
+    start -- The UTC datetime it started at
+    '''
+
+    def __init__(self, start):
+        self.start = start
+        self._now = start
+
+    def now(self):
+        return self._now
+
+    def monotonic(self):
+        return (self._now - self.start).total_seconds()
+
+    def advance_to(self, when):
+        '''
+        Move to `when`, which may not be earlier than now.
+        '''
+        if when < self._now:
+            raise ValueError("Can't go back from %s to %s" % (self._now, when))
+        self._now = when
+
+    def advance(self, delta):
+        '''
+        Move forward by the timedelta `delta`.
+        '''
+        self.advance_to(self._now + delta)
@@ -1,12 +1,21 @@
 # pylint: disable=W1202
+import collections
+import functools
 import threading
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import List
 
-from oadr2 import logger
+from oadr2 import arbitration, dispatch, event, logger, schedule, snapshot, timeline
 from oadr2.schemas import EventSchema
 
 CONTROL_LOOP_INTERVAL = 30   # update control state every X second
+FORECAST_HOURS = 24  # horizon the forecast is built for, at least
+
+# The state of one resource of a multi-resource controller
+ResourceState = collections.namedtuple('ResourceState', ('level', 'event_id', 'next_change_time'))
+
+# The current value of a signal type, resolved across the active events
+SignalValue = collections.namedtuple('SignalValue', ('level', 'event_id', 'signal_id'))
 
 
 # Used by poll.OpenADR2 to handle events
@@ -19,6 +28,26 @@ class EventController(object):
     --------
     event_handler -- The EventHandler instance
     current_signal_level -- current signal level of a realy/point
+    current_event_id -- ID of the event setting the current signal level
+    next_change_time -- When the signal level may change next, or None
+    active_events -- The events seen by the last control pass, minus
+                     those it removed
+    signal_table -- An optional shm.SignalTable the state is published to
+    resource_id -- The resource ID the state is published under
+    callback_dispatcher -- The dispatch.CoalescingDispatcher running
+                           `signal_changed_callback`
+    resources -- Resource IDs controlled separately, empty if only the
+                 VEN as a whole is
+    resource_states -- resource ID -> ResourceState of the last pass
+    current_signals -- signal type -> SignalValue of the last pass, for
+                       every type with a current interval ('level',
+                       'price', 'x-loadControlCapacity'...)
+    optimizer -- An optional optimize.LoadShifter run on each pass
+    current_setpoint -- The optimizer's power setpoint of the last pass
+    clock -- The clock.Clock the passes are timed by
+    retention -- An optional retention.Retention the ended events go to
+    snapshot -- An optional snapshot.SnapshotFile the state is kept in
+    restored -- Whether the state was restored from `snapshot`
     control_loop_interval -- How often to run the control loop
     control_thread -- threading.Thread() object w/ name of 'oadr2.control'
     _control_loop_signal -- threading.Event() object
@@ -30,7 +59,18 @@ class EventController(object):
             event_handler,
             signal_changed_callback=None,
             start_thread=True,
-            control_loop_interval=CONTROL_LOOP_INTERVAL
+            control_loop_interval=CONTROL_LOOP_INTERVAL,
+            signal_table=None,
+            resource_id=None,
+            callback_timeout=dispatch.DEFAULT_CALLBACK_TIMEOUT,
+            callback_dispatcher=None,
+            resources=None,
+            resource_changed_callback=None,
+            optimizer=None,
+            setpoint_changed_callback=None,
+            clock=None,
+            retention=None,
+            snapshot=None
     ):
         '''
         Initialize the Event Controller
@@ -38,15 +78,87 @@ class EventController(object):
         event_handler -- An instance of event.EventHandler
         start_thread -- Start the control thread
         control_loop_interval -- How often to run the control loop
+        signal_table -- A writable shm.SignalTable: each control pass
+                        which changes the signal level, event or next
+                        change time publishes them for other processes
+        resource_id -- Slot name in `signal_table`, the VEN ID by default
+        callback_timeout -- Seconds `signal_changed_callback` may run before
+                            a newer level is delivered without waiting for it
+        callback_dispatcher -- A dispatch.CoalescingDispatcher shared with
+                               other controllers, instead of one of our own
+        resources -- Resource IDs to control separately, e.g. the
+                     `resource_ids` of the event handler of a gateway.
+                     Each pass also works out the level of each of them
+                     from the events targeting it (or no resource), and
+                     publishes them to `signal_table` under their IDs.
+        resource_changed_callback -- Called as `cb(resource_id, old_level,
+                                     new_level)` when a resource's level
+                                     changes, like `signal_changed_callback`
+        optimizer -- An optimize.LoadShifter: each pass also asks it for the
+                     power setpoint of its device, which it plans from the
+                     forecast of the event levels taken as prices
+        setpoint_changed_callback -- Called as `cb(old_setpoint,
+                                     new_setpoint)` when the optimizer's
+                                     setpoint changes, like
+                                     `signal_changed_callback`
+        clock -- A clock.Clock, that of `event_handler` by default
+        retention -- A retention.Retention: the passes hand it the events
+                     which ended, to be removed on its thread, instead of
+                     removing them from the database themselves
+        snapshot -- A snapshot.SnapshotFile: the state is restored from it
+                    if it matches the database, so the first pass needs
+                    no events loaded and fires no callback for a level
+                    which didn't change, and written to it after each pass
+                    which changed the state and on `exit()`
         '''
 
         self.event_handler = event_handler
+        self.clock = clock if clock is not None else event_handler.clock
         self.current_signal_level = 0
+        self.current_event_id = None
+        self.next_change_time = None
+        self.active_events = []
+        self.current_signals = {}
+
+        self._level_cache = None  # (handler generation, valid until, level, event ID)
+        self._events = None  # (handler generation, events) of the last control pass
+        self._arbiter = None  # arbitration.Arbiter of the last control pass
+        self._events_lock = threading.Lock()  # guards the two above
+        self._forecasts = {}  # (resource, signal type) -> (handler generation, end, timeline.Timeline)
+
+        self.signal_table = signal_table
+        self.resource_id = resource_id if resource_id is not None \
+                else getattr(event_handler, 'ven_id', None) or ''
+        self._published = None
 
         self.signal_changed_callback = signal_changed_callback \
                 if signal_changed_callback is not None \
                 else self.default_signal_callback
 
+        # The callback runs on the dispatcher's workers, so a slow actuator
+        # doesn't hold up the control loop
+        self._own_dispatcher = callback_dispatcher is None
+        self.callback_dispatcher = callback_dispatcher if callback_dispatcher is not None \
+                else dispatch.CoalescingDispatcher(timeout=callback_timeout)
+
+        self.resources = frozenset(resources or ())
+        self.resource_states = dict(
+            (resource, ResourceState(0, None, None)) for resource in self.resources)
+        self.resource_changed_callback = resource_changed_callback \
+                if resource_changed_callback is not None \
+                else self.default_resource_callback
+        self._published_resources = {}
+
+        self.retention = retention
+        if retention is not None:
+            retention.register(event_handler)
+
+        self.optimizer = optimizer
+        self.current_setpoint = 0.0
+        self.setpoint_changed_callback = setpoint_changed_callback \
+                if setpoint_changed_callback is not None \
+                else self.default_setpoint_callback
+
         # Add an exit thread for the module
         self._exit = threading.Event()
         self._exit.clear()
@@ -57,6 +169,17 @@ class EventController(object):
         # The control thread
         self.control_thread = None
 
+        event_handler.subscribe(self._events_changed)
+
+        self.snapshot = snapshot
+        self.restored = False
+        self._snapshotted = None  # (handler generation, level, event ID, next change) last written
+        if snapshot is not None:
+            try:
+                self.restored = self._restore_snapshot()
+            except Exception as ex:
+                logger.exception("Error restoring the snapshot %s: %s", snapshot.path, ex)
+
         if start_thread:
             self.control_thread = threading.Thread(
                 name='oadr2.control',
@@ -70,20 +193,118 @@ class EventController(object):
         Call this when some events have updated to cause the control
         loop to refresh
         '''
+        self._level_cache = None
+        self._forecasts = {}
         self._control_loop_signal.set()
 
+    def _events_changed(self, changes):
+        '''
+        Subscribed to the event handler: apply its changes to the events of
+        the last control pass, and their arbiter, so the next pass doesn't
+        load them all again, and wake the control loop up.  If we missed a
+        change they are loaded again instead.
+
+        changes -- A list of event.EventChange
+        '''
+
+        with self._events_lock:
+            cached = self._events
+            if cached is not None and cached[0] == changes[0].generation - 1:
+                arbiter = self._arbiter if self._arbiter is not None \
+                        and self._arbiter.events is cached[1] else None
+                events = collections.OrderedDict((evt.id, evt) for evt in cached[1])
+                for change in changes:
+                    events.pop(change.event_id, None)
+                    if arbiter is not None:
+                        arbiter.remove(change.event_id)
+                    if change.event is None or change.kind == event.OPTED_OUT \
+                            or change.event_id in self.event_handler.optouts:
+                        continue
+                    events[change.event_id] = change.event
+                    if arbiter is not None:
+                        arbiter.add(change.event)
+
+                events = sorted(events.values(), key=lambda evt: evt.start)
+                if arbiter is not None:
+                    arbiter.events = events
+                self._events = (changes[-1].generation, events)
+            else:
+                self._events = None
+
+        self._level_cache = None
+        self._forecasts = {}
+        # Changes made by the control pass itself need no other pass
+        if threading.current_thread() is not self.control_thread:
+            self._control_loop_signal.set()
+
     def get_current_signal_level(self):
         '''
         Return the signal level and event ID of the currently active event.
         If no events are active, this will return (0,None)
-        '''
 
-        signal_level, event_id, expired_events = self._calculate_current_event_status(
-            self.event_handler.get_active_events()
-        )
+        The result is cached until the next event start, interval boundary
+        or end, or until the event handler's events change, so repeated
+        calls don't touch the database.  Only the events active now are
+        loaded, however many are scheduled later.
+        '''
 
+        now = self.clock.now()
+        generation = self.event_handler.generation
+        cache = self._level_cache
+        if cache is not None and cache[0] == generation and now < cache[1]:
+            return cache[2], cache[3]
+
+        events = self.event_handler.get_events_at(now)
+        signal_level, event_id, expired_events = self._calculate_current_event_status(events)
+
+        # An interval includes its end, so a boundary at `now` still changes the level
+        changes = [
+            change for change in (
+                self._next_change_time(events, now, inclusive=True),
+                self.event_handler.next_event_start(now),
+            ) if change is not None
+        ]
+        valid_until = min(changes) if changes else datetime.max
+        self._level_cache = (generation, valid_until, signal_level, event_id)
         return signal_level, event_id
 
+    def forecast(self, hours=12, resource=None, signal_type=None):
+        '''
+        Return the signal level over the next `hours`, merged from the
+        intervals of all the active events and resolved by priority the way
+        the control loop does, as a timeline.Timeline starting now.  Use its
+        `as_arrays()` to export it, or `level_at()` to look up a time.
+
+        The forecast is built once for at least FORECAST_HOURS and reused
+        until the event handler's events change, so repeated calls don't
+        touch the database.
+
+        hours -- The horizon
+        resource -- Forecast one of `resources` instead of the VEN as a whole
+        signal_type -- Forecast the signals of this type (e.g. 'price')
+                       instead of the simple signals
+
+        Returns: A timeline.Timeline
+        '''
+
+        if resource is not None and resource not in self.resources:
+            raise ValueError("Unknown resource %r" % resource)
+
+        now = self.clock.now()
+        end = now + timedelta(hours=hours)
+        generation = self.event_handler.generation
+        cache = self._forecasts.get((resource, signal_type))
+        if cache is None or cache[0] != generation or not cache[2].times[0] <= now or end > cache[1]:
+            events = self.event_handler.get_active_events()
+            if resource is not None:
+                events = [evt for evt in events if resource in self._resources_of(evt)]
+            cache_end = now + timedelta(hours=max(hours, FORECAST_HOURS))
+            cache = (generation, cache_end, timeline.build(
+                events, now, cache_end, self._select, signal_type=signal_type))
+            self._forecasts[(resource, signal_type)] = cache
+
+        return cache[2].window(now, end)
+
     def _control_event_loop(self):
         '''
         This is the threading loop to perform control based on current oadr events
@@ -91,25 +312,50 @@ class EventController(object):
         except when an updated event is received by a VTN.
         '''
         while not self._exit.is_set():
-            try:
-                logger.debug("Updating control states...")
-                events = self.event_handler.get_active_events()
-
-                new_signal_level = self._update_control(events)
-                logger.debug("Highest signal level is: %f", new_signal_level)
-
-                changed = self._update_signal_level(new_signal_level)
-                if changed:
-                    logger.debug("Updated current signal level!")
-
-            except Exception as ex:
-                logger.exception("Control loop error: %s", ex)
-
+            self.tick()
             self._control_loop_signal.wait(self.control_loop_interval)
             self._control_loop_signal.clear() # in case it was triggered by a poll update
 
         logger.info("Control loop exiting.")
 
+    def tick(self):
+        '''
+        Run one pass of the control loop: drop expired events and fire the
+        callback if the signal level changed.  Called by the control thread,
+        or by whatever schedules the controller when it runs without one
+        (see `host.VENHost`).
+        '''
+        try:
+            logger.debug("Updating control states...")
+            # Events are only loaded again when we missed how they changed
+            generation = self.event_handler.generation
+            with self._events_lock:
+                cached = self._events
+            if cached is None or cached[0] != generation:
+                events = self.event_handler.get_active_events()
+                with self._events_lock:
+                    self._events = cached = (generation, events)
+            events = cached[1]
+
+            new_signal_level = self._update_control(events)
+            logger.debug("Highest signal level is: %f", new_signal_level)
+
+            changed = self._update_signal_level(new_signal_level)
+            if changed:
+                logger.debug("Updated current signal level!")
+
+            # An interval includes its end, so a boundary now still changes the level
+            self.next_change_time = self._next_change_time(self.active_events, self.clock.now(), inclusive=True)
+            if self.optimizer is not None:
+                self._update_setpoint()
+            if self.signal_table is not None:
+                self._publish()
+            if self.snapshot is not None:
+                self._write_snapshot()
+
+        except Exception as ex:
+            logger.exception("Control loop error: %s", ex)
+
     def _update_control(self, events):
         '''
         Called by `control_event_loop()` to determine the current signal level.
@@ -117,28 +363,252 @@ class EventController(object):
 
         events -- List of lxml.etree.ElementTree objects (with OpenADR 2.0 tags)
         '''
-        signal_level, event_id, remove_events = self._calculate_current_event_status(events)
-
-        if remove_events:
+        now = self.clock.now()
+        with self._events_lock:
+            arbiter = self._arbiter
+            if arbiter is None or arbiter.events is not events or \
+                    arbiter.now is not None and now < arbiter.now:
+                arbiter = arbitration.Arbiter(events)
+                self._arbiter = arbiter
+            remove_events = arbiter.advance(now)
+            signal_level, evt = arbiter.winner()
+            current = arbiter.current()
+        event_id = evt.id if evt else None
+
+        if remove_events and self.retention is not None:
+            # Leave them out of the next passes until they are removed
+            logger.debug("Completed or cancelled events: %s", remove_events)
+            self.retention.expired(
+                self.event_handler, [(evt.id, evt.mod_number) for evt in events if evt.id in remove_events])
+            with self._events_lock:
+                if self._events is not None and self._events[1] is events:
+                    remaining = [other for other in events if other.id not in remove_events]
+                    self._events = (self._events[0], remaining)
+                    arbiter.events = remaining
+
+        elif remove_events:
             # remove any events that we've detected have ended or been cancelled.
             # TODO callback for expired events??
             logger.debug("Removing completed or cancelled events: %s", remove_events)
             self.event_handler.remove_events(remove_events)
 
-        if event_id:
+        if evt and evt.status in ("near", "far"):
             self.event_handler.update_active_status(event_id)
 
+        self.current_event_id = event_id
+        self.active_events = [evt for evt in events if evt.id not in remove_events]
+        self._update_signals(now)
+        if self.resources:
+            self._update_resources(current, now)
         return signal_level
 
+    def _update_signals(self, now):
+        '''
+        Work out `current_signals` from the current interval of every signal
+        of the active events, resolving each signal type like the simple
+        signal.
+        '''
+
+        by_type = collections.defaultdict(list)
+        for evt in self.active_events:
+            if evt.status is None or evt.test_event:
+                continue
+            for event_signal in evt.event_signals:
+                interval = evt.get_current_interval(now=now, signal=event_signal)
+                if interval is not None:
+                    by_type[event_signal.type].append((evt, interval, event_signal.id))
+
+        current_signals = {}
+        for signal_type, candidates in by_type.items():
+            level, evt = self._select([(evt, interval) for evt, interval, _ in candidates])
+            signal_id = next(signal_id for candidate, interval, signal_id in candidates
+                             if candidate is evt and interval.level == level)
+            current_signals[signal_type] = SignalValue(level, evt.id, signal_id)
+        self.current_signals = current_signals
+
+    def _resources_of(self, evt):
+        '''
+        returns the resources of ours which `evt` controls: those it
+        targets, or all of them if it targets no resource
+        '''
+        if evt.resource_ids:
+            return self.resources.intersection(evt.resource_ids)
+        return self.resources
+
+    def _update_resources(self, current, now):
+        '''
+        Work out the state of each resource from the current intervals of
+        the last pass, and fire `resource_changed_callback` for those whose
+        level changed.
+
+        current -- (event, current interval) pairs from `_current_intervals()`
+        '''
+
+        by_resource = dict((resource, []) for resource in self.resources)
+        for evt, interval in current:
+            for resource in self._resources_of(evt):
+                by_resource[resource].append((evt, interval))
+
+        next_changes = dict((resource, None) for resource in self.resources)
+        for evt in self.active_events:
+            change = self._next_change_time([evt], now)
+            if change is None:
+                continue
+            for resource in self._resources_of(evt):
+                if next_changes[resource] is None or change < next_changes[resource]:
+                    next_changes[resource] = change
+
+        for resource in self.resources:
+            level, evt = self._select(by_resource[resource])
+            old_level = self.resource_states[resource].level
+            self.resource_states[resource] = ResourceState(
+                level, evt.id if evt else None, next_changes[resource])
+
+            if level != old_level:
+                try:
+                    self.callback_dispatcher.submit(
+                        (self, resource),
+                        functools.partial(self.resource_changed_callback, resource),
+                        old_level, level)
+                except Exception as ex:
+                    logger.exception("Error dispatching callback for %s! %s", resource, ex)
+
+    def _publish(self):
+        '''
+        Write the current state to `signal_table` if it changed since the
+        last pass.
+        '''
+        state = (self.current_signal_level, self.current_event_id, self.next_change_time)
+        if state != self._published:
+            self.signal_table.publish(self.resource_id, *state)
+            self._published = state
+
+        for resource, state in self.resource_states.items():
+            if state != self._published_resources.get(resource):
+                self.signal_table.publish(resource, *state)
+                self._published_resources[resource] = state
+
+    def _write_snapshot(self, force=False):
+        '''
+        Write the state of the last pass to `snapshot` if it changed since
+        the last snapshot, or anyway if `force`.  Nothing is written if the
+        events changed since the pass: the next pass writes them.
+        '''
+
+        state = (self.event_handler.generation, self.current_signal_level, self.current_event_id,
+                 self.next_change_time, frozenset(self.resource_states.items()))
+        if state == self._snapshotted and not force:
+            return
+
+        generation, versions, optouts = self.event_handler.get_versions()
+        with self._events_lock:
+            cached = self._events
+        if cached is None or cached[0] != generation:
+            return
+
+        # The forecast from now on, its earlier pieces may be of events gone since
+        now = self.clock.now()
+        cache = self._forecasts.get((None, None))
+        if cache is not None and cache[0] == generation and cache[2].times[0] <= now < cache[1]:
+            forecast = cache[2].window(now, cache[1])
+        else:
+            forecast = timeline.build(cached[1], now, now + timedelta(hours=FORECAST_HOURS), self._select)
+
+        self.snapshot.write(snapshot.VENState(
+            written=now,
+            level=self.current_signal_level,
+            event_id=self.current_event_id,
+            next_change_time=self.next_change_time,
+            events=cached[1],
+            timeline=forecast,
+            optouts=optouts,
+            versions=versions,
+            resource_states=self.resource_states,
+        ))
+        self._snapshotted = (generation,) + state[1:]
+
+    def _restore_snapshot(self):
+        '''
+        Take the state of the last pass from `snapshot`.  Its opt-outs of
+        events still stored are always restored, the rest only if the
+        database holds the same events as when it was written.
+
+        Returns: Whether the state was restored
+        '''
+
+        state = self.snapshot.read()
+        if state is None:
+            return False
+        for event_id in state.optouts:
+            self.event_handler.optout_event(event_id)
+
+        generation, versions, _ = self.event_handler.get_versions()
+        if versions != state.versions:
+            logger.info("Snapshot %s is out of date, loading the events", self.snapshot.path)
+            return False
+
+        with self._events_lock:
+            self._events = (generation, state.events)
+        self.active_events = list(state.events)
+        self.current_signal_level = state.level
+        self.current_event_id = state.event_id
+        self.next_change_time = state.next_change_time
+        for resource, resource_state in state.resource_states.items():
+            if resource in self.resources:
+                self.resource_states[resource] = ResourceState(*resource_state)
+        if state.timeline is not None:
+            self._forecasts[(None, None)] = (generation, state.timeline.times[-1], state.timeline)
+        self._snapshotted = (generation, state.level, state.event_id, state.next_change_time,
+                             frozenset(self.resource_states.items()))
+        logger.info("Restored %d events from the snapshot %s of %s",
+                    len(state.events), self.snapshot.path, state.written)
+        return True
+
+    def _next_change_time(self, events: List[EventSchema], now, inclusive=False):
+        '''
+        returns the earliest start, interval boundary or end after `now` (or
+        at `now` if `inclusive`) of any event which can affect the signal
+        level, or None if there is none
+        '''
+
+        next_change = None
+        for evt in events:
+            if evt.status is None or evt.test_event or not evt.signals:
+                continue
+
+            boundaries = [evt.start]
+            for signal in evt.signals:
+                duration = schedule.duration_to_delta(signal.duration)[0]
+                if not duration:  # open ended
+                    break
+                boundaries.append(boundaries[-1] + duration)
+            if evt.end is not None:
+                boundaries.append(evt.end)
+
+            for boundary in boundaries:
+                if (boundary > now or inclusive and boundary == now) \
+                        and (next_change is None or boundary < next_change):
+                    next_change = boundary
+
+        return next_change
+
     def _calculate_current_event_status(self, events: List[EventSchema]):
         '''
         returns a 3-tuple of (current_signal_level, current_event_id, remove_events=[])
         '''
 
-        highest_signal_val = 0
-        current_event = None
+        current, remove_events = self._current_intervals(events, self.clock.now())
+        signal_level, current_event = self._select(current)
+        return signal_level, current_event.id if current_event else None, remove_events
+
+    def _current_intervals(self, events: List[EventSchema], now):
+        '''
+        returns a 2-tuple of ([(event, current interval)...] for the events
+        which can set the signal level now, remove_events=[])
+        '''
+
+        current = []
         remove_events = []  # to collect expired events
-        now = datetime.utcnow()
 
         for evt in events:
             try:
@@ -146,7 +616,7 @@ class EventController(object):
                     logger.debug(f"Ignoring event {evt.id} - no valid status")
                     continue
 
-                if evt.status.lower() == "cancelled" and datetime.utcnow() > evt.end:
+                if evt.status.lower() == "cancelled" and now > evt.end:
                     logger.debug(f"Event {evt.id}({evt.mod_number}) has been cancelled")
                     remove_events.append(evt.id)
                     continue
@@ -179,23 +649,30 @@ class EventController(object):
                     f'Control loop: Evt ID: {evt.id}({evt.mod_number}); '
                     f'Interval: {current_interval.index}; Current Signal: {current_interval.level}'
                 )
-
-                if current_interval.level > highest_signal_val or not current_event:
-                    if not current_event or evt.priority > current_event.priority:
-                        highest_signal_val = current_interval.level
-                        current_event = evt
+                current.append((evt, current_interval))
 
             except Exception as ex:
                 logger.exception(f"Error parsing event: {evt.id}: {ex}")
 
-        return highest_signal_val, current_event.id if current_event else None, remove_events
+        return current, remove_events
+
+    def _select(self, current):
+        '''
+        returns a 2-tuple of (signal_level, event setting it) out of
+        (event, current interval) pairs, or (0, None) if there are none;
+        see `arbitration.rank()` for which event wins
+        '''
+        return arbitration.select(current)
 
     def _update_signal_level(self, signal_level):
         '''
         Called once each control interval with the 'current' signal level.
         If the signal level has changed from `current_signal_level`, this
-        calls `self.signal_changed_callback(current_signal_level, new_signal_level)`
-        and then sets `self.current_signal_level = new_signal_level`.
+        hands `self.signal_changed_callback(current_signal_level, new_signal_level)`
+        to `callback_dispatcher` and then sets
+        `self.current_signal_level = new_signal_level`.  If the callback is
+        still busy with an earlier change, only the latest level is
+        delivered once it returns.
 
         signal_level -- If it is the same as the current signal level, the
                         function will exit.  Else, it will change the
@@ -210,24 +687,76 @@ class EventController(object):
             return False
 
         try:
-            self.signal_changed_callback(self.current_signal_level, signal_level)
+            self.callback_dispatcher.submit(
+                self, self.signal_changed_callback, self.current_signal_level, signal_level)
 
         except Exception as ex:
-            logger.exception("Error from callback! %s", ex)
+            logger.exception("Error dispatching callback! %s", ex)
 
         self.current_signal_level = signal_level
         return True
 
+    def _update_setpoint(self):
+        '''
+        Ask the optimizer for the setpoint of now, and hand
+        `setpoint_changed_callback` to `callback_dispatcher` if it changed.
+        '''
+
+        setpoint = self.optimizer.setpoint(self, self.clock.now())
+        if setpoint == self.current_setpoint:
+            return
+
+        try:
+            self.callback_dispatcher.submit(
+                (self, self.optimizer), self.setpoint_changed_callback, self.current_setpoint, setpoint)
+        except Exception as ex:
+            logger.exception("Error dispatching setpoint callback! %s", ex)
+        self.current_setpoint = setpoint
+
+    def callback_stats(self, resource=None):
+        '''
+        resource -- Count the `resource_changed_callback` calls for this
+                    resource instead
+
+        Returns: Counters and latencies of our `signal_changed_callback`
+                 calls, see `dispatch.CoalescingDispatcher.stats()`
+        '''
+        return self.callback_dispatcher.stats(self if resource is None else (self, resource))
+
     def default_signal_callback(self, old_level, new_level):
         '''
         The default callback just logs a message.
         '''
         logger.debug(f"Signal level changed from {old_level} to {new_level}")
 
+    def default_setpoint_callback(self, old_setpoint, new_setpoint):
+        '''
+        The default setpoint callback just logs a message.
+        '''
+        logger.debug(f"Setpoint changed from {old_setpoint} to {new_setpoint}")
+
+    def default_resource_callback(self, resource_id, old_level, new_level):
+        '''
+        The default resource callback just logs a message.
+        '''
+        logger.debug(f"Signal level of {resource_id} changed from {old_level} to {new_level}")
+
     def exit(self):
         '''
         Shutdown the threads for the module
         '''
+        self.event_handler.unsubscribe(self._events_changed)
         self._exit.set()
         self._control_loop_signal.set()  # interrupt sleep
-        self.control_thread.join(2)
+        if self.control_thread is not None:
+            self.control_thread.join(2)
+        if self.snapshot is not None:
+            try:
+                self._write_snapshot(force=True)
+            except Exception as ex:
+                logger.exception("Error writing the snapshot %s: %s", self.snapshot.path, ex)
+        if self._own_dispatcher:
+            self.callback_dispatcher.stop(2)
+        else:  # it outlives us, don't leave our keys in its counters
+            for key in [self, (self, self.optimizer)] + [(self, resource) for resource in self.resources]:
+                self.callback_dispatcher.forget(key)
@@ -0,0 +1,451 @@
+# Worker pools which keep jobs with the same key in order
+# pylint: disable=W1202
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from oadr2 import logger
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_QUEUED = 100  # messages waiting across all keys before submit() refuses more
+DEFAULT_STOP_TIMEOUT = 10  # seconds a transport's exit() waits for the messages already accepted
+DEFAULT_CALLBACK_WORKERS = 2
+DEFAULT_CALLBACK_TIMEOUT = 10  # seconds a callback may run before the next value is delivered anyway
+
+
+class QueueFull(Exception):
+    '''
+    Raised by `OrderedDispatcher.submit()` when `max_queued` messages are
+    already waiting.
+    '''
+
+
+class OrderedDispatcher(object):
+    '''
+    Runs submitted jobs on a fixed set of worker threads.  Jobs sharing a key
+    (e.g. the JID of the VTN that sent them) run one at a time in submission
+    order, jobs with different keys run in parallel.
+
+    Each key with pending jobs sits at most once in the ready queue, and the
+    worker which takes it runs a single job before putting the key back at
+    the end, so one busy sender cannot starve the others.
+
+    Member Variables:
+    --------
+    workers -- Number of worker threads
+    max_queued -- Jobs allowed to wait across all keys
+    name -- Prefix for the worker thread names
+    '''
+
+    def __init__(self, workers=DEFAULT_WORKERS, max_queued=DEFAULT_MAX_QUEUED,
+                 name='oadr2-dispatch', start_thread=True):
+        '''
+        workers -- Number of worker threads
+        max_queued -- Jobs allowed to wait before `submit()` raises QueueFull
+        name -- Prefix for the worker thread names
+        start_thread -- Start the workers right away
+        '''
+
+        self.workers = int(workers)
+        self.max_queued = int(max_queued)
+        self.name = name
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)  # workers wait for keys
+        self._idle = threading.Condition(self._lock)  # join() waits for an empty pool
+        self._pending = {}  # key -> deque of (submitted time, func, args)
+        self._ready_keys = collections.deque()
+        self._queued = 0
+        self._stopping = False
+        self._threads = []
+
+        # Backpressure metrics, see stats()
+        self._submitted = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._busy = 0
+        self._max_queued_seen = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+        if start_thread:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            self._stopping = False
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    name='%s-%d' % (self.name, len(self._threads)),
+                    target=self._work
+                )
+                thread.daemon = True
+                self._threads.append(thread)
+                thread.start()
+
+    def submit(self, key, func, *args):
+        '''
+        Queue `func(*args)` behind any other job submitted with `key`.
+
+        key -- Jobs with equal keys are run in order, one at a time
+        func -- Callable to run on a worker thread
+        *args -- Arguments for `func`
+
+        Raises: QueueFull if `max_queued` jobs are already waiting
+        '''
+
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError("dispatcher is stopped")
+            if self._queued >= self.max_queued:
+                self._rejected += 1
+                raise QueueFull("%d messages already queued" % self._queued)
+
+            jobs = self._pending.get(key)
+            if jobs is None:
+                jobs = self._pending[key] = collections.deque()
+                self._ready_keys.append(key)
+                self._ready.notify()
+            jobs.append((time.monotonic(), func, args))
+
+            self._queued += 1
+            self._submitted += 1
+            self._max_queued_seen = max(self._max_queued_seen, self._queued)
+
+    def stop(self, timeout=None):
+        '''
+        Let the workers finish the queued jobs, then stop them.
+
+        timeout -- Seconds to wait for all the workers, None for as long as
+                   they take; those still busy are left to finish on their
+                   own (they are daemon threads)
+        '''
+
+        with self._lock:
+            self._stopping = True
+            self._ready.notify_all()
+            threads, self._threads = self._threads, []
+
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join(max(deadline - time.monotonic(), 0) if deadline is not None else None)
+
+    def join(self, timeout=None):
+        '''
+        Wait until every queued job has run.
+
+        Returns: False if `timeout` seconds passed first
+        '''
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._queued or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+        return True
+
+    def stats(self):
+        '''
+        Returns: A dict of counters; `queued` and `busy` are the current
+                 depth and jobs running, `max_queued` the high-water mark and
+                 `wait_avg`/`wait_max` the seconds a job spent queued
+        '''
+
+        with self._lock:
+            started = self._processed + self._failed
+            return dict(
+                submitted=self._submitted,
+                processed=self._processed,
+                failed=self._failed,
+                rejected=self._rejected,
+                queued=self._queued,
+                busy=self._busy,
+                keys=len(self._pending),
+                max_queued=self._max_queued_seen,
+                wait_avg=self._wait_total / started if started else 0.0,
+                wait_max=self._wait_max,
+            )
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._ready_keys:
+                    if self._stopping:
+                        return
+                    self._ready.wait()
+
+                key = self._ready_keys.popleft()
+                submitted, func, args = self._pending[key].popleft()
+                self._queued -= 1
+                self._busy += 1
+                waited = time.monotonic() - submitted
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+
+            failed = False
+            try:
+                func(*args)
+            except Exception as ex:
+                failed = True
+                logger.exception("Error dispatching message for %s: %s", key, ex)
+
+            with self._lock:
+                self._busy -= 1
+                if failed:
+                    self._failed += 1
+                else:
+                    self._processed += 1
+
+                # Only now may the next job for this key run
+                if self._pending[key]:
+                    self._ready_keys.append(key)
+                    self._ready.notify()
+                else:
+                    del self._pending[key]
+
+                if not self._queued and not self._busy:
+                    self._idle.notify_all()
+
+
+class _Call(object):
+    __slots__ = ('func', 'old', 'new', 'submitted', 'deadline')
+
+    def __init__(self, func, old, new, submitted):
+        self.func = func
+        self.old = old
+        self.new = new
+        self.submitted = submitted
+        self.deadline = None
+
+
+class _CallbackStats(object):
+    '''
+    Counters of a CoalescingDispatcher, overall or for one key.
+    '''
+
+    def __init__(self):
+        self.submitted = 0
+        self.delivered = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.latency_last = None
+
+    def completed(self, latency, failed):
+        if failed:
+            self.failed += 1
+        else:
+            self.delivered += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+        self.latency_last = latency
+
+    def as_dict(self):
+        completed = self.delivered + self.failed
+        return dict(
+            submitted=self.submitted,
+            delivered=self.delivered,
+            coalesced=self.coalesced,
+            failed=self.failed,
+            timed_out=self.timed_out,
+            latency_avg=self.latency_total / completed if completed else 0.0,
+            latency_max=self.latency_max,
+            latency_last=self.latency_last,
+        )
+
+
+class CoalescingDispatcher(object):
+    '''
+    Delivers value changes, such as signal levels to a relay, as
+    `func(old, new)` calls on an executor, so a slow actuator does not hold
+    up the thread reporting the changes.
+
+    Calls sharing a key run one at a time.  Changes submitted while a call
+    for their key is running are coalesced: only the latest is delivered
+    next, with `old` the value the actuator last got.
+
+    A call running longer than `timeout` is abandoned: it is counted as
+    timed out and the next value for its key is delivered without waiting
+    for it.  Python threads cannot be killed, so an abandoned call keeps
+    its worker until it returns; `workers` should allow for that.
+
+    Member Variables:
+    --------
+    workers -- Size of the executor
+    timeout -- Seconds a call may run, None for no limit
+    name -- Prefix for the thread names
+    '''
+
+    def __init__(self, workers=DEFAULT_CALLBACK_WORKERS, timeout=DEFAULT_CALLBACK_TIMEOUT,
+                 name='oadr2-callback'):
+        '''
+        workers -- Threads running the calls
+        timeout -- Seconds a call may run before it is abandoned
+        name -- Prefix for the thread names
+        '''
+
+        self.workers = int(workers)
+        self.timeout = timeout
+        self.name = name
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._running = {}  # key -> _Call
+        self._pending = {}  # key -> _Call waiting for the running one
+        self._stats = _CallbackStats()
+        self._key_stats = {}  # key -> _CallbackStats
+        self._stopping = False
+        self._watchdog = None
+
+    def submit(self, key, func, old, new):
+        '''
+        Deliver `func(old, new)` once no call for `key` is running, replacing
+        any change for `key` still waiting.
+        '''
+
+        now = time.monotonic()
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError("dispatcher is stopped")
+
+            key_stats = self._key_stats.setdefault(key, _CallbackStats())
+            self._stats.submitted += 1
+            key_stats.submitted += 1
+
+            if key not in self._running:
+                self._start(key, _Call(func, old, new, now))
+                return
+
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = _Call(func, old, new, now)
+            else:
+                self._stats.coalesced += 1
+                key_stats.coalesced += 1
+                pending.func = func
+                pending.new = new
+                pending.submitted = now
+
+    def join(self, timeout=None):
+        '''
+        Wait until no call is running or waiting; abandoned calls don't
+        count.
+
+        Returns: False if `timeout` seconds passed first
+        '''
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._running or self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+        return True
+
+    def stop(self, timeout=None):
+        '''
+        Deliver what is waiting, up to `timeout` seconds, then stop.
+        '''
+        self.join(timeout)
+        with self._lock:
+            self._stopping = True
+            self._changed.notify_all()
+        self._executor.shutdown(wait=False)
+
+    def stats(self, key=None):
+        '''
+        key -- Only count the calls for `key`
+
+        Returns: A dict of counters, and the seconds from submitting a value
+                 to its call returning as `latency_avg`, `latency_max` and
+                 `latency_last`
+        '''
+        with self._lock:
+            stats = self._stats if key is None else self._key_stats.get(key, _CallbackStats())
+            stats = stats.as_dict()
+            if key is None:
+                stats.update(running=len(self._running), pending=len(self._pending))
+            return stats
+
+    def forget(self, key):
+        '''
+        Drop the counters of `key`, when its submitter goes away while the
+        dispatcher lives on.  A call for `key` still running or waiting is
+        delivered, and counted only in the totals.
+        '''
+        with self._lock:
+            self._key_stats.pop(key, None)
+
+    def _start(self, key, call):
+        '''
+        Called with `self._lock` held.
+        '''
+
+        self._running[key] = call
+        if self.timeout is not None:
+            call.deadline = time.monotonic() + self.timeout
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(name='%s-watchdog' % self.name, target=self._watch)
+                self._watchdog.daemon = True
+                self._watchdog.start()
+            self._changed.notify_all()
+        self._executor.submit(self._run, key, call)
+
+    def _finish(self, key):
+        '''
+        The call for `key` returned or was abandoned, start the next one.
+        Called with `self._lock` held.
+        '''
+
+        del self._running[key]
+        pending = self._pending.pop(key, None)
+        if pending is not None and not self._stopping:
+            self._start(key, pending)
+        self._changed.notify_all()
+
+    def _run(self, key, call):
+        failed = False
+        try:
+            call.func(call.old, call.new)
+        except Exception as ex:
+            failed = True
+            logger.exception("Error from callback for %s: %s", key, ex)
+
+        with self._lock:
+            if self._running.get(key) is not call:
+                logger.warning("Abandoned callback for %s returned", key)
+                return
+            latency = time.monotonic() - call.submitted
+            self._stats.completed(latency, failed)
+            if key in self._key_stats:
+                self._key_stats[key].completed(latency, failed)
+            self._finish(key)
+
+    def _watch(self):
+        '''
+        Abandon calls running past their deadline.
+        '''
+
+        with self._lock:
+            while not self._stopping:
+                now = time.monotonic()
+                for key, call in list(self._running.items()):
+                    if call.deadline is not None and call.deadline <= now:
+                        logger.error("Callback for %s did not return within %ss", key, self.timeout)
+                        self._stats.timed_out += 1
+                        if key in self._key_stats:
+                            self._key_stats[key].timed_out += 1
+                        self._finish(key)
+
+                # including calls just started for keys abandoned above
+                deadlines = [call.deadline for call in self._running.values() if call.deadline is not None]
+                self._changed.wait(min(deadlines) - now if deadlines else None)
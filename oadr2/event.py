@@ -4,18 +4,50 @@
 # pylint: disable=W1202
 __author__ = "Thom Nichols <tnichols@enernoc.com>, Ben Summerton <bsummerton@enernoc.com>"
 
+import collections
+import functools
+import logging
+import threading
 import uuid
+from datetime import datetime
 from typing import List
 
-from lxml import etree
 from lxml.builder import ElementMaker
 
-from oadr2 import eventdb, logger
+from oadr2 import eventdb, logger, xmlconv
+from oadr2.clock import Clock
 from oadr2.schemas import (NS_A, NS_B, OADR_PROFILE_20A, OADR_PROFILE_20B,
                            EventSchema)
 
 __author__ = "Thom Nichols <tnichols@enernoc.com>, Ben Summerton <bsummerton@enernoc.com>"
 
+# Kinds of EventChange
+ADDED = 'added'
+MODIFIED = 'modified'  # a new modification number, or the status became active
+CANCELLED = 'cancelled'
+REMOVED = 'removed'
+OPTED_OUT = 'opted-out'
+
+# A change to the events of an EventHandler, see `EventHandler.subscribe()`.
+# `event` is the EventSchema as stored (None if removed), `generation` the
+# handler's generation right after the change.
+EventChange = collections.namedtuple('EventChange', ('kind', 'event_id', 'event', 'generation'))
+
+
+def synchronized(method):
+    '''
+    Run an EventHandler method while holding the handler's lock.  The event
+    DB session is shared and may be used from the control, poll and push
+    threads at the same time.
+    '''
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
 
 class EventHandler(object):
     '''
@@ -30,14 +62,23 @@ class EventHandler(object):
     market_contexts -- List of Market Contexts
     group_id -- ID of group that VEN belogns to
     resource_id -- ID of resource in VEN we want to manipulate
+    resource_ids -- IDs of all the resources we manipulate, for a gateway
     party_id -- ID of the party we are party of
     db_path -- path to db file
+    element_maker -- ElementMaker class used to build reply payloads
+    event_parser -- Turns an ei:eiEvent element into an EventSchema
+    clock -- The clock.Clock cancellations are timed by
+    generation -- Incremented whenever the set of events or their opt-outs
+                  change, so callers can tell whether results computed
+                  from `get_active_events()` are still current
     '''
 
     def __init__(self, ven_id, vtn_ids=None, market_contexts=None,
                  group_id=None, resource_id=None, party_id=None,
                  oadr_profile_level=OADR_PROFILE_20A,
-                 event_callback=None, db_path=None):
+                 event_callback=None, db_path=None, element_maker=ElementMaker,
+                 db_engine=None, db_namespace="", event_parser=EventSchema.from_xml,
+                 resource_ids=None, clock=None):
         '''
         Class constructor
 
@@ -50,9 +91,24 @@ class EventHandler(object):
         oadr_profile_level -- What version of OpenADR 2.0 we want to use
         event_callback -- a function to call when events are updated and removed.
            The callback should have the signature `cb(updated,removed)` where
-           each parameter will be passed a dict in the form `{event_id, event_etree}`
-           where `oadr:oadrEvent` is the root element.  You can use functions defined
-           in the `event` module to pick out individual values from each event.
+           each parameter will be passed a dict in the form `{event_id: event}`
+           of EventSchema objects: `updated` those added, modified or
+           cancelled, `removed` those removed (mapped to None) or opted out
+           of.  See `subscribe()` for the individual changes.
+        element_maker -- `lxml.builder.ElementMaker` or a compatible factory such
+           as `xmlconv.StdElementMaker`, for transports which need the reply
+           payloads as standard library elements.
+        db_engine -- A SQLAlchemy engine shared with other handlers, used
+           instead of `db_path`
+        db_namespace -- Keeps our events apart from those of the other
+           handlers sharing `db_engine`
+        event_parser -- Called with each ei:eiEvent element to get its
+           EventSchema, e.g. a cache shared by many handlers
+        resource_ids -- The resources of a gateway controlling several,
+           events targeting any of them are accepted.  See the `resources`
+           of controller.EventController.
+        clock -- A clock.Clock to use instead of the system clock, e.g. a
+           clock.SimulatedClock; the controller of the handler shares it
         '''
 
         # 'vtn_ids' is a CSV string of
@@ -67,11 +123,17 @@ class EventHandler(object):
 
         self.group_id = group_id
         self.resource_id = resource_id
+        self.resource_ids = set(resource_ids or ())
+        if resource_id:
+            self.resource_ids.add(resource_id)
         self.party_id = party_id
 
         self.ven_id = ven_id
 
         self.event_callback = event_callback
+        self.element_maker = element_maker
+        self.event_parser = event_parser
+        self.clock = clock if clock is not None else Clock()
 
         # the default profile is '2.0a'; do this to set the ns_map
         self.oadr_profile_level = oadr_profile_level
@@ -84,18 +146,82 @@ class EventHandler(object):
             self.oadr_profile_level = OADR_PROFILE_20A
             self.ns_map = NS_A
 
-        self.db = eventdb.DBHandler(db_path=db_path)  # TODO: add this back memdb.DBHandler()
+        # TODO: add this back memdb.DBHandler()
+        self.db = eventdb.DBHandler(db_path=db_path, engine=db_engine, namespace=db_namespace)
         self.optouts = set()
+        self.generation = 0
+        self._lock = threading.RLock()
+        self._subscribers = []
+        if event_callback is not None:
+            self.subscribe(self._call_event_callback)
+
+    def subscribe(self, callback):
+        '''
+        Have `callback(changes)` called with a list of EventChange after
+        each call which changed the events, in the order they happened.
+        It runs on the thread making the change, while the handler is
+        locked, so it should be quick.
+
+        Returns: `callback`, for `unsubscribe()`
+        '''
+        self._subscribers.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def _changed(self, changes, kind, event_id, evt=None):
+        '''
+        Record a change made to the database: bump `generation` and add an
+        EventChange to `changes`.
 
+        evt -- The event as now stored, None if removed
+        '''
+        self.generation += 1
+        if evt is not None:
+            evt = self.fill_event_target_info(evt)
+        changes.append(EventChange(kind, event_id, evt, self.generation))
+
+    def _notify(self, changes):
+        if not changes:
+            return
+        for callback in list(self._subscribers):
+            try:
+                callback(changes)
+            except Exception as ex:
+                logger.exception("Error in event change subscriber %r: %s", callback, ex)
+
+    def _call_event_callback(self, changes):
+        updated = {}
+        removed = {}
+        for change in changes:
+            if change.kind in (REMOVED, OPTED_OUT):
+                updated.pop(change.event_id, None)
+                removed[change.event_id] = change.event
+            else:
+                removed.pop(change.event_id, None)
+                updated[change.event_id] = change.event
+        self.event_callback(updated, removed)
+
+    @synchronized
     def handle_payload(self, payload):
         '''
         Handle a payload.  Puts Events into the handler's event list.
 
-        payload -- An lxml.etree.Element object of oadr:oadrDistributeEvent as root node
+        payload -- An lxml.etree.Element (or xml.etree.ElementTree.Element)
+                   object of oadr:oadrDistributeEvent as root node
 
         Returns: An lxml.etree.Element object; which should be used as a response payload
         '''
 
+        changes = []
+        try:
+            return self._handle_payload(payload, changes)
+        finally:
+            self._notify(changes)
+
+    def _handle_payload(self, payload, changes):
         reply_events = []
         all_events = []
 
@@ -112,7 +238,7 @@ class EventHandler(object):
         for evt in payload.iterfind('oadr:oadrEvent', namespaces=self.ns_map):
             response_required = evt.findtext("oadr:oadrResponseRequired", namespaces=self.ns_map)
             evt = evt.find('ei:eiEvent', namespaces=self.ns_map)  # go to nested eiEvent
-            new_event = EventSchema.from_xml(evt)
+            new_event = self.event_parser(evt)
             current_signal_val = get_current_signal_value(evt, self.ns_map)
 
             logger.debug(
@@ -171,22 +297,24 @@ class EventHandler(object):
                     # updated_events[e_id] = evt
                     if new_event.status == "cancelled":
                         if new_event.status != old_event.status:
-                            new_event.cancel(random_end=True)
+                            new_event.cancel(random_end=True, now=self.clock.now())
                         else:
-                            new_event.cancel()
-                    self.db.update_event(new_event)
+                            new_event.cancel(now=self.clock.now())
+                    stored = self.db.update_event(new_event)
+                    self._changed(changes, CANCELLED if new_event.status == "cancelled" else MODIFIED, new_event.id, stored)
 
                 if not old_event:
                     if new_event.status == "cancelled":
-                        new_event.cancel()
-                    self.db.add_event(new_event)
+                        new_event.cancel(now=self.clock.now())
+                    stored = self.db.add_event(new_event)
+                    self._changed(changes, CANCELLED if new_event.status == "cancelled" else ADDED, new_event.id, stored)
 
         # Find implicitly cancelled events and get rid of them
         for evt in self.get_active_events():
             if evt.id not in all_events:
                 logger.debug(f'Mark event {evt.id} as cancelled')
-                evt.cancel()
-                self.db.update_event(evt)
+                evt.cancel(now=self.clock.now())
+                self._changed(changes, CANCELLED, evt.id, self.db.update_event(evt))
 
         # If we have any in the reply_events list, build some payloads
         logger.debug("Replying for events %r", reply_events)
@@ -203,10 +331,9 @@ class EventHandler(object):
         Returns: An lxml.etree.Element object
         '''
 
-        oadr = ElementMaker(namespace=self.ns_map['oadr'], nsmap=self.ns_map)
-        pyld = ElementMaker(namespace=self.ns_map['pyld'], nsmap=self.ns_map)
-        ei = ElementMaker(namespace=self.ns_map['ei'], nsmap=self.ns_map)
-        emix = ElementMaker(namespace=self.ns_map['emix'], nsmap=self.ns_map)
+        oadr = self.element_maker(namespace=self.ns_map['oadr'], nsmap=self.ns_map)
+        pyld = self.element_maker(namespace=self.ns_map['pyld'], nsmap=self.ns_map)
+        ei = self.element_maker(namespace=self.ns_map['ei'], nsmap=self.ns_map)
 
         payload = oadr.oadrRequestEvent(
             pyld.eiRequestEvent(
@@ -234,9 +361,9 @@ class EventHandler(object):
         '''
 
         # Setup the element makers
-        oadr = ElementMaker(namespace=self.ns_map['oadr'], nsmap=self.ns_map)
-        pyld = ElementMaker(namespace=self.ns_map['pyld'], nsmap=self.ns_map)
-        ei = ElementMaker(namespace=self.ns_map['ei'], nsmap=self.ns_map)
+        oadr = self.element_maker(namespace=self.ns_map['oadr'], nsmap=self.ns_map)
+        pyld = self.element_maker(namespace=self.ns_map['pyld'], nsmap=self.ns_map)
+        ei = self.element_maker(namespace=self.ns_map['ei'], nsmap=self.ns_map)
 
         def responses(events):
             for e_id, mod_num, requestID, opt, status in events:
@@ -256,8 +383,8 @@ class EventHandler(object):
                 ei.eventResponses(*list(responses(events))),
                 ei.venID(self.ven_id)))
 
-        logger.debug("Created payload:\n%s",
-                      etree.tostring(payload, pretty_print=True))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Created payload:\n%s", xmlconv.tostring(payload, pretty_print=True))
         return payload
 
     def build_error_response(self, request_id, code, description=None):
@@ -271,9 +398,9 @@ class EventHandler(object):
         Returns: An lxml.etree.Element object containing the payload
         '''
 
-        oadr = ElementMaker(namespace=self.ns_map['oadr'], nsmap=self.ns_map)
-        pyld = ElementMaker(namespace=self.ns_map['pyld'], nsmap=self.ns_map)
-        ei = ElementMaker(namespace=self.ns_map['ei'], nsmap=self.ns_map)
+        oadr = self.element_maker(namespace=self.ns_map['oadr'], nsmap=self.ns_map)
+        pyld = self.element_maker(namespace=self.ns_map['pyld'], nsmap=self.ns_map)
+        ei = self.element_maker(namespace=self.ns_map['ei'], nsmap=self.ns_map)
 
         payload = oadr.oadrCreatedEvent(
             pyld.eiCreatedEvent(
@@ -282,8 +409,8 @@ class EventHandler(object):
                     pyld.requestID(request_id)),
                 ei.venID(self.ven_id)))
 
-        logger.debug("Error payload:\n%s",
-                      etree.tostring(payload, pretty_print=True))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Error payload:\n%s", xmlconv.tostring(payload, pretty_print=True))
         return payload
 
     def check_target_info(self, evt: EventSchema):
@@ -306,7 +433,7 @@ class EventHandler(object):
             if evt.group_ids and self.group_id in evt.group_ids:
                 accept = True
 
-            if evt.resource_ids and self.resource_id in evt.resource_ids:
+            if evt.resource_ids and self.resource_ids.intersection(evt.resource_ids):
                 accept = True
 
             if evt.ven_ids and self.ven_id in evt.ven_ids:
@@ -315,12 +442,17 @@ class EventHandler(object):
         return accept
 
     def fill_event_target_info(self, evt: EventSchema) -> EventSchema:
+        '''
+        The group, party and VEN targets aren't stored, fill in ours.  The
+        resources targeted are stored, as they decide which resources an
+        event controls.
+        '''
         evt.group_ids = [self.group_id] if self.group_id else None
-        evt.resource_ids = [self.resource_id] if self.resource_id else None
         evt.party_ids = [self.party_id] if self.party_id else None
         evt.ven_ids = [self.ven_id] if self.ven_id else None
         return evt
 
+    @synchronized
     def get_active_events(self) -> List[EventSchema]:
         '''
         Get an iterator of all the active events.
@@ -337,16 +469,103 @@ class EventHandler(object):
 
         return active
 
-    def remove_events(self, evt_id_list):
+    @synchronized
+    def get_events_between(self, start, end) -> List[EventSchema]:
+        '''
+        Get the events active at any time from `start` to `end`, without
+        going through the others, e.g. far future ones.
+
+        Return: A list of EventSchema, by start
+        '''
+        return [
+            self.fill_event_target_info(evt)
+            for evt in self.db.get_events_between(start, end) if evt.id not in self.optouts
+        ]
+
+    def get_events_at(self, when) -> List[EventSchema]:
+        '''
+        Return: The events active at `when`, see `get_events_between()`
+        '''
+        return self.get_events_between(when, when)
+
+    @synchronized
+    def next_event_start(self, after):
+        '''
+        Return: The earliest start of an event later than `after`, None if
+                there is none
+        '''
+        return self.db.next_event_start(after)
+
+    @synchronized
+    def get_versions(self):
+        '''
+        Returns: A 3-tuple of (generation, event ID -> (modification number,
+                 status, end) of every stored event, IDs of those opted
+                 out of), all as of the same moment
+        '''
+        return self.generation, self.db.get_versions(), set(self.optouts)
+
+    @synchronized
+    def remove_events(self, evt_id_list, archive=False):
         '''
         Remove a list of events from our internal member dictionary
 
         event_id_list - List of Event IDs
+        archive - Keep them in the history table, see `eventdb.DBHandler.get_history()`
         '''
-        self.db.remove_events(evt_id_list)
+        self.db.remove_events(evt_id_list, finished=self.clock.now() if archive else None)
+        changes = []
         for evt in evt_id_list:
             self.optouts.discard(evt)
+            self._changed(changes, REMOVED, evt)
+        self._notify(changes)
+
+    @synchronized
+    def remove_expired(self, expired, archive=False):
+        '''
+        Remove events a control pass saw end, see `retention.Retention`,
+        unless they were modified or no longer ended since.
+
+        expired -- event ID -> modification number when it was seen to end
+        archive -- Keep them in the history table
+
+        Returns: IDs of the events removed
+        '''
+        now = self.clock.now()
+        versions = self.db.get_versions()
+        event_ids = []
+        for event_id, mod_number in sorted(expired.items()):
+            version = versions.get(event_id)
+            if version is None:
+                continue
+            stored_mod_number, _, end = version
+            if stored_mod_number == mod_number and end and datetime.fromisoformat(end) < now:
+                event_ids.append(event_id)
+            else:
+                logger.debug(f"Keeping event {event_id}({stored_mod_number}) - changed since it ended")
+
+        if event_ids:
+            self.remove_events(event_ids, archive=archive)
+        return event_ids
+
+    @synchronized
+    def get_history(self, since=None):
+        '''
+        Returns: The eventdb.HistoryEntry of each event archived by
+                 `remove_events()` after `since` (all if None)
+        '''
+        return self.db.get_history(since)
+
+    @synchronized
+    def prune_history(self, before):
+        '''
+        Drop the history of the events which finished before `before`.
+
+        Returns: The number of entries dropped
+        '''
+        return self.db.prune_history(before)
 
+    @synchronized
     def optout_event(self, e_id):
         '''
         Opt out of an event by its ID
@@ -355,11 +574,16 @@ class EventHandler(object):
         :return:
         '''
 
-        if e_id not in [event.id for event in self.db.get_active_events()]:
+        evt = self.db.get_event(e_id)
+        if evt is None:
             return  # optout of not existing event
 
         self.optouts.add(e_id)
+        changes = []
+        self._changed(changes, OPTED_OUT, e_id, evt)
+        self._notify(changes)
 
+    @synchronized
     def update_active_status(self, event_id):
         '''
         Update given event status
@@ -370,7 +594,9 @@ class EventHandler(object):
         event = self.db.get_event(event_id)
         if event and event.status in ["near", "far"]:
             event.status = "active"
-            self.db.update_event(event)
+            changes = []
+            self._changed(changes, MODIFIED, event_id, self.db.update_event(event))
+            self._notify(changes)
 
 
 def get_current_signal_value(evt, ns_map=NS_A):
@@ -1,20 +1,36 @@
+import collections
+import json
+import weakref
 from datetime import datetime
-from typing import Dict, List, Optional, Sequence, Union
+from typing import Any, Dict, List, Optional, Sequence, Union
 
-from sqlalchemy import (Boolean, Column, Float, ForeignKey, Integer, String,
-                        create_engine)
+from sqlalchemy import (Boolean, Column, Float, ForeignKeyConstraint, Integer,
+                        String, create_engine, event, inspect, literal, select)
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import Session, relationship, sessionmaker
+from sqlalchemy.pool import QueuePool, StaticPool
 
-from oadr2.schemas import EventSchema
+from oadr2 import intervals, logger
+from oadr2.schemas import EventSchema, simple_signal_index
 
 Base = declarative_base()
 
+MAX_BATCH = 500  # event IDs in one statement, below SQLite's limit of 999 parameters
+
+# A finished event kept in the history table
+HistoryEntry = collections.namedtuple(
+    'HistoryEntry', ('event_id', 'mod_number', 'start', 'end', 'status', 'priority', 'finished'))
+
 
 class Signal(Base):
     __tablename__ = "signals"
+    __table_args__ = (
+        ForeignKeyConstraint(["namespace", "event_id"], ["events.namespace", "events.id"]),
+    )
 
-    event_id = Column(String, ForeignKey("events.id"), primary_key=True)
+    namespace = Column(String, primary_key=True, default="")
+    event_id = Column(String, primary_key=True)
     index = Column(Integer, primary_key=True)
     duration = Column(String)
     level = Column(Float)
@@ -23,7 +39,9 @@ class Signal(Base):
 class Event(Base):
     __tablename__ = "events"
 
-    id = Column(String, primary_key=True, index=True, unique=True)
+    # Several VENs can share one database, each in its own namespace
+    namespace = Column(String, primary_key=True, default="")
+    id = Column(String, primary_key=True, index=True)
     mod_number = Column(Integer, nullable=False, default=0)
     _start = Column(String)
     _original_start = Column(String)
@@ -33,6 +51,11 @@ class Event(Base):
     status = Column(String)
     priority = Column(Integer)
     test_event = Column(Boolean)
+    _resource_ids = Column(String)  # JSON list of targeted resources, NULL if not targeted
+    # JSON list of [name, type, ID, current value, [[index, duration, level]...]] of every signal.
+    # The intervals of the simple signal are left out as null: the Signal rows, which
+    # the database had before this column, are the only copy of them.
+    _event_signals = Column(String)
 
     @property
     def start(self) -> datetime:
@@ -58,6 +81,38 @@ class Event(Base):
     def end(self, value: Union[datetime, None]) -> None:
         self._end = value.isoformat() if value else None
 
+    @property
+    def resource_ids(self) -> Optional[List[str]]:
+        return json.loads(self._resource_ids) if self._resource_ids else None
+
+    @resource_ids.setter
+    def resource_ids(self, value: Optional[List[str]]) -> None:
+        self._resource_ids = json.dumps(value) if value else None
+
+    @property
+    def event_signals(self) -> List[Dict[str, Any]]:
+        return [
+            dict(
+                name=name,
+                type=signal_type,
+                id=signal_id,
+                current_value=current_value,
+                intervals=[dict(index=index, duration=duration, level=level)
+                           for index, duration, level in intervals] if intervals is not None else self.signals
+            ) for name, signal_type, signal_id, current_value, intervals in json.loads(self._event_signals or "[]")
+        ]
+
+    @event_signals.setter
+    def event_signals(self, value: List[Dict[str, Any]]) -> None:
+        simple = simple_signal_index([(signal["name"], signal["type"]) for signal in value])
+        self._event_signals = json.dumps([
+            [
+                signal["name"], signal["type"], signal["id"], signal["current_value"],
+                [[interval["index"], interval["duration"], interval["level"]] for interval in signal["intervals"]]
+                if index != simple else None
+            ] for index, signal in enumerate(value)
+        ], separators=(",", ":")) if value else None
+
     @property
     def signals(self) -> List[Dict[str, Union[float, int, str]]]:
         return [
@@ -72,6 +127,7 @@ class Event(Base):
     def signals(self, value: List[Dict[str, Union[float, int, str]]]) -> None:
         self._signals = [
             Signal(
+                namespace=self.namespace,
                 event_id=self.id,
                 index=signal["index"],
                 duration=signal["duration"],
@@ -80,34 +136,253 @@ class Event(Base):
         ]
 
 
+class EventHistory(Base):
+    '''
+    What is left of an event once it finished, see `DBHandler.remove_events()`.
+    '''
+    __tablename__ = "event_history"
+
+    row = Column(Integer, primary_key=True)
+    namespace = Column(String, index=True, default="")
+    id = Column(String)
+    mod_number = Column(Integer)
+    _start = Column(String)
+    _end = Column(String)
+    status = Column(String)
+    priority = Column(Integer)
+    finished = Column(String, index=True)
+
+
+def create_shared_engine(db_path: str, pool_size: int = 4) -> Engine:
+    '''
+    An engine for one database shared by many DBHandlers across threads:
+    pooled connections instead of one per handler, and WAL journaling so
+    readers don't wait for a writer.
+    '''
+    engine = create_engine(
+        f"sqlite:///{db_path}",
+        connect_args={"check_same_thread": False},
+        poolclass=QueuePool,
+        pool_size=pool_size,
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_journal_mode(dbapi_connection, connection_record):
+        dbapi_connection.execute("PRAGMA journal_mode=WAL")
+
+    return engine
+
+
+def create_memory_engine() -> Engine:
+    '''
+    An in-memory database shared by many DBHandlers, e.g. those of a
+    simulation.  Its events are gone with the engine.
+    '''
+    return create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+
+
+def migrate(engine: Engine) -> None:
+    '''
+    Bring tables created by older versions up to date.  Tables from before
+    the `namespace` column existed are rebuilt, keeping their events in the
+    default namespace; columns added since are added empty.
+    '''
+    tables = inspect(engine).get_table_names()
+    if "events" not in tables:
+        return
+    existing = dict(
+        (table.name, set(column["name"] for column in inspect(engine).get_columns(table.name)))
+        for table in (Event.__table__, Signal.__table__) if table.name in tables
+    )
+
+    if "namespace" not in existing["events"]:
+        logger.info("Adding the namespace column to the events database")
+        with engine.begin() as connection:
+            connection.execute("ALTER TABLE signals RENAME TO signals_legacy")
+            connection.execute("ALTER TABLE events RENAME TO events_legacy")
+            connection.execute("DROP INDEX IF EXISTS ix_events_id")
+            Base.metadata.create_all(connection)
+            for table in (Event.__table__, Signal.__table__):
+                columns = ", ".join(
+                    f'"{column.name}"' for column in table.columns
+                    if column.name in existing.get(table.name, ()) and column.name != "namespace"
+                )
+                connection.execute(
+                    f"INSERT INTO {table.name} (namespace, {columns}) "
+                    f"SELECT '', {columns} FROM {table.name}_legacy"
+                )
+            connection.execute("DROP TABLE signals_legacy")
+            connection.execute("DROP TABLE events_legacy")
+        return
+
+    with engine.begin() as connection:
+        for table in (Event.__table__, Signal.__table__):
+            for column in table.columns:
+                if table.name in existing and column.name not in existing[table.name]:
+                    logger.info(f"Adding the {column.name} column to the {table.name} table")
+                    connection.execute(
+                        f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" '
+                        f'{column.type.compile(engine.dialect)}'
+                    )
+
+
+_prepared_engines = weakref.WeakSet()  # engines already migrated and set up
+
+
 class DBHandler:
-    def __init__(self, db_path: str):
-        engine = create_engine(f"sqlite:///{db_path}")
+    def __init__(self, db_path: str = None, engine: Engine = None, namespace: str = ""):
+        '''
+        db_path -- SQLite database file, used if no `engine` is given
+        engine -- A shared engine, see `create_shared_engine()`
+        namespace -- Keeps this handler's events apart from those of other
+                     handlers using the same database
+        '''
+        if engine is None:
+            engine = create_engine(f"sqlite:///{db_path}")
+        self.namespace = namespace
         self.session: Session = sessionmaker(bind=engine, autocommit=True)()
-        Event.metadata.create_all(engine)
+        self._index: Optional[intervals.IntervalIndex] = None
+        if engine not in _prepared_engines:
+            migrate(engine)
+            with engine.connect() as connection:
+                # Only takes on a new database, see `retention.vacuum()`
+                connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                Event.metadata.create_all(connection)
+            _prepared_engines.add(engine)
         self.accepted_params = {"id", "mod_number", "start", "original_start", "end", "signals",
-                                "cancellation_offset", "status", "priority", "test_event"}
+                                "cancellation_offset", "status", "priority", "test_event", "resource_ids",
+                                "event_signals"}
 
     def get_active_events(self) -> List[EventSchema]:
         return sorted(
             [
-                EventSchema.from_orm(evt) for evt in self.session.query(Event).all()
+                EventSchema.from_orm(evt)
+                for evt in self.session.query(Event).filter_by(namespace=self.namespace)
+            ], key=lambda evt: evt.start
+        )
+
+    @property
+    def index(self) -> intervals.IntervalIndex:
+        '''
+        The time ranges of our events, read from the database the first time
+        and then kept up to date by our own changes.
+        '''
+        if self._index is None:
+            index = intervals.IntervalIndex()
+            for event_id, start, end in self.session.query(Event.id, Event._start, Event._end) \
+                    .filter_by(namespace=self.namespace):
+                index.add(event_id, datetime.fromisoformat(start), datetime.fromisoformat(end) if end else None)
+            self._index = index
+        return self._index
+
+    def get_events_between(self, start: datetime, end: datetime) -> List[EventSchema]:
+        '''
+        Returns: The events active at any time from `start` to `end`, by start
+        '''
+        event_ids = self.index.overlapping(start, end)
+        if not event_ids:
+            return []
+        return sorted(
+            [
+                EventSchema.from_orm(evt)
+                for evt in self.session.query(Event).filter(
+                    Event.namespace == self.namespace, Event.id.in_(event_ids))
             ], key=lambda evt: evt.start
         )
 
-    def update_event(self, event: EventSchema) -> None:
+    def get_events_at(self, when: datetime) -> List[EventSchema]:
+        return self.get_events_between(when, when)
+
+    def next_event_start(self, after: datetime) -> Optional[datetime]:
+        return self.index.next_start(after)
+
+    def get_versions(self) -> Dict[str, tuple]:
+        '''
+        Returns: event ID -> (modification number, status, end) of each
+                 stored event, without loading their signals
+        '''
+        return dict(
+            (event_id, (mod_number, status, end))
+            for event_id, mod_number, status, end in self.session.query(
+                Event.id, Event.mod_number, Event.status, Event._end).filter_by(namespace=self.namespace)
+        )
+
+    def update_event(self, event: EventSchema) -> EventSchema:
         self.remove_events([event.id])
-        self.add_event(event)
+        return self.add_event(event)
 
-    def add_event(self, event: EventSchema) -> None:
-        db_item = Event(**event.dict(include=self.accepted_params))
+    def add_event(self, event: EventSchema) -> EventSchema:
+        '''
+        Returns: The event as `get_event()` will return it
+        '''
+        db_item = Event(namespace=self.namespace, **event.dict(include=self.accepted_params))
         self.session.add(db_item)
+        if self._index is not None:
+            self._index.add(event.id, event.start, event.end)
+        return EventSchema.from_orm(db_item)
 
     def get_event(self, event_id: str) -> Optional[EventSchema]:
-        evt = self.session.query(Event).filter_by(id=event_id).first()
+        evt = self.session.query(Event).filter_by(namespace=self.namespace, id=event_id).first()
         return EventSchema.from_orm(evt) if evt else None
 
-    def remove_events(self, event_ids: Sequence[str]) -> None:
-        for event_id in event_ids:
-            self.session.query(Event).filter_by(id=event_id).delete()
-            self.session.query(Signal).filter_by(event_id=event_id).delete()
+    def remove_events(self, event_ids: Sequence[str], finished: datetime = None) -> None:
+        '''
+        Delete events and their signals, MAX_BATCH at a time, each batch in
+        one transaction.
+
+        finished -- Keep a row of each event in the history table, as
+                    finished at this UTC datetime
+        '''
+
+        event_ids = list(event_ids)
+        self.session.flush()
+        for first in range(0, len(event_ids), MAX_BATCH):
+            batch = event_ids[first:first + MAX_BATCH]
+            with self.session.begin():
+                if finished is not None:
+                    self.session.execute(EventHistory.__table__.insert().from_select(
+                        ["namespace", "id", "mod_number", "_start", "_end", "status", "priority", "finished"],
+                        select([
+                            Event.namespace, Event.id, Event.mod_number, Event._start, Event._end,
+                            Event.status, Event.priority, literal(finished.isoformat()),
+                        ]).where(Event.namespace == self.namespace).where(Event.id.in_(batch))
+                    ))
+                self.session.query(Signal).filter(
+                    Signal.namespace == self.namespace, Signal.event_id.in_(batch)
+                ).delete(synchronize_session=False)
+                self.session.query(Event).filter(
+                    Event.namespace == self.namespace, Event.id.in_(batch)
+                ).delete(synchronize_session=False)
+        # All changes were flushed, so only deleted or unchanged objects go
+        self.session.expunge_all()
+
+        if self._index is not None:
+            for event_id in event_ids:
+                self._index.remove(event_id)
+
+    def get_history(self, since: datetime = None) -> List[HistoryEntry]:
+        '''
+        Returns: The events which finished after `since` (all if None), in
+                 the order they finished
+        '''
+        query = self.session.query(EventHistory).filter(EventHistory.namespace == self.namespace)
+        if since is not None:
+            query = query.filter(EventHistory.finished > since.isoformat())
+        return [
+            HistoryEntry(
+                entry.id, entry.mod_number, datetime.fromisoformat(entry._start),
+                datetime.fromisoformat(entry._end) if entry._end else None,
+                entry.status, entry.priority, datetime.fromisoformat(entry.finished))
+            for entry in query.order_by(EventHistory.finished, EventHistory.row)
+        ]
+
+    def prune_history(self, before: datetime) -> int:
+        '''
+        Drop the history of the events which finished before `before`.
+
+        Returns: The number of entries dropped
+        '''
+        with self.session.begin():
+            return self.session.query(EventHistory).filter(
+                EventHistory.namespace == self.namespace, EventHistory.finished < before.isoformat()
+            ).delete(synchronize_session=False)
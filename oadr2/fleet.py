@@ -0,0 +1,323 @@
+# Shards VEN identities over a pool of processes, each running a VENHost
+# pylint: disable=W1202
+import multiprocessing
+import os
+import threading
+import time
+import zlib
+from multiprocessing import connection
+
+from oadr2 import host, logger
+
+DEFAULT_HEARTBEAT_INTERVAL = 1  # seconds between shard status reports
+DEFAULT_HEARTBEAT_TIMEOUT = 30  # a shard silent for X seconds is restarted
+RESTART_DELAY = 1  # seconds before restarting a failed shard, doubled per failure in a row
+MAX_RESTART_DELAY = 60
+
+SUMMED_STATS = ('vens', 'scheduled', 'polls', 'updates', 'errors', 'control_passes')
+
+
+def shard_for(ven_id, shards):
+    '''
+    Returns: The index of the shard hosting `ven_id`, the same in every
+             process and run
+    '''
+    return zlib.crc32(ven_id.encode('utf-8')) % shards
+
+
+def run_shard(db_path, vens, host_opts, conn, heartbeat_interval):
+    '''
+    Entry point of a shard process.  Hosts `vens` in a VENHost, sending its
+    stats over `conn` every `heartbeat_interval` seconds until the
+    supervisor sends anything back or goes away.
+
+    vens -- A list of keyword argument dicts for `VENHost.add_ven()`
+    conn -- This shard's end of a multiprocessing Pipe
+    '''
+
+    ven_host = host.VENHost(db_path, **host_opts)
+    try:
+        for ven in vens:
+            ven_host.add_ven(**ven)
+        while True:
+            conn.send(ven_host.stats())
+            if conn.poll(heartbeat_interval):
+                break
+    except (EOFError, OSError):
+        pass
+    finally:
+        ven_host.exit()
+        conn.close()
+
+
+class Shard(object):
+    '''
+    The supervisor's view of one shard process.
+
+    Member Variables:
+    --------
+    index -- Position of the shard in `Fleet.shards`
+    db_path -- SQLite database of the shard's VENs
+    vens -- A list of keyword argument dicts for `VENHost.add_ven()`
+    process -- The current multiprocessing.Process, None until started
+    conn -- The supervisor's end of the pipe to the process
+    pid -- PID of the current process
+    restarts -- Times the process was restarted
+    failures -- Failures since the last heartbeat, sets the restart backoff
+    last_heartbeat -- time.monotonic() of the last heartbeat (or start)
+    restart_at -- time.monotonic() after which a dead shard is restarted
+    stats -- The VENHost stats of the last heartbeat
+    '''
+
+    def __init__(self, index, db_path):
+        self.index = index
+        self.db_path = db_path
+        self.vens = []
+        self.process = None
+        self.conn = None
+        self.pid = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_heartbeat = None
+        self.restart_at = None
+        self.stats = {}
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+
+class Fleet(object):
+    '''
+    Runs VEN identities across a pool of processes, so parsing and event
+    handling for thousands of VENs can use every core instead of contending
+    for one GIL.  Each shard process runs a `host.VENHost` with its own
+    database, and VENs are assigned to shards by a hash of their ven_id.
+
+    A supervisor thread in the parent collects each shard's heartbeat and
+    stats, and restarts a shard whose process dies or stops reporting for
+    `heartbeat_timeout` seconds.  Events are in the shard's database, so a
+    restarted shard picks up where it left off.
+
+    Shards are started with the `spawn` method by default, so everything in
+    a VEN's `event_config` and `control_opts` (e.g. an `event_callback`)
+    must be picklable: a module level function, not a lambda.
+
+    Member Variables:
+    --------
+    shards -- The list of Shard
+    db_dir -- Directory of the shard databases
+    host_opts -- Keyword arguments for each shard's VENHost
+    heartbeat_interval -- Seconds between shard status reports
+    heartbeat_timeout -- Seconds of silence before a shard is restarted
+    '''
+
+    def __init__(self, db_dir, shards=None, host_opts={},
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 mp_context='spawn'):
+        '''
+        db_dir -- Directory for the shard databases, `shard_N.db`
+        shards -- Number of shard processes, one per CPU if None
+        host_opts -- Keyword arguments for each shard's VENHost
+                     (workers, parse_cache_size, startup_spread)
+        heartbeat_interval -- Seconds between shard status reports
+        heartbeat_timeout -- Seconds of silence before a shard is restarted
+        mp_context -- multiprocessing start method
+        '''
+
+        self.db_dir = db_dir
+        self.host_opts = dict(host_opts)
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.shards = [
+            Shard(index, os.path.join(db_dir, 'shard_%d.db' % index))
+            for index in range(int(shards or os.cpu_count() or 1))
+        ]
+
+        self._context = multiprocessing.get_context(mp_context)
+        self._lock = threading.Lock()
+        self._exit = threading.Event()
+        self._thread = None
+
+    def add_ven(self, ven_id, vtn_base_uri, **ven_opts):
+        '''
+        Assign a VEN to its shard.  VENs are added before `start()`.
+
+        ven_id -- The VEN's ID
+        vtn_base_uri -- Base URI of its VTN
+        **ven_opts -- More keyword arguments for `VENHost.add_ven()`
+
+        Returns: The index of the VEN's shard
+        '''
+
+        if self._thread is not None:
+            raise RuntimeError("VENs must be added before the fleet starts")
+
+        index = shard_for(ven_id, len(self.shards))
+        self.shards[index].vens.append(dict(ven_opts, ven_id=ven_id, vtn_base_uri=vtn_base_uri))
+        return index
+
+    def start(self):
+        '''
+        Start every shard process and the supervisor thread.
+        '''
+
+        self._exit.clear()
+        with self._lock:
+            for shard in self.shards:
+                self._start_shard(shard)
+
+        self._thread = threading.Thread(name='oadr2.fleet', target=self._supervise)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        '''
+        Returns: A dict merging the last heartbeat of every shard: summed
+                 VENHost counters and parse cache stats, the number of
+                 shards alive and restarts, plus `per_shard`, a list of
+                 each shard's pid, restarts, heartbeat age and stats.
+                 Counters of a restarted shard start again from 0.
+        '''
+
+        now = time.monotonic()
+        merged = dict((key, 0) for key in SUMMED_STATS)
+        merged['parse_cache'] = dict(size=0, hits=0, misses=0)
+        per_shard = []
+
+        with self._lock:
+            for shard in self.shards:
+                for key in SUMMED_STATS:
+                    merged[key] += shard.stats.get(key, 0)
+                for key, value in shard.stats.get('parse_cache', {}).items():
+                    merged['parse_cache'][key] += value
+                per_shard.append(dict(
+                    index=shard.index,
+                    pid=shard.pid,
+                    alive=shard.alive,
+                    restarts=shard.restarts,
+                    assigned=len(shard.vens),
+                    heartbeat_age=now - shard.last_heartbeat if shard.last_heartbeat else None,
+                    stats=shard.stats,
+                ))
+
+        merged.update(
+            shards=len(self.shards),
+            alive=sum(1 for shard in per_shard if shard['alive']),
+            restarts=sum(shard['restarts'] for shard in per_shard),
+            per_shard=per_shard,
+        )
+        return merged
+
+    def exit(self, timeout=10):
+        '''
+        Stop the supervisor and ask every shard to shut down, terminating
+        those still running after `timeout` seconds.
+        '''
+
+        self._exit.set()
+        if self._thread is not None:
+            self._thread.join(2 * self.heartbeat_interval + 1)
+
+        for shard in self.shards:
+            if shard.conn is not None:
+                try:
+                    shard.conn.send(None)
+                except OSError:
+                    pass
+
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            shard.process.join(max(0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                logger.warning("Shard %d did not stop, terminating it", shard.index)
+                shard.process.terminate()
+                shard.process.join(1)
+            self._disconnect(shard)
+        logger.info("VEN fleet shut down.")
+
+    def _start_shard(self, shard):
+        '''
+        Called with `self._lock` held.
+        '''
+
+        shard.conn, child_conn = self._context.Pipe()
+        shard.process = self._context.Process(
+            name='oadr2.fleet.shard_%d' % shard.index,
+            target=run_shard,
+            args=(shard.db_path, shard.vens, self.host_opts, child_conn, self.heartbeat_interval),
+        )
+        shard.process.daemon = True
+        shard.process.start()
+        child_conn.close()
+        shard.pid = shard.process.pid
+        shard.last_heartbeat = time.monotonic()
+        shard.restart_at = None
+        shard.stats = {}
+        logger.info("Started shard %d (pid %d) with %d VENs", shard.index, shard.pid, len(shard.vens))
+
+    def _supervise(self):
+        while not self._exit.is_set():
+            with self._lock:
+                conns = dict((shard.conn, shard) for shard in self.shards if shard.conn is not None)
+            if conns:
+                ready = connection.wait(list(conns), timeout=self.heartbeat_interval)
+            else:  # every shard is waiting for a restart
+                ready = []
+                self._exit.wait(self.heartbeat_interval)
+
+            with self._lock:
+                for conn in ready:
+                    self._receive(conns[conn])
+                for shard in self.shards:
+                    self._check(shard)
+
+    def _receive(self, shard):
+        '''
+        Take the heartbeats waiting on `shard`'s pipe.  Called with
+        `self._lock` held.
+        '''
+        try:
+            while shard.conn.poll():
+                shard.stats = shard.conn.recv()
+                shard.last_heartbeat = time.monotonic()
+                shard.failures = 0
+        except (EOFError, OSError):  # the process went away, see _check()
+            self._disconnect(shard)
+
+    def _disconnect(self, shard):
+        if shard.conn is not None:
+            shard.conn.close()
+            shard.conn = None
+
+    def _check(self, shard):
+        '''
+        Restart `shard` if its process died or went silent, after a backoff
+        growing with each failure in a row.  Called with `self._lock` held.
+        '''
+
+        now = time.monotonic()
+        if shard.restart_at is None:
+            if shard.alive and now - shard.last_heartbeat < self.heartbeat_timeout:
+                return
+
+            if shard.alive:
+                logger.error("Shard %d (pid %d) missed its heartbeats, terminating it",
+                             shard.index, shard.pid)
+                shard.process.terminate()
+                shard.process.join(1)
+            else:
+                logger.error("Shard %d (pid %d) died with exit code %s",
+                             shard.index, shard.pid, shard.process.exitcode)
+            self._disconnect(shard)
+
+            delay = min(RESTART_DELAY * 2 ** shard.failures, MAX_RESTART_DELAY)
+            shard.failures += 1
+            shard.restart_at = now + delay
+
+        if now >= shard.restart_at:
+            shard.restarts += 1
+            self._start_shard(shard)
@@ -0,0 +1,319 @@
+# Hosts many VEN identities in one process over shared resources
+# pylint: disable=W1202
+import collections
+import hashlib
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from lxml import etree
+from requests.adapters import HTTPAdapter
+
+from oadr2 import dispatch, eventdb, logger, poll, schedule, xmlconv
+from oadr2.schemas import EventSchema
+
+DEFAULT_WORKERS = 8  # threads polling and running control passes for all VENs
+DEFAULT_PARSE_CACHE_SIZE = 1024  # distinct eiEvents kept parsed
+STARTUP_SPREAD = 10  # first polls are spread over X seconds
+
+POLL = 'poll'
+CONTROL = 'control'
+
+
+class EventParseCache(object):
+    '''
+    Shares parsed events between VENs.  When a VTN sends the same
+    oadrDistributeEvent to many VENs, each ei:eiEvent is parsed into an
+    EventSchema once and every VEN gets a copy.
+
+    Events are keyed by a hash of their canonical (C14N) XML.  The random
+    start offset of an event with a startbefore/startafter tolerance is drawn
+    again for every copy, so VENs still don't all start at the same second.
+    '''
+
+    def __init__(self, max_size=DEFAULT_PARSE_CACHE_SIZE, parser=EventSchema.from_xml):
+        '''
+        max_size -- Parsed events kept, least recently used ones are dropped
+        parser -- Parses an ei:eiEvent element on a cache miss
+        '''
+        self.max_size = max_size
+        self.parser = parser
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()  # digest -> (EventSchema, (startbefore, startafter))
+        self._lock = threading.Lock()
+
+    def parse(self, evt_xml):
+        '''
+        A drop-in for `EventSchema.from_xml`, see `EventHandler.event_parser`.
+
+        Returns: A new EventSchema which the caller may modify
+        '''
+
+        if xmlconv.is_lxml(evt_xml):
+            key = hashlib.sha256(etree.tostring(evt_xml, method='c14n')).digest()
+        else:
+            key = hashlib.sha256(xmlconv.tostring(evt_xml)).digest()
+
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+            else:
+                # Parsed under the lock, so VENs getting the same event at
+                # once don't all parse it
+                evt = self.parser(evt_xml)
+                self.misses += 1
+                self._cache[key] = (evt.copy(deep=True), EventSchema.get_start_before_after(evt_xml))
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+                return evt
+
+        cached, start_offset = entry
+        evt = cached.copy(deep=True)
+        if any(start_offset):
+            evt.start = schedule.random_offset(evt.original_start, *start_offset)
+            if evt.end is not None:
+                evt.end += evt.start - cached.start
+        return evt
+
+    def stats(self):
+        with self._lock:
+            return dict(size=len(self._cache), hits=self.hits, misses=self.misses)
+
+
+class VENHost(object):
+    '''
+    Runs many VEN identities in one process.  Each VEN is a poll.OpenADR2
+    with its own ven_id, targets, optouts and database namespace, but none
+    has threads of its own: one scheduler thread hands their polls and
+    control passes to a shared pool of workers, and they share one database
+    engine, one HTTP session and one EventParseCache.
+
+    A long-poll request ties up a worker while the VTN holds it, so VENs
+    with `long_poll_timeout` need about one worker each.
+
+    Member Variables:
+    --------
+    vens -- ven_id -> poll.OpenADR2
+    engine -- The SQLAlchemy engine shared by all VENs
+    session -- The requests.Session shared by all VENs
+    parse_cache -- The EventParseCache shared by all VENs
+    callbacks -- The dispatch.CoalescingDispatcher shared by all VENs
+    workers -- Size of the worker pool
+    startup_spread -- First polls are spread over this many seconds
+    '''
+
+    def __init__(self, db_path, workers=DEFAULT_WORKERS, parse_cache_size=DEFAULT_PARSE_CACHE_SIZE,
+                 startup_spread=STARTUP_SPREAD, start_thread=True):
+        '''
+        db_path -- SQLite database for the events of all VENs
+        workers -- Threads polling and running control passes
+        parse_cache_size -- Distinct events kept parsed, see EventParseCache
+        startup_spread -- Spread the first polls over this many seconds
+        start_thread -- Start the scheduler right away
+        '''
+
+        self.workers = int(workers)
+        self.startup_spread = startup_spread
+        self.engine = eventdb.create_shared_engine(db_path, pool_size=self.workers)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self.parse_cache = EventParseCache(parse_cache_size)
+        self.callbacks = dispatch.CoalescingDispatcher(workers=self.workers, name='oadr2.host-callback')
+        self.vens = {}
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='oadr2.host')
+        self._queue = []  # heap of (due time, seq, ven_id, task)
+        self._seq = itertools.count()
+        # ven_id -> seq of its scheduled control pass, None while it runs;
+        # a VEN has one control pass at a time, older entries are skipped
+        self._control = {}
+        self._control_again = set()  # VENs whose running control pass must run again
+        self._changed = threading.Condition()
+        self._exit = threading.Event()
+        self._thread = None
+        self._counts = collections.Counter()  # polls, updates, errors, control_passes
+
+        if start_thread:
+            self.start()
+
+    def add_ven(self, ven_id, vtn_base_uri, event_config={}, control_opts={}, **poll_opts):
+        '''
+        Add a VEN identity, polled from the next scheduler pass.
+
+        ven_id -- The VEN's ID, also its database namespace
+        vtn_base_uri -- Base URI of its VTN
+        event_config -- More keyword arguments for its EventHandler
+                        (vtn_ids, targets, market_contexts, event_callback...)
+        control_opts -- More keyword arguments for its EventController
+        **poll_opts -- More keyword arguments for poll.OpenADR2
+
+        Returns: The VEN's poll.OpenADR2
+        '''
+
+        if ven_id in self.vens:
+            raise ValueError("VEN %s is already hosted" % ven_id)
+
+        ven = poll.OpenADR2(
+            event_config=dict(
+                event_config,
+                ven_id=ven_id,
+                db_engine=self.engine,
+                db_namespace=ven_id,
+                event_parser=self.parse_cache.parse,
+            ),
+            vtn_base_uri=vtn_base_uri,
+            control_opts=dict(dict(callback_dispatcher=self.callbacks, **control_opts), start_thread=False),
+            session=self.session,
+            start_thread=False,
+            **poll_opts
+        )
+
+        now = time.monotonic()
+        with self._changed:
+            self.vens[ven_id] = ven
+            self._schedule(now + random.uniform(0, self.startup_spread), ven_id, POLL)
+            self._schedule(now, ven_id, CONTROL)
+        return ven
+
+    def remove_ven(self, ven_id):
+        '''
+        Stop hosting a VEN.  Its events stay in the database.
+        '''
+        with self._changed:
+            ven = self.vens.pop(ven_id)
+            self._control.pop(ven_id, None)
+            self._control_again.discard(ven_id)
+        ven.exit()
+
+    def start(self):
+        self._exit.clear()
+        self._thread = threading.Thread(name='oadr2.host', target=self._scheduler_loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stats(self):
+        '''
+        Returns: A dict with the number of VENs and scheduled tasks, counts
+                 of polls, polls which updated events, failed tasks and
+                 control passes, and the parse cache and callback stats
+        '''
+        with self._changed:
+            stats = dict(vens=len(self.vens), scheduled=len(self._queue))
+            for key in ('polls', 'updates', 'errors', 'control_passes'):
+                stats[key] = self._counts[key]
+        stats['parse_cache'] = self.parse_cache.stats()
+        stats['callbacks'] = self.callbacks.stats()
+        return stats
+
+    def exit(self):
+        '''
+        Stop the scheduler, let running tasks finish and shut down all VENs.
+        '''
+
+        with self._changed:
+            self._exit.set()
+            self._changed.notify_all()
+        if self._thread is not None:
+            self._thread.join(2)
+        self._executor.shutdown(wait=True)
+
+        with self._changed:
+            vens, self.vens = list(self.vens.values()), {}
+        for ven in vens:
+            ven.exit()
+
+        self.callbacks.stop(2)
+        self.session.close()
+        self.engine.dispose()
+        logger.info("VEN host shut down.")
+
+    def _schedule(self, due, ven_id, task):
+        '''
+        Called with `self._changed` held.
+        '''
+        seq = next(self._seq)
+        if task == CONTROL:
+            self._control[ven_id] = seq
+        heapq.heappush(self._queue, (due, seq, ven_id, task))
+        self._changed.notify()
+
+    def _control_now(self, ven_id):
+        '''
+        Move the control pass of a VEN to now, or have it run again straight
+        away if it is running, so that it never runs twice at once.
+        Called with `self._changed` held.
+        '''
+        if ven_id not in self._control:
+            return  # removed
+        if self._control[ven_id] is None:
+            self._control_again.add(ven_id)
+        else:
+            self._schedule(time.monotonic(), ven_id, CONTROL)
+
+    def _scheduler_loop(self):
+        while True:
+            with self._changed:
+                while not self._exit.is_set():
+                    now = time.monotonic()
+                    if self._queue and self._queue[0][0] <= now:
+                        break
+                    self._changed.wait(self._queue[0][0] - now if self._queue else None)
+                if self._exit.is_set():
+                    return
+
+                _, seq, ven_id, task = heapq.heappop(self._queue)
+                ven = self.vens.get(ven_id)
+                if task == CONTROL:
+                    if self._control.get(ven_id) != seq:
+                        continue  # the pass was moved
+                    self._control[ven_id] = None
+
+            if ven is not None:  # else it was removed
+                self._executor.submit(self._run_task, ven_id, ven, task)
+
+    def _run_task(self, ven_id, ven, task):
+        '''
+        Poll a VEN's VTN or run its control pass on a worker, then schedule
+        the next one.  A poll which updated the events moves the control
+        pass to now rather than running it, which could be running already.
+        '''
+
+        delay = ven.vtn_poll_interval if task == POLL else ven.event_controller.control_loop_interval
+        counts = []
+        try:
+            if task == POLL:
+                started = time.monotonic()
+                updated = ven.query_vtn()
+                counts.append('polls')
+                if updated:
+                    counts.append('updates')
+                    with self._changed:
+                        self._control_now(ven_id)
+                delay = ven._poll_delay(time.monotonic() - started, updated)
+            else:
+                ven.event_controller.tick()
+                counts.append('control_passes')
+
+        except Exception as ex:
+            counts.append('errors')
+            logger.exception("Error in %s of VEN %s: %s", task, ven_id, ex)
+
+        finally:
+            with self._changed:
+                self._counts.update(counts)
+                if task == CONTROL and ven_id in self._control_again:
+                    self._control_again.discard(ven_id)
+                    delay = 0
+                if self.vens.get(ven_id) is ven and not self._exit.is_set():
+                    self._schedule(time.monotonic() + delay, ven_id, task)
@@ -0,0 +1,168 @@
+'''
+An index of the time ranges of events, so that the events active at a
+time, or overlapping a window, can be found without going through all of
+them: a treap (a binary search tree kept balanced by random priorities)
+ordered by start, where each node also knows the latest end below it.
+
+Ranges are closed, [start, end], like the events themselves: an event is
+still active at its end.  An end of None is open ended.
+'''
+import random
+from datetime import datetime
+
+OPEN_END = datetime.max
+
+
+class _Node(object):
+    __slots__ = ('key', 'order', 'start', 'end', 'priority', 'left', 'right', 'max_end')
+
+    def __init__(self, key, start, end, priority):
+        self.key = key
+        self.order = (start, key)
+        self.start = start
+        self.end = end
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.max_end = end
+
+
+def _update(node):
+    node.max_end = node.end
+    for child in (node.left, node.right):
+        if child is not None and child.max_end > node.max_end:
+            node.max_end = child.max_end
+    return node
+
+
+def _split(node, order):
+    '''
+    Returns: (the nodes before `order`, the others)
+    '''
+    if node is None:
+        return None, None
+    if node.order < order:
+        node.right, right = _split(node.right, order)
+        return _update(node), right
+    left, node.left = _split(node.left, order)
+    return left, _update(node)
+
+
+def _merge(left, right):
+    '''
+    Returns: The union of two treaps, all of `left` ordered before `right`
+    '''
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        return _update(left)
+    right.left = _merge(left, right.left)
+    return _update(right)
+
+
+def _remove(node, order):
+    if node is None:
+        return None
+    if order == node.order:
+        return _merge(node.left, node.right)
+    if order < node.order:
+        node.left = _remove(node.left, order)
+    else:
+        node.right = _remove(node.right, order)
+    return _update(node)
+
+
+class IntervalIndex(object):
+    '''
+    The time ranges of a set of keys (event IDs).  Adding, moving and
+    removing a range, and finding those at a time, take O(log n) expected,
+    plus the number of ranges found.
+    '''
+
+    def __init__(self, seed=None):
+        self._root = None
+        self._nodes = {}  # key -> _Node
+        self._random = random.Random(seed)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, key):
+        return key in self._nodes
+
+    def add(self, key, start, end=None):
+        '''
+        Index the range of `key`, replacing the one it had.
+
+        end -- None for an open ended range
+        '''
+
+        if key in self._nodes:
+            self.remove(key)
+        node = _Node(key, start, end if end is not None else OPEN_END, self._random.random())
+        left, right = _split(self._root, node.order)
+        self._root = _merge(_merge(left, node), right)
+        self._nodes[key] = node
+
+    def remove(self, key):
+        '''
+        Drop `key` from the index, if it is there.
+        '''
+        node = self._nodes.pop(key, None)
+        if node is not None:
+            self._root = _remove(self._root, node.order)
+
+    def get(self, key):
+        '''
+        Returns: The (start, end) of `key`, end None if open ended
+        '''
+        node = self._nodes[key]
+        return node.start, node.end if node.end != OPEN_END else None
+
+    def at(self, when):
+        '''
+        Returns: The keys whose range contains `when`, by start
+        '''
+        return self.overlapping(when, when)
+
+    def overlapping(self, start, end):
+        '''
+        Returns: The keys whose range has any time in common with
+                 [start, end], by start
+        '''
+
+        found = []
+        stack = []
+        node = self._root
+        while stack or node is not None:
+            # Nothing below `node` ends after `start`: skip the subtree
+            while node is not None and node.max_end >= start:
+                stack.append(node)
+                node = node.left
+            if not stack:
+                break
+            node = stack.pop()
+            if node.start > end:
+                break  # this and all that follow start too late
+            if node.end >= start:
+                found.append(node.key)
+            node = node.right
+        return found
+
+    def next_start(self, after):
+        '''
+        Returns: The earliest start later than `after`, None if there is none
+        '''
+
+        found = None
+        node = self._root
+        while node is not None:
+            if node.start > after:
+                found = node.start
+                node = node.left
+            else:
+                node = node.right
+        return found
@@ -0,0 +1,269 @@
+'''
+A local query API over a Unix domain socket, so that integrations in other
+processes can ask for the signal level, the active events and the upcoming
+schedule, and opt out of events, without importing this package.
+
+The framing is JSON lines: each request is one JSON object on its own line,
+
+    {"id": 1, "method": "level"}
+    {"id": 2, "method": "schedule", "params": {"horizon": 3600}}
+    {"id": 3, "method": "optout", "params": {"event_id": "FooEvent"}}
+
+and each gets one line back, in order, carrying the same `id` and either a
+`result` or an `error` with a `code` and a `message`.  Times are UTC in
+ISO 8601.  Clients may send several requests without waiting for replies.
+
+Methods:
+
+    level    -- {"level", "event_id", "next_change"}
+    events   -- A list of the active events and their intervals
+    schedule -- The intervals of the active events which have not ended, in
+                start order, optionally only those starting within
+                `horizon` seconds
+    forecast -- The signal level over the next `hours` (12 by default) as
+                {"times", "levels", "event_ids"} arrays, see
+                `controller.EventController.forecast()`
+    optout   -- Opt out of `event_id`; {"opted_out": true} if it is active
+
+Queries are answered from the EventController's in-memory state, which is
+refreshed on every control pass, so they never touch the database.  Only a
+forecast after the events changed, and opt-outs, do; they run on a worker
+thread.
+'''
+# pylint: disable=W1202
+import asyncio
+import inspect
+import json
+import math
+import os
+from datetime import timedelta
+
+from oadr2 import aioloop, logger, schedule, timeline
+
+MAX_REQUEST_SIZE = 64 * 1024  # bytes in a request line
+
+
+class RequestError(Exception):
+    '''
+    Answered to the client as an error with `code`.
+    '''
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class LocalAPI(object):
+    '''
+    Serves the JSON lines API on a Unix socket from an asyncio event loop,
+    one task per client, so many clients can be connected at once.
+
+    Member Variables:
+    --------
+    path -- The socket path
+    event_handler -- The event.EventHandler opt-outs go to
+    event_controller -- The controller.EventController queries are answered from
+    loop -- The aioloop.EventLoopThread serving the socket
+    clients -- Number of clients connected
+    '''
+
+    def __init__(self, path, event_handler, event_controller, loop=None, mode=0o660):
+        '''
+        path -- Path of the Unix socket, replaced if it exists
+        event_handler -- An event.EventHandler
+        event_controller -- Its controller.EventController
+        loop -- An aioloop.EventLoopThread, the process wide one if None
+        mode -- Permissions of the socket file
+        '''
+
+        self.path = path
+        self.event_handler = event_handler
+        self.event_controller = event_controller
+        self.loop = loop if loop is not None else aioloop.shared_loop()
+        self.clients = 0
+
+        self._methods = dict(
+            level=self.level,
+            events=self.events,
+            schedule=self.schedule,
+            forecast=self.forecast,
+            optout=self.optout,
+        )
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = self.loop.submit(
+            asyncio.start_unix_server(self._serve, path, limit=MAX_REQUEST_SIZE)).result(5)
+        os.chmod(path, mode)
+        logger.info("Local API listening on %s", path)
+
+    def exit(self):
+        '''
+        Stop accepting clients and remove the socket.
+        '''
+
+        async def close():
+            self._server.close()
+            await self._server.wait_closed()
+
+        self.loop.submit(close()).result(5)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def level(self):
+        controller = self.event_controller
+        return dict(
+            level=controller.current_signal_level,
+            event_id=controller.current_event_id,
+            next_change=_time(controller.next_change_time),
+        )
+
+    def events(self):
+        return [
+            dict(
+                id=evt.id,
+                status=evt.status,
+                mod_number=evt.mod_number,
+                priority=evt.priority,
+                test_event=evt.test_event,
+                market_context=evt.market_context,
+                start=_time(evt.start),
+                end=_time(evt.end),
+                intervals=[
+                    dict(index=index, start=_time(start), end=_time(end), level=level)
+                    for index, start, end, level in _intervals(evt)
+                ],
+            ) for evt in self._active_events()
+        ]
+
+    def schedule(self, horizon=None):
+        now = self.event_controller.clock.now()
+        until = now + timedelta(seconds=_number('horizon', horizon)) if horizon is not None else None
+        upcoming = []
+        for evt in self._active_events():
+            if evt.test_event:
+                continue
+            for index, start, end, level in _intervals(evt):
+                if (end is not None and end <= now) or (until is not None and start > until):
+                    continue
+                upcoming.append((start, evt.id, index, end, level))
+
+        return [
+            dict(event_id=event_id, index=index, start=_time(start), end=_time(end), level=level)
+            for start, event_id, index, end, level in sorted(upcoming, key=lambda item: item[:3])
+        ]
+
+    def forecast(self, hours=12, resource=None):
+        if resource is not None and not isinstance(resource, str):
+            raise RequestError('bad-params', "resource must be a string")
+        return self.event_controller.forecast(_number('hours', hours), resource).as_arrays()
+
+    def optout(self, event_id):
+        '''
+        Opt out of an event and have the controller take it into account
+        on its next pass.  Runs on a worker thread as it uses the database.
+        '''
+        if not isinstance(event_id, str):
+            raise RequestError('bad-params', "event_id must be a string")
+        self.event_handler.optout_event(event_id)
+        opted_out = event_id in self.event_handler.optouts
+        if opted_out:
+            self.event_controller.events_updated()
+        return dict(opted_out=opted_out)
+
+    def _active_events(self):
+        optouts = self.event_handler.optouts
+        return [evt for evt in self.event_controller.active_events if evt.id not in optouts]
+
+    async def _serve(self, reader, writer):
+        self.clients += 1
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:  # longer than MAX_REQUEST_SIZE
+                    writer.write(_encode(dict(id=None, error=dict(
+                        code='too-large', message="Request over %d bytes" % MAX_REQUEST_SIZE))))
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                writer.write(_encode(await self._handle(line)))
+                await writer.drain()
+
+        except ConnectionError:
+            pass
+        finally:
+            self.clients -= 1
+            writer.close()
+
+    async def _handle(self, line):
+        '''
+        Returns: The response to a request line
+        '''
+
+        request_id = None
+        try:
+            try:
+                request = json.loads(line)
+                request_id = request.get('id')
+                method = self._methods.get(request['method'])
+                params = request.get('params') or {}
+            except (ValueError, TypeError, KeyError, AttributeError):
+                raise RequestError('bad-request', "Not a JSON request object")
+
+            if method is None:
+                raise RequestError('unknown-method', "No method %r" % request['method'])
+            if not isinstance(params, dict):
+                raise RequestError('bad-request', "params must be an object")
+
+            try:
+                inspect.signature(method).bind(**params)
+            except TypeError as ex:
+                raise RequestError('bad-params', str(ex))
+
+            if method in (self.optout, self.forecast):
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, lambda: method(**params))
+            else:
+                result = method(**params)
+
+            return dict(id=request_id, result=result)
+
+        except RequestError as ex:
+            return dict(id=request_id, error=dict(code=ex.code, message=str(ex)))
+
+        except Exception as ex:
+            logger.exception("Local API error: %s", ex)
+            return dict(id=request_id, error=dict(code='internal', message=str(ex)))
+
+
+def _number(name, value):
+    '''
+    Returns: A numeric request parameter as a float
+    Raises: RequestError if it isn't a finite, non-negative number
+    '''
+    if isinstance(value, bool) or not isinstance(value, (int, float)) \
+            or not math.isfinite(value) or value < 0:
+        raise RequestError('bad-params', "%s must be a non-negative number" % name)
+    return float(value)
+
+
+def _intervals(evt):
+    '''
+    Returns: A list of (index, start, end, level) of the event's intervals;
+             end is None for an open ended one
+    '''
+    return [
+        (signal.index, start, end, signal.level)
+        for start, end, signal in timeline.event_intervals(evt)
+    ]
+
+
+def _time(dttm):
+    return schedule.dttm_to_str(dttm) if dttm is not None else None
+
+
+def _encode(response):
+    return json.dumps(response, separators=(',', ':')).encode('utf-8') + b'\n'
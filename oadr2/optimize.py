@@ -0,0 +1,238 @@
+'''
+An optional load shifting stage for price signals: given the price over
+the coming hours and a device which needs some energy by a deadline (an
+EV charger, a water heater, an ice storage chiller...), work out when to
+run it so that the energy costs the least, and hand the power setpoint
+of each moment to a callback, see `EventController(optimizer=...)`.
+
+The schedule is solved by dynamic programming over a grid of time steps,
+vectorized with NumPy over the states of the device, which is only needed
+by this module (`pip install numpy`).
+'''
+# pylint: disable=W1202
+import math
+from datetime import datetime, timedelta
+
+import numpy
+
+from oadr2 import logger
+
+DEFAULT_STEP = timedelta(minutes=1)
+DEFAULT_HORIZON = timedelta(hours=24)  # deadline of a device without one
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class OptimizerError(Exception):
+    '''
+    Raised when the device cannot get its energy by the deadline.
+    '''
+
+
+class Device(object):
+    '''
+    A flexible load: it needs `energy` before `deadline`, and can run at
+    `max_power * k / power_steps` for k in 0..power_steps during each step.
+
+    Member Variables:
+    --------
+    energy -- Energy to deliver, in kWh
+    max_power -- Highest power, in kW
+    power_steps -- Number of power levels above off, 1 for an on/off load
+    deadline -- UTC datetime the energy is needed by, None for a day after
+                the first solve
+    start_cost -- Cost added each time the device is switched on, to avoid
+                  short cycling
+    '''
+
+    def __init__(self, energy, max_power, power_steps=1, deadline=None, start_cost=0.0):
+        if energy < 0 or max_power <= 0 or power_steps < 1:
+            raise ValueError("Need energy >= 0, max_power > 0 and power_steps >= 1")
+        self.energy = float(energy)
+        self.max_power = float(max_power)
+        self.power_steps = int(power_steps)
+        self.deadline = deadline
+        self.start_cost = float(start_cost)
+
+
+def solve(prices, device, step_hours):
+    '''
+    Find the cheapest way for `device` to get its energy over the steps
+    priced by `prices`.
+
+    Energy is counted in units of what the lowest power level delivers in
+    one step.  Going backwards from the last step, the cost to go of every
+    (units delivered, running) state is worked out for all of them at once
+    from that of the next step, together with the best power level in
+    each; the schedule is then read forwards from (0, off).
+
+    prices -- Price of energy in each step, per kWh
+    device -- The Device
+    step_hours -- Length of a step, in hours
+
+    Returns: A 2-tuple of (numpy array of the power in each step, cost)
+    '''
+
+    prices = numpy.asarray(prices, dtype=float)
+    steps = len(prices)
+    unit = device.max_power * step_hours / device.power_steps
+    need = int(math.ceil(device.energy / unit - 1e-9))
+    if need == 0:
+        return numpy.zeros(steps), 0.0
+
+    levels = numpy.arange(device.power_steps + 1)
+    reached = numpy.minimum(numpy.arange(need + 1)[None, :] + levels[:, None], need)
+    running = (levels > 0).astype(int)[:, None]
+    energy_cost = levels[:, None] * unit
+    start_cost = device.start_cost * running
+
+    value = numpy.full((2, need + 1), numpy.inf)  # [running, units] -> cost to go
+    value[:, need] = 0
+    choices = numpy.empty((steps, 2, need + 1), dtype=numpy.int32)
+    for step in range(steps - 1, -1, -1):
+        total = value[running, reached] + prices[step] * energy_cost
+        total[1:, need] = numpy.inf  # done, nothing more to run for
+        starting = total + start_cost
+        choices[step, 0] = starting.argmin(axis=0)
+        choices[step, 1] = total.argmin(axis=0)
+        value = numpy.stack((starting.min(axis=0), total.min(axis=0)))
+
+    if not numpy.isfinite(value[0, 0]):
+        raise OptimizerError(
+            "%.3f kWh can't be delivered at %.3f kW in %d steps" % (device.energy, device.max_power, steps))
+
+    chosen = numpy.zeros(steps, dtype=int)
+    units, on = 0, 0
+    for step in range(steps):
+        level = choices[step, on, units]
+        chosen[step] = level
+        units = min(units + level, need)
+        on = int(level > 0)
+    return chosen * (device.max_power / device.power_steps), float(value[0, 0])
+
+
+def step_prices(forecast, start, steps, step, default_price=0.0):
+    '''
+    Returns: A numpy array of the price in each step from `start`, looked
+             up at the end of the step in a timeline.Timeline of prices, and
+             `default_price` where no event sets one
+    '''
+
+    arrays = forecast.as_arrays()
+    times = numpy.asarray(arrays['times'])
+    levels = numpy.asarray(arrays['levels'], dtype=float)
+    unpriced = numpy.array([event_id is None for event_id in arrays['event_ids']])
+
+    ends = (start - EPOCH).total_seconds() + step.total_seconds() * numpy.arange(1, steps + 1)
+    index = numpy.clip(numpy.searchsorted(times, ends, side='left') - 1, 0, len(levels) - 1)
+    return numpy.where(unpriced[index], default_price, levels[index])
+
+
+class Plan(object):
+    '''
+    A solved schedule.
+
+    Member Variables:
+    --------
+    start -- UTC datetime of the first step
+    step -- timedelta of each step
+    powers -- numpy array of the power setpoint in each step
+    cost -- Its total cost
+    '''
+
+    def __init__(self, start, step, powers, cost):
+        self.start = start
+        self.step = step
+        self.powers = powers
+        self.cost = cost
+
+    def setpoint_at(self, when):
+        '''
+        Returns: The power setpoint at `when`, 0 outside the plan
+        '''
+        index = int((when - self.start) / self.step)
+        if 0 <= index < len(self.powers):
+            return float(self.powers[index])
+        return 0.0
+
+    def delivered(self, when):
+        '''
+        Returns: The energy delivered from the start up to `when`, in kWh
+        '''
+        elapsed = min(max((when - self.start) / self.step, 0), len(self.powers))
+        whole = int(elapsed)
+        energy = self.powers[:whole].sum()
+        if whole < len(self.powers):
+            energy += self.powers[whole] * (elapsed - whole)
+        return float(energy) * self.step.total_seconds() / 3600
+
+
+class LoadShifter(object):
+    '''
+    The optimizer stage of an EventController: the device's plan is solved
+    from the forecast of the price signals of the active events, and solved
+    again whenever the events change, for the energy it still needs.
+
+    Member Variables:
+    --------
+    device -- The Device
+    step -- timedelta of the plan's steps
+    default_price -- Price when no event sets one
+    signal_type -- Type of the signals giving the price
+    plan -- The current Plan, None before the first solve
+    delivered -- Energy delivered by earlier plans
+    '''
+
+    def __init__(self, device, step=DEFAULT_STEP, default_price=0.0, signal_type='price'):
+        '''
+        device -- The Device to schedule
+        step -- Time resolution of the plan
+        default_price -- Price outside of events, e.g. the regular tariff
+        signal_type -- Type of the signals giving the price, None to take
+                       the level of the simple signals as the price
+        '''
+
+        self.device = device
+        self.step = step
+        self.default_price = default_price
+        self.signal_type = signal_type
+        self.plan = None
+        self.delivered = 0.0
+        self._generation = None
+        self._deadline = device.deadline
+
+    def setpoint(self, event_controller, now):
+        '''
+        Returns: The power setpoint at `now`, solving again if the events
+                 of `event_controller` changed since the last solve
+        '''
+
+        generation = event_controller.event_handler.generation
+        if self.plan is None or generation != self._generation:
+            self._solve(event_controller, now)
+            self._generation = generation
+        return self.plan.setpoint_at(now)
+
+    def _solve(self, event_controller, now):
+        if self.plan is not None:
+            self.delivered += self.plan.delivered(now)
+        if self._deadline is None:
+            self._deadline = now + DEFAULT_HORIZON
+
+        steps = max(int((self._deadline - now) / self.step), 0)
+        device = Device(
+            max(self.device.energy - self.delivered, 0), self.device.max_power,
+            self.device.power_steps, self._deadline, self.device.start_cost)
+        prices = step_prices(
+            event_controller.forecast(steps * self.step / timedelta(hours=1), signal_type=self.signal_type),
+            now, steps, self.step, self.default_price)
+
+        try:
+            powers, cost = solve(prices, device, self.step / timedelta(hours=1))
+        except OptimizerError as ex:
+            logger.warning("%s, running flat out", ex)
+            powers = numpy.full(steps, device.max_power)
+            cost = float((prices * powers).sum() * self.step / timedelta(hours=1))
+
+        self.plan = Plan(now, self.step, powers, cost)
+        logger.debug("Planned %.3f kWh over %d steps for %.3f", device.energy, steps, cost)
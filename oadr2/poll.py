@@ -1,4 +1,7 @@
 # pylint: disable=W1202, I1101
+import copy
+import hashlib
+import logging
 import threading
 import urllib.error
 import urllib.parse
@@ -9,14 +12,25 @@ import requests
 from lxml import etree
 
 from oadr2 import base, logger
+from oadr2.schemas import PYLD_XMLNS_A
 
 # HTTP parameters:
 REQUEST_TIMEOUT = 5  # HTTP request timeout
+MAX_RESPONSE_SIZE = 4 * 1024 * 1024  # largest oadrDistributeEvent we accept, in bytes
+RESPONSE_CHUNK_SIZE = 16 * 1024  # response bytes fed to the parser at a time
+LOGGED_RESPONSE_SIZE = 1024  # bytes of an unparsable response to log
 DEFAULT_VTN_POLL_INTERVAL = 300  # poll the VTN every X seconds
 MINIMUM_POLL_INTERVAL = 10
 POLLING_JITTER = 0.1  # polling interval +/-
 OADR2_URI_PATH = 'OpenADR2/Simple/'  # URI of where the VEN needs to request from
 
+# Long-poll parameters:
+LONG_POLL_MIN_HOLD = 2  # a response faster than X seconds means the VTN did not hold the request
+LONG_POLL_RETRY_DELAY = 1  # wait X seconds before re-polling after a fast, changed response
+                           # and before the first retry of a failed poll, doubling after that
+
+REQUEST_ID_TAG = '{%s}requestID' % PYLD_XMLNS_A  # same namespace in 2.0a and 2.0b
+
 
 class OpenADR2(base.BaseHandler):
     '''
@@ -31,6 +45,9 @@ class OpenADR2(base.BaseHandler):
     ven_client_cert_key
     ven_client_cert_pem
     vtn_ca_certs
+    long_poll_timeout
+    max_response_size
+    http -- The `requests` module, or a shared `requests.Session`
     poll_thread
     '''
 
@@ -42,6 +59,9 @@ class OpenADR2(base.BaseHandler):
                  ven_client_cert_pem=None,
                  vtn_ca_certs=False,
                  vtn_poll_interval=DEFAULT_VTN_POLL_INTERVAL,
+                 long_poll_timeout=None,
+                 max_response_size=MAX_RESPONSE_SIZE,
+                 session=None,
                  start_thread=True):
         '''
         Sets up the class and intializes the HTTP client.
@@ -53,6 +73,14 @@ class OpenADR2(base.BaseHandler):
         vtn_base_uri -- Base URI of the VTN's location
         vtn_poll_interval -- How often we should poll the VTN
         vtn_ca_certs -- CA Certs for the VTN
+        long_poll_timeout -- If set, ask the VTN to hold each poll request open
+                             for up to this many seconds until an event is ready
+                             (`Prefer: wait=N`, RFC 7240).  Falls back to interval
+                             polling whenever the VTN answers immediately.
+        max_response_size -- Responses larger than this (bytes) are dropped
+                             without being read completely
+        session -- A `requests.Session` to send requests with, e.g. one
+                   shared by many VENs to reuse connections to the VTN
         start_thread -- start the thread for the poll loop or not? left as a legacy option
         '''
 
@@ -78,6 +106,25 @@ class OpenADR2(base.BaseHandler):
         self.__username = username
         self.__password = password
 
+        self.long_poll_timeout = int(long_poll_timeout) if long_poll_timeout else None
+        self.http = session if session is not None else requests
+
+        # Responses are fed to this parser as they are read; it is only used
+        # from the poll thread and reset after every response
+        self.max_response_size = int(max_response_size)
+        self._parser = etree.XMLParser(resolve_entities=False, no_network=True, huge_tree=False)
+
+        # Fingerprint of the last successfully processed distribute and the
+        # reply it produced, see `query_vtn()`
+        self._last_fingerprint = None
+        self._last_reply = None
+
+        # Outcome of the polls, see `_poll_delay()`: consecutive polls without
+        # a valid 2xx response, and whether the VTN confirmed it applied our
+        # `Prefer: wait` to the last one
+        self._poll_failures = 0
+        self._poll_confirmed = False
+
         self.poll_thread = None
         if start_thread:  # this is left for backward compatibility
             self.start()
@@ -132,8 +179,10 @@ class OpenADR2(base.BaseHandler):
         '''
 
         while not self._exit.is_set():
+            started = self.clock.monotonic()
+            updated = False
             try:
-                self.query_vtn()
+                updated = self.query_vtn()
 
             except urllib.error.HTTPError as ex:  # 4xx or 5xx HTTP response:
                 logger.warning("HTTP error: %s\n%s", ex, ex.read())
@@ -144,63 +193,204 @@ class OpenADR2(base.BaseHandler):
             except Exception as ex:
                 logger.exception("Error in OADR2 poll thread: %s", ex)
 
-            self._exit.wait(
-                uniform(
-                    self.vtn_poll_interval*(1-POLLING_JITTER),
-                    self.vtn_poll_interval*(1+POLLING_JITTER)
-                )
-            )
+            self._exit.wait(self._poll_delay(self.clock.monotonic() - started, updated))
         logger.info("+++++++++++++++ OADR2 polling thread has exited.")
 
+    def _poll_delay(self, elapsed, updated):
+        '''
+        How long to wait before the next poll.
+
+        In long-poll mode a request that the VTN held open is re-issued right
+        away, so events are delivered as soon as the VTN has them.  The VTN
+        held it if it answered with a valid 2xx response and either said so
+        (`Preference-Applied: wait=N`), or took a while to send something new
+        or about the whole wait to send nothing new.  Otherwise it does not
+        support long-polling (at least right now), or is just slow, and we
+        fall back to the regular poll interval.  Failed polls are retried
+        after an exponential backoff, up to the poll interval.
+
+        elapsed -- Seconds the last poll took
+        updated -- Whether the last poll returned a changed payload
+
+        Returns: The delay in seconds
+        '''
+
+        if self.long_poll_timeout:
+            if self._poll_failures:
+                backoff = min(LONG_POLL_RETRY_DELAY * 2 ** (self._poll_failures - 1), self.vtn_poll_interval)
+                return uniform(backoff*(1-POLLING_JITTER), backoff*(1+POLLING_JITTER))
+
+            if self._poll_confirmed or elapsed >= LONG_POLL_MIN_HOLD and \
+                    (updated or elapsed >= self.long_poll_timeout - LONG_POLL_MIN_HOLD):
+                return 0
+
+            if updated:
+                return LONG_POLL_RETRY_DELAY
+
+            logger.debug("VTN did not hold the long-poll request, falling back to interval polling")
+
+        return uniform(
+            self.vtn_poll_interval*(1-POLLING_JITTER),
+            self.vtn_poll_interval*(1+POLLING_JITTER)
+        )
+
     def query_vtn(self):
         '''
         Query the VTN for an event.
+
+        Most polls return the same oadrDistributeEvent over and over, with
+        only the requestID changing.  When the payload fingerprint (see
+        `payload_fingerprint()`) matches the last processed one, event
+        processing is skipped and the previous reply is re-sent with the new
+        requestID.
+
+        Returns: True if a new or changed payload was processed
         '''
 
         if not self.vtn_base_uri:
             logger.warning("VTN base URI is invalid: %s", self.vtn_base_uri)
-            return
+            return False
 
         event_uri = self.vtn_base_uri + 'EiEvent'
         payload = self.event_handler.build_request_payload()
+        self._poll_failures += 1  # until a valid response was read
+        self._poll_confirmed = False
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'New polling request to {event_uri}:\n'
+                          f'{etree.tostring(payload, pretty_print=True).decode("utf-8")}')
 
-        logger.debug(f'New polling request to {event_uri}:\n'
-                      f'{etree.tostring(payload, pretty_print=True).decode("utf-8")}')
+        request_opts = {}
+        if self.long_poll_timeout:
+            request_opts = dict(
+                headers={'Prefer': f'wait={self.long_poll_timeout}'},
+                timeout=(REQUEST_TIMEOUT, self.long_poll_timeout + REQUEST_TIMEOUT)
+            )
 
         try:
-            resp = requests.post(
+            resp = self.http.post(
                 event_uri,
                 cert=self.ven_certs,
                 verify=self.vtn_ca_certs,
                 data=etree.tostring(payload),
-                auth=(self.__username, self.__password) if self.__username or self.__password else None
+                auth=(self.__username, self.__password) if self.__username or self.__password else None,
+                stream=True,
+                **request_opts
             )
+        except requests.exceptions.ReadTimeout:
+            logger.debug("Long-poll request timed out without a response")
+            return False
         except Exception as ex:
             logger.warning(f"Connection failed: {ex}")
-            return
+            return False
+
+        if not resp.ok:
+            logger.warning("VTN answered the poll with HTTP %s", resp.status_code)
+            resp.close()
+            return False
+        self._poll_confirmed = 'wait' in resp.headers.get('Preference-Applied', '')
 
         reply = None
+        updated = False
+        content_head = bytearray()
         try:
-            payload = etree.fromstring(resp.content)
-            logger.debug(f'Got Payload:\n'
-                          f'{etree.tostring(payload, pretty_print=True).decode("utf-8")}')
-            reply = self.event_handler.handle_payload(payload)
+            payload = self._read_payload(resp, content_head)
+            self._poll_failures = 0
+            fingerprint = (payload_fingerprint(payload), frozenset(self.event_handler.optouts))
+
+            if fingerprint == self._last_fingerprint:
+                logger.debug("Payload unchanged since the last poll, skipping event processing")
+                reply = self._synthesize_reply(payload)
+
+            else:
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f'Got Payload:\n'
+                                  f'{etree.tostring(payload, pretty_print=True).decode("utf-8")}')
+                self._last_fingerprint = None
+                reply = self.event_handler.handle_payload(payload)
+                self._last_fingerprint = fingerprint
+                self._last_reply = reply
+                updated = True
 
         except Exception as ex:
-            logger.warning(f"error parsing payload: {ex}\n"
-                            f"Response content: {resp.content}")
+            logger.warning("error parsing payload: %s\nResponse content (first %d bytes): %s",
+                           ex, LOGGED_RESPONSE_SIZE, bytes(content_head))
+        finally:
+            resp.close()
 
         # If we have a generated reply:
         if reply is not None:
-            logger.debug(f'Reply to {event_uri}:\n'
-                          f'{etree.tostring(reply, pretty_print=True).decode("utf-8")}')
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Reply to {event_uri}:\n'
+                              f'{etree.tostring(reply, pretty_print=True).decode("utf-8")}')
 
-            # tell the control loop that events may have updated
-            # (note `self.event_controller` is defined in base.BaseHandler)
-            self.event_controller.events_updated()
+            if updated:
+                # tell the control loop that events may have updated
+                # (note `self.event_controller` is defined in base.BaseHandler)
+                self.event_controller.events_updated()
 
             self.send_reply(reply, event_uri)  # And send the response
 
+        return updated
+
+    def _read_payload(self, resp, content_head):
+        '''
+        Parse a streamed response body incrementally, without ever holding
+        more than one chunk of it in memory.
+
+        resp -- A `requests.Response` opened with `stream=True`
+        content_head -- A bytearray which receives the first
+                        LOGGED_RESPONSE_SIZE bytes of the body, for logging
+
+        Returns: The root lxml.etree.Element of the response
+        Raises: ValueError if the body exceeds `max_response_size`,
+                lxml.etree.XMLSyntaxError if it is not well-formed
+        '''
+
+        length = resp.headers.get('Content-Length')
+        if length and int(length) > self.max_response_size:
+            raise ValueError(f"Response of {length} bytes exceeds {self.max_response_size} bytes")
+
+        received = 0
+        try:
+            for chunk in resp.iter_content(RESPONSE_CHUNK_SIZE):
+                received += len(chunk)
+                if received > self.max_response_size:
+                    raise ValueError(f"Response exceeds {self.max_response_size} bytes")
+                if len(content_head) < LOGGED_RESPONSE_SIZE:
+                    content_head += chunk[:LOGGED_RESPONSE_SIZE - len(content_head)]
+                self._parser.feed(chunk)
+
+            return self._parser.close()
+
+        except Exception:
+            try:
+                self._parser.close()  # reset the parser for the next response
+            except etree.XMLSyntaxError:
+                pass
+            raise
+
+    def _synthesize_reply(self, payload):
+        '''
+        Build the reply to an unchanged distribute from the last processed one.
+
+        payload -- The lxml.etree.Element of the new oadrDistributeEvent
+
+        Returns: A copy of the last reply carrying the new requestID, or None
+                 if the last payload did not need a reply.
+        '''
+
+        if self._last_reply is None:
+            return None
+
+        request_id = payload.findtext(REQUEST_ID_TAG)
+        reply = copy.deepcopy(self._last_reply)
+        for elem in reply.iter(REQUEST_ID_TAG):
+            if elem.text:
+                elem.text = request_id
+
+        return reply
+
     def send_reply(self, payload, uri):
         '''
         Send a reply back to the VTN.
@@ -210,7 +400,7 @@ class OpenADR2(base.BaseHandler):
         uri -- The URI (of the VTN) where the response should be sent
         '''
 
-        resp = requests.post(
+        resp = self.http.post(
             uri,
             cert=self.ven_certs,
             verify=self.vtn_ca_certs,
@@ -220,3 +410,24 @@ class OpenADR2(base.BaseHandler):
         )
 
         logger.debug("EiEvent response: %s", resp.status_code)
+
+
+def payload_fingerprint(payload):
+    '''
+    Hash the canonical (C14N) form of a payload, ignoring the values of all
+    pyld:requestID elements.  Two oadrDistributeEvent payloads which only
+    differ in their request IDs produce the same fingerprint.
+
+    payload -- An lxml.etree.Element object
+
+    Returns: A hex digest string
+    '''
+
+    request_ids = [(elem, elem.text) for elem in payload.iter(REQUEST_ID_TAG)]
+    try:
+        for elem, _ in request_ids:
+            elem.text = None
+        return hashlib.sha256(etree.tostring(payload, method='c14n')).hexdigest()
+    finally:
+        for elem, text in request_ids:
+            elem.text = text
@@ -0,0 +1,310 @@
+# Classes for receiving OpenADR 2.0 events pushed by the VTN over HTTP
+# pylint: disable=W1202, I1101
+import logging
+import ssl
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from lxml import etree
+
+from oadr2 import base, logger
+from oadr2.poll import OADR2_URI_PATH, REQUEST_TIMEOUT
+
+# HTTP parameters:
+DEFAULT_LISTEN_PORT = 8443
+MAX_REQUEST_SIZE = 1024 * 1024  # largest oadrDistributeEvent body we accept, in bytes
+MAX_CONCURRENT_REQUESTS = 4  # requests handled at once, others get a 503
+MAX_CONNECTIONS = 32  # connections open at once, others are closed as they are accepted
+RETRY_AFTER = 5  # seconds, sent along with a 503
+READ_CHUNK_SIZE = 64 * 1024  # bytes of a request body read at once
+
+DISTRIBUTE_EVENT_TAG = 'oadrDistributeEvent'
+
+
+class OpenADR2(base.BaseHandler):
+    '''
+    push.OpenADR2 is the HTTP push equivalent of poll.OpenADR2.  It runs a
+    small HTTP(S) server that accepts oadrDistributeEvent POSTs from the VTN,
+    feeds them to `EventHandler.handle_payload()` and answers synchronously
+    with the oadrCreatedEvent.
+
+    Member Variables:
+    --------
+    (Everything from base.BaseHandler)
+    listen_addr
+    listen_port
+    max_request_size
+    max_concurrent_requests
+    max_connections
+    server -- The ThreadingHTTPServer, created by `start()`
+    server_thread
+    '''
+
+    def __init__(self, event_config,
+                 control_opts={},
+                 listen_addr='0.0.0.0',
+                 listen_port=DEFAULT_LISTEN_PORT,
+                 server_cert_pem=None,
+                 server_cert_key=None,
+                 ven_ca_certs=None,
+                 max_request_size=MAX_REQUEST_SIZE,
+                 max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
+                 max_connections=MAX_CONNECTIONS,
+                 start_thread=True):
+        '''
+        Sets up the class and starts the HTTP server.
+
+        event_config -- A dictionary containing key-word arugments for the
+                        EventHandller
+        listen_addr -- Address to bind the server to
+        listen_port -- Port to listen on; 0 picks a free one
+        server_cert_pem -- PEM certificate for HTTPS; plain HTTP if not set
+        server_cert_key -- Private key for `server_cert_pem`
+        ven_ca_certs -- CA certs used to require and verify VTN client certs
+        max_request_size -- Bodies larger than this (bytes) get a 413
+        max_concurrent_requests -- Requests over this limit get a 503
+        max_connections -- Connections over this limit are closed unanswered,
+                           each one open holds a request thread
+        start_thread -- Start serving right away
+        '''
+
+        super(OpenADR2, self).__init__(event_config, control_opts)
+
+        self.listen_addr = listen_addr
+        self.listen_port = int(listen_port)
+        self.max_request_size = int(max_request_size)
+        self.max_concurrent_requests = int(max_concurrent_requests)
+        self.max_connections = int(max_connections)
+
+        self.ssl_context = None
+        if server_cert_pem and server_cert_key:
+            self.ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            self.ssl_context.load_cert_chain(server_cert_pem, server_cert_key)
+            if ven_ca_certs:
+                self.ssl_context.verify_mode = ssl.CERT_REQUIRED
+                self.ssl_context.load_verify_locations(ven_ca_certs)
+
+        # Parsing is done on the server's request threads, one parser each
+        self._parsers = threading.local()
+
+        self.server = None
+        self.server_thread = None
+        if start_thread:
+            self.start()
+
+        logger.info("+++++++++++++++ OADR2 push module started ++++++++++++++")
+
+    def start(self):
+        '''
+        Bind the HTTP server and start serving on a thread.
+        '''
+
+        if self.server_thread and self.server_thread.is_alive():
+            logger.warning("Thread is already running")
+            return
+
+        # TLS handshakes run on the request threads, see _PushServer
+        self.server = _PushServer((self.listen_addr, self.listen_port), self)
+        self.listen_port = self.server.server_address[1]
+
+        self.server_thread = threading.Thread(
+            name='oadr2.push',
+            target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self._exit.clear()
+
+        self.server_thread.start()
+        logger.info("Push server listening on %s:%d", self.listen_addr, self.listen_port)
+
+    def stop(self):
+        '''
+        Stops the HTTP server without stopping event controller
+        '''
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+        if self.server_thread is not None:
+            self.server_thread.join(2)
+
+        logger.info("Push server stopped")
+
+    def exit(self):
+        '''
+        Shutdown the HTTP server, join the running threads and exit.
+        '''
+
+        self.stop()
+        super(OpenADR2, self).exit()
+
+    def handle_distribute(self, body):
+        '''
+        Process a pushed oadrDistributeEvent body.
+
+        body -- The raw request body (bytes)
+
+        Returns: A 2-tuple of (HTTP status, response body bytes)
+        '''
+
+        try:
+            payload = etree.fromstring(body, parser=self._parser())
+        except etree.XMLSyntaxError as ex:
+            logger.warning("Invalid push payload: %s", ex)
+            return 400, b''
+
+        if etree.QName(payload).localname != DISTRIBUTE_EVENT_TAG:
+            logger.warning("Unexpected push payload: %s", payload.tag)
+            return 400, b''
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Got pushed payload:\n'
+                          f'{etree.tostring(payload, pretty_print=True).decode("utf-8")}')
+
+        reply = self.event_handler.handle_payload(payload)
+
+        # tell the control loop that events may have updated
+        # (note `self.event_controller` is defined in base.BaseHandler)
+        self.event_controller.events_updated()
+
+        return 200, etree.tostring(reply) if reply is not None else b''
+
+    def _parser(self):
+        parser = getattr(self._parsers, 'parser', None)
+        if parser is None:
+            parser = self._parsers.parser = etree.XMLParser(
+                resolve_entities=False, no_network=True, huge_tree=False)
+        return parser
+
+
+class _PushServer(ThreadingHTTPServer):
+    '''
+    ThreadingHTTPServer which knows its push.OpenADR2 and caps how many
+    connections are open, and how many requests processed, at once.  The
+    connection cap is taken as they are accepted, before a thread is
+    started for them.  With TLS, each accepted connection is
+    wrapped on its own request thread, under the request timeout, so a
+    client stalling its handshake doesn't hold up the others.
+    '''
+
+    daemon_threads = True
+
+    def __init__(self, server_address, handler):
+        self.handler = handler
+        self.slots = threading.BoundedSemaphore(handler.max_concurrent_requests)
+        self.connections = threading.BoundedSemaphore(handler.max_connections)
+        super(_PushServer, self).__init__(server_address, _PushRequestHandler)
+
+    def process_request(self, request, client_address):
+        if not self.connections.acquire(blocking=False):
+            logger.warning("Too many push connections, refused %s", client_address[0])
+            self.shutdown_request(request)
+            return
+        try:
+            super(_PushServer, self).process_request(request, client_address)
+        except Exception:
+            self.connections.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super(_PushServer, self).process_request_thread(request, client_address)
+        finally:
+            self.connections.release()
+
+    def finish_request(self, request, client_address):
+        ssl_context = self.handler.ssl_context
+        if ssl_context is None:
+            super(_PushServer, self).finish_request(request, client_address)
+            return
+
+        request.settimeout(REQUEST_TIMEOUT)
+        try:
+            request = ssl_context.wrap_socket(request, server_side=True)
+        except (ssl.SSLError, OSError) as ex:
+            logger.warning("TLS handshake with %s failed: %s", client_address[0], ex)
+            return
+        try:
+            super(_PushServer, self).finish_request(request, client_address)
+        finally:
+            request.close()
+
+
+class _PushRequestHandler(BaseHTTPRequestHandler):
+    '''
+    Handles `POST <OADR2_URI_PATH>EiEvent` for a _PushServer
+    '''
+
+    timeout = REQUEST_TIMEOUT  # socket timeout, so slow clients can't pin a slot
+
+    def do_POST(self):
+        handler = self.server.handler
+
+        if self.path.rstrip('/') != '/' + OADR2_URI_PATH + 'EiEvent':
+            self._respond(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length'))
+        except (TypeError, ValueError):
+            self._respond(411)
+            return
+
+        if length < 0:
+            self._respond(400)
+            return
+
+        if length > handler.max_request_size:
+            logger.warning("Rejected %d byte push payload from %s", length, self.client_address[0])
+            self._respond(413)
+            return
+
+        if not self.server.slots.acquire(blocking=False):
+            logger.warning("Too many concurrent push requests, rejected %s", self.client_address[0])
+            self._respond(503, headers={'Retry-After': str(RETRY_AFTER)})
+            return
+
+        try:
+            body = self._read_body(length, handler.max_request_size)
+            if body is None:
+                logger.warning("Truncated push payload from %s", self.client_address[0])
+                status, body = 400, b''
+            else:
+                status, body = handler.handle_distribute(body)
+        except Exception as ex:
+            logger.exception("Error handling push payload: %s", ex)
+            status, body = 500, b''
+        finally:
+            self.server.slots.release()
+
+        self._respond(status, body)
+
+    def _read_body(self, length, limit):
+        '''
+        Read the `length` byte body in chunks, never more than `limit` + 1
+        bytes however long the client claims it is.
+
+        Returns: The body, None if the client sent less
+        '''
+        chunks = []
+        remaining = min(length, limit + 1)
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, READ_CHUNK_SIZE))
+            if not chunk:
+                return None
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return b''.join(chunks)
+
+    def _respond(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Push server: " + format, *args)
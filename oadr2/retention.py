@@ -0,0 +1,193 @@
+'''
+Clears finished events out of the database away from the control loop.
+With a Retention, the control pass of an EventController only notes which
+events ended; a background thread removes them in batches, keeping a
+compact row of each in the history table if the Policy says so, drops
+history past its age and gives the freed pages back with SQLite's
+incremental vacuum.  The database of a long running gateway, and the
+cost of its control passes, stay flat.
+'''
+# pylint: disable=W1202
+import threading
+import time
+import weakref
+from datetime import timedelta
+
+from oadr2 import logger
+
+RETENTION_INTERVAL = 300  # seconds between maintenance passes
+VACUUM_PAGES = 1000  # free pages given back by each maintenance pass
+INCREMENTAL = 2  # PRAGMA auto_vacuum
+
+
+class Policy(object):
+    '''
+    What happens to finished events.
+
+    Member Variables:
+    --------
+    keep_history -- Keep a row of each in the history table, or drop them
+    history_age -- timedelta the history is kept for, None for ever
+    vacuum_pages -- Free pages given back by each maintenance pass, 0 for
+                    none
+    '''
+
+    def __init__(self, keep_history=True, history_age=timedelta(days=30), vacuum_pages=VACUUM_PAGES):
+        self.keep_history = keep_history
+        self.history_age = history_age
+        self.vacuum_pages = vacuum_pages
+
+
+def vacuum(engine, pages=VACUUM_PAGES):
+    '''
+    Give up to `pages` free pages of an SQLite database back to the file
+    system.  New databases use incremental vacuum (see eventdb.DBHandler);
+    an older one is switched over by a full VACUUM the first time.
+
+    Returns: The number of pages given back
+    '''
+
+    if engine.url.database in (None, '', ':memory:'):
+        return 0
+    with engine.connect() as connection:
+        if connection.execute("PRAGMA auto_vacuum").scalar() != INCREMENTAL:
+            logger.info("Turning on incremental vacuum of %s", engine.url.database)
+            connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            connection.execute("VACUUM")
+            return 0
+
+        free = connection.execute("PRAGMA freelist_count").scalar()
+        if free:
+            # Each step of the pragma frees one page, run it to the end
+            connection.connection.executescript("PRAGMA incremental_vacuum(%d);" % pages)
+        return min(free, pages)
+
+
+class Retention(object):
+    '''
+    Removes the finished events of any number of event.EventHandlers, e.g.
+    all those of a host.VENHost, on one thread.  Pass it to their
+    controllers as `EventController(retention=...)`.
+
+    Member Variables:
+    --------
+    policy -- The Policy
+    interval -- Seconds between maintenance passes
+    removed -- Number of events removed so far
+    thread -- threading.Thread() object w/ name of 'oadr2.retention'
+    '''
+
+    def __init__(self, policy=None, interval=RETENTION_INTERVAL, start_thread=True):
+        '''
+        policy -- A Policy, the default one if None
+        interval -- How often to prune the history and vacuum
+        start_thread -- Start the thread, else call `maintain()` yourself
+        '''
+
+        self.policy = policy if policy is not None else Policy()
+        self.interval = interval
+        self.removed = 0
+
+        self._handlers = weakref.WeakSet()
+        self._pending = {}  # event handler -> {ID: modification number} of its events which ended
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._exit = threading.Event()
+
+        self.thread = None
+        if start_thread:
+            self.thread = threading.Thread(name='oadr2.retention', target=self._loop)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def register(self, event_handler):
+        '''
+        Prune the history of `event_handler` and vacuum its database too.
+        '''
+        with self._lock:
+            self._handlers.add(event_handler)
+
+    def expired(self, event_handler, events):
+        '''
+        Note that events of `event_handler` ended, to be removed soon unless
+        they change in the meantime.  Called on the control pass, so it
+        doesn't touch the database.
+
+        events -- (event ID, modification number) of each
+        '''
+        with self._lock:
+            self._handlers.add(event_handler)
+            self._pending.setdefault(event_handler, {}).update(events)
+        self._wake.set()
+
+    def collect(self):
+        '''
+        Remove the events noted so far, those the VTN modified or sent
+        again since and which haven't ended are kept.
+
+        Returns: The number of events removed
+        '''
+
+        with self._lock:
+            pending, self._pending = self._pending, {}
+
+        removed = 0
+        for event_handler, expired in pending.items():
+            try:
+                removed += len(event_handler.remove_expired(expired, archive=self.policy.keep_history))
+            except Exception as ex:
+                logger.exception("Error removing events %s: %s", sorted(expired), ex)
+        self.removed += removed
+        return removed
+
+    def maintain(self):
+        '''
+        Remove the events noted so far, drop the history past its age and
+        vacuum every database.
+        '''
+
+        self.collect()
+        with self._lock:
+            handlers = list(self._handlers)
+
+        engines = {}
+        for event_handler in handlers:
+            engines[id(event_handler.db.session.bind)] = event_handler.db.session.bind
+            if self.policy.history_age is not None:
+                try:
+                    dropped = event_handler.prune_history(event_handler.clock.now() - self.policy.history_age)
+                    if dropped:
+                        logger.debug("Dropped %d history entries of %s", dropped, event_handler.ven_id)
+                except Exception as ex:
+                    logger.exception("Error pruning the history: %s", ex)
+
+        if self.policy.vacuum_pages:
+            for engine in engines.values():
+                try:
+                    vacuum(engine, self.policy.vacuum_pages)
+                except Exception as ex:
+                    logger.exception("Error vacuuming %s: %s", engine.url, ex)
+
+    def _loop(self):
+        next_maintenance = time.monotonic() + self.interval
+        while not self._exit.is_set():
+            self._wake.wait(max(next_maintenance - time.monotonic(), 0))
+            self._wake.clear()
+            if self._exit.is_set():
+                break
+            if time.monotonic() >= next_maintenance:
+                self.maintain()
+                next_maintenance = time.monotonic() + self.interval
+            else:  # woken up by `expired()`
+                self.collect()
+        logger.info("Retention thread exiting.")
+
+    def exit(self):
+        '''
+        Stop the thread, removing the events noted so far.
+        '''
+        self._exit.set()
+        self._wake.set()
+        if self.thread is not None:
+            self.thread.join(2)
+        self.collect()
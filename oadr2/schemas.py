@@ -4,7 +4,7 @@ from typing import List, Optional, Union
 from lxml import etree
 from pydantic import BaseModel
 
-from oadr2 import schedule
+from oadr2 import logger, schedule
 
 # Stuff for the 2.0a spec of OpenADR
 OADR_XMLNS_A = 'http://openadr.org/oadr-2.0a/2012/07'
@@ -61,6 +61,20 @@ OADR_PROFILE_20A = '2.0a'
 OADR_PROFILE_20B = '2.0b'
 
 
+def simple_signal_index(signals) -> Optional[int]:
+    '''
+    signals -- (name, type) of each signal of an event
+
+    Returns: The index of the signal whose intervals control the event, the
+             last 'simple' one of a valid type (an A profile rule), or None
+    '''
+    simple = None
+    for index, (name, signal_type) in enumerate(signals):
+        if name == 'simple' and signal_type in VALID_SIGNAL_TYPES:
+            simple = index
+    return simple
+
+
 class SignalSchema(BaseModel):
     index: int
     duration: str
@@ -70,13 +84,28 @@ class SignalSchema(BaseModel):
         orm_mode = True
 
 
+class EventSignalSchema(BaseModel):
+    '''
+    One ei:eiEventSignal of an event, of any name and type.
+    '''
+    name: Optional[str]
+    type: Optional[str]
+    id: Optional[str]
+    current_value: Optional[float]
+    intervals: List[SignalSchema]
+
+    class Config:
+        orm_mode = True
+
+
 class EventSchema(BaseModel):
     id: Union[str, None]
     start: datetime
     original_start: datetime
     end: Union[datetime, None]
     cancellation_offset: Union[str, None]
-    signals: List[SignalSchema]
+    signals: List[SignalSchema]  # intervals of the simple signal
+    event_signals: List[EventSignalSchema] = []  # every signal, the simple one included
     group_ids: Optional[List[str]]
     resource_ids: Optional[List[str]]
     party_ids: Optional[List[str]]
@@ -90,7 +119,16 @@ class EventSchema(BaseModel):
     class Config:
         orm_mode = True
 
-    def get_current_interval(self, now=datetime.utcnow()) -> Union[SignalSchema, None]:
+    def get_signals_of_type(self, signal_type) -> List[EventSignalSchema]:
+        return [signal for signal in self.event_signals if signal.type == signal_type]
+
+    def get_current_interval(self, now=None, signal=None) -> Union[SignalSchema, None]:
+        '''
+        now -- UTC datetime to look at, the current time if None
+        signal -- An EventSignalSchema of ours, the simple signal if None
+        '''
+        if now is None:
+            now = datetime.utcnow()
         if self.start > now:  # event not started yet
             return None
 
@@ -98,7 +136,7 @@ class EventSchema(BaseModel):
             return None
 
         previous_signal_end = self.start
-        for signal in self.signals:
+        for signal in (signal.intervals if signal is not None else self.signals):
             if not bool(schedule.duration_to_delta(signal.duration)[0]):
                 return signal
 
@@ -107,30 +145,27 @@ class EventSchema(BaseModel):
                 return signal
             previous_signal_end = current_signal_end
 
-    def cancel(self, random_end=False):
+    def cancel(self, random_end=False, now=None):
+        '''
+        now -- UTC datetime of the cancellation, the current time if None
+        '''
+        if now is None:
+            now = datetime.utcnow()
         if self.status == "active" or random_end:
-            self.end = schedule.random_offset(datetime.utcnow(), 0, self.cancellation_offset) if self.cancellation_offset else datetime.utcnow()
+            self.end = schedule.random_offset(now, 0, self.cancellation_offset) if self.cancellation_offset else now
         elif self.status == "cancelled":
             pass
         else:
-            self.end = datetime.utcnow()
+            self.end = now
         self.status = "cancelled"
 
     @staticmethod
     def from_xml(evt_xml: etree.XML):
         event_id = EventSchema.get_event_id(evt_xml)
         event_original_start = EventSchema.get_active_period_start(evt_xml)
-        signal_list = EventSchema.get_signals(evt_xml)
-        event_signals = (
-            [
-                SignalSchema(
-                    duration=evt[0],
-                    index=int(evt[1]),
-                    level=float(evt[2])
-                ) for evt in signal_list
-            ]
-            if signal_list else []
-        )
+        all_signals = EventSchema.get_event_signals(evt_xml)
+        simple = simple_signal_index([(signal.name, signal.type) for signal in all_signals])
+        event_signals = list(all_signals[simple].intervals) if simple is not None else []
         event_group_ids = EventSchema.get_group_ids(evt_xml)
         event_resource_ids = EventSchema.get_resource_ids(evt_xml)
         event_party_ids = EventSchema.get_party_ids(evt_xml)
@@ -156,6 +191,7 @@ class EventSchema(BaseModel):
         return EventSchema(
             id=event_id,
             signals=event_signals,
+            event_signals=all_signals,
             start=event_start,
             end=ending_time,
             cancellation_offset=start_offset[1],
@@ -209,28 +245,32 @@ class EventSchema(BaseModel):
             'ei:payloadFloat/ei:value', namespaces=ns_map)
 
     @staticmethod
-    def get_signals(evt, ns_map=NS_A):
-        simple_signal = None
-        signals = []
-        for signal in evt.iterfind(
-                'ei:eiEventSignals/ei:eiEventSignal', namespaces=ns_map
-        ):
-            signal_name = signal.findtext('ei:signalName', namespaces=ns_map)
-            signal_type = signal.findtext('ei:signalType', namespaces=ns_map)
-
-            if signal_name == 'simple' and signal_type in VALID_SIGNAL_TYPES:
-                simple_signal = signal  # This is A profile only conformance rule!
-
-        if simple_signal is None:
-            return None
-
-        for interval in simple_signal.iterfind('strm:intervals/ei:interval', namespaces=ns_map):
-            duration = interval.findtext('xcal:duration/xcal:duration', namespaces=ns_map)
-            uid = interval.findtext('xcal:uid/xcal:text', namespaces=ns_map)
-            value = interval.findtext('ei:signalPayload//ei:value', namespaces=ns_map)
-            signals.append((duration, uid, value))
-
-        return signals
+    def get_event_signals(evt, ns_map=NS_A):
+        '''
+        Returns: A list of EventSignalSchema, one for each ei:eiEventSignal;
+                 those with intervals which can't be read are left out
+        '''
+        event_signals = []
+        for signal in evt.iterfind('ei:eiEventSignals/ei:eiEventSignal', namespaces=ns_map):
+            signal_id = signal.findtext('ei:signalID', namespaces=ns_map)
+            try:
+                current_value = signal.findtext('ei:currentValue//ei:value', namespaces=ns_map)
+                event_signals.append(EventSignalSchema(
+                    name=signal.findtext('ei:signalName', namespaces=ns_map),
+                    type=signal.findtext('ei:signalType', namespaces=ns_map),
+                    id=signal_id,
+                    current_value=float(current_value) if current_value is not None else None,
+                    intervals=[
+                        SignalSchema(
+                            duration=interval.findtext('xcal:duration/xcal:duration', namespaces=ns_map),
+                            index=int(interval.findtext('xcal:uid/xcal:text', namespaces=ns_map)),
+                            level=float(interval.findtext('ei:signalPayload//ei:value', namespaces=ns_map))
+                        ) for interval in signal.iterfind('strm:intervals/ei:interval', namespaces=ns_map)
+                    ]
+                ))
+            except (TypeError, ValueError) as ex:
+                logger.warning(f"Ignoring signal {signal_id} of event {EventSchema.get_event_id(evt)}: {ex}")
+        return event_signals
 
     @staticmethod
     def get_active_period_start(evt, ns_map=NS_A):
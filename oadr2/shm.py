@@ -0,0 +1,295 @@
+'''
+A memory-mapped table of the current signal state of each controlled
+resource, written by the EventController and readable by any local
+process (relay drivers, BMS bridges...) without IPC round trips or
+database access.
+
+The file is a 64 byte header followed by `slots` slots of 256 bytes, all
+little-endian:
+
+    header: magic b'OADRSIG1', uint32 version, uint32 slots, uint32 slot size
+    slot:   uint64 seq, float64 level, float64 next change (UNIX time, NaN
+            if none), char[64] resource ID, char[128] event ID (UTF-8,
+            NUL padded)
+
+Each slot is a seqlock: the writer makes `seq` odd, writes the slot and
+makes `seq` even again.  A reader copies the slot and retries if `seq` was
+odd or changed in between, so it never sees a half written slot.  `seq / 2`
+is the number of times the slot was written.
+'''
+import collections
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+MAGIC = b'OADRSIG1'
+VERSION = 1
+DEFAULT_SLOTS = 64
+
+HEADER = struct.Struct('<8sIII')
+HEADER_SIZE = 64
+SEQ = struct.Struct('<Q')
+PAYLOAD = struct.Struct('<dd64s128s')  # follows seq
+SLOT_SIZE = 256
+RESOURCE_ID_SIZE = 64
+EVENT_ID_SIZE = 128
+READ_RETRIES = 1000  # give up on a slot the writer keeps changing
+
+EPOCH = datetime(1970, 1, 1)
+
+SignalState = collections.namedtuple(
+    'SignalState', ('resource_id', 'level', 'event_id', 'next_change_time', 'sequence'))
+
+
+class SignalTableError(Exception):
+    '''
+    Raised for a file which is not a signal table, or a slot which could
+    not be read consistently.
+    '''
+
+
+class SignalTable(object):
+    '''
+    A signal table file, opened for writing by the process which owns it
+    (`writable=True`) or read-only by anyone else.
+
+    Only one process may write a table, and within it writes are serialized
+    by a lock.  Reads never block.
+
+    Member Variables:
+    --------
+    path -- The table file
+    slots -- Number of resources the table can hold
+    writable -- Whether this process writes the table
+    '''
+
+    def __init__(self, path, writable=False, slots=DEFAULT_SLOTS):
+        '''
+        path -- The table file.  A writer reuses an existing table with
+                the same number of slots, so readers which already mapped
+                it keep working.  Anything else is replaced by a new file
+                rather than resized under the readers' mappings, which
+                would kill them with SIGBUS; they see the new table once
+                they open it again.
+        writable -- Open the table for publishing
+        slots -- Number of resources, for a new table
+        '''
+
+        self.path = path
+        self.writable = writable
+        self._index = {}  # resource ID -> slot
+        self._lock = threading.Lock()
+
+        if writable:
+            self._map = self._reuse(slots) or self._create(slots)
+        else:
+            with open(path, 'rb') as table_file:
+                self._map = mmap.mmap(table_file.fileno(), 0, access=mmap.ACCESS_READ)
+            slots = _read_header(self._map)
+            if slots is None:
+                self._map.close()
+                raise SignalTableError("%s is not a signal table" % path)
+
+        self.slots = slots
+
+    def publish(self, resource_id, level, event_id=None, next_change_time=None):
+        '''
+        Write the current state of a resource, taking a free slot the first
+        time it is published.
+
+        resource_id -- The resource; a controller publishes the VEN as a
+                       whole under its `resource_id`, the VEN ID by default
+        level -- The current signal level
+        event_id -- ID of the event setting the level, None if none
+        next_change_time -- UTC datetime at which the level may change next
+        '''
+
+        if not self.writable:
+            raise SignalTableError("%s is open read-only" % self.path)
+
+        resource = _encode(resource_id, RESOURCE_ID_SIZE, "resource ID")
+        event = _encode(event_id or '', EVENT_ID_SIZE, "event ID")
+        next_change = (next_change_time - EPOCH).total_seconds() \
+            if next_change_time is not None else math.nan
+
+        with self._lock:
+            offset = self._offset(self._slot(resource_id, allocate=True))
+            seq = SEQ.unpack_from(self._map, offset)[0] | 1
+            SEQ.pack_into(self._map, offset, seq)  # odd: write in progress
+            PAYLOAD.pack_into(self._map, offset + SEQ.size, float(level), next_change, resource, event)
+            SEQ.pack_into(self._map, offset, seq + 1)
+
+    def read(self, resource_id):
+        '''
+        resource_id -- The resource, see `publish()`
+
+        Returns: The SignalState of a resource, None if never published
+        '''
+        slot = self._slot(resource_id)
+        return self._read_slot(slot) if slot is not None else None
+
+    def read_all(self):
+        '''
+        Returns: A dict of resource ID -> SignalState for every published
+                 resource
+        '''
+        states = {}
+        for slot in range(self.slots):
+            state = self._read_slot(slot)
+            if state is not None:
+                states[state.resource_id] = state
+        return states
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _reuse(self, slots):
+        '''
+        Returns: The writable map of the existing table, None if there is
+                 none with `slots` slots
+        '''
+
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except FileNotFoundError:
+            return None
+        try:
+            if os.fstat(fd).st_size != HEADER_SIZE + slots * SLOT_SIZE:
+                return None
+            mapped = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        if _read_header(mapped) != slots:
+            mapped.close()
+            return None
+        return mapped
+
+    def _create(self, slots):
+        '''
+        Write an empty table to a temporary file next to `path` and rename
+        it over whatever is there.
+
+        Returns: Its writable map
+        '''
+
+        size = HEADER_SIZE + slots * SLOT_SIZE
+        directory, name = os.path.split(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=name + '.', dir=directory)
+        try:
+            os.fchmod(fd, 0o644)
+            os.ftruncate(fd, size)
+            mapped = mmap.mmap(fd, size)
+            HEADER.pack_into(mapped, 0, MAGIC, VERSION, slots, SLOT_SIZE)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        finally:
+            os.close(fd)
+        return mapped
+
+    def _offset(self, slot):
+        return HEADER_SIZE + slot * SLOT_SIZE
+
+    def _slot(self, resource_id, allocate=False):
+        '''
+        Find the slot of `resource_id`, or with `allocate` the first free
+        one.  A slot keeps its resource once published, so the index can
+        be cached.
+        '''
+
+        slot = self._index.get(resource_id)
+        if slot is not None:
+            return slot
+
+        free = None
+        for slot in range(self.slots):
+            slot_resource = self._resource_at(slot)
+            if slot_resource is None:
+                if free is None:
+                    free = slot
+            elif slot_resource == resource_id:
+                self._index[resource_id] = slot
+                return slot
+
+        if not allocate:
+            return None
+        if free is None:
+            raise SignalTableError("No free slot in %s for resource %r" % (self.path, resource_id))
+        self._index[resource_id] = free
+        return free
+
+    def _resource_at(self, slot):
+        '''
+        Returns: The resource ID of `slot`, None if it is unused
+        '''
+        if self.writable:  # nothing else writes the table, no need for the seqlock
+            offset = self._offset(slot)
+            if SEQ.unpack_from(self._map, offset)[0] == 0:
+                return None
+            return PAYLOAD.unpack_from(self._map, offset + SEQ.size)[2].rstrip(b'\0').decode('utf-8')
+
+        state = self._read_slot(slot)
+        return state.resource_id if state is not None else None
+
+    def _read_slot(self, slot):
+        '''
+        Returns: A consistent SignalState of `slot`, None if it is unused
+        '''
+
+        offset = self._offset(slot)
+        for attempt in range(READ_RETRIES):
+            seq = SEQ.unpack_from(self._map, offset)[0]
+            if seq & 1:
+                if attempt:
+                    time.sleep(0)
+                continue
+            level, next_change, resource, event = PAYLOAD.unpack_from(self._map, offset + SEQ.size)
+            if SEQ.unpack_from(self._map, offset)[0] != seq:
+                continue
+
+            if seq == 0:
+                return None
+            event_id = event.rstrip(b'\0').decode('utf-8')
+            return SignalState(
+                resource_id=resource.rstrip(b'\0').decode('utf-8'),
+                level=level,
+                event_id=event_id or None,
+                next_change_time=None if math.isnan(next_change)
+                else datetime.utcfromtimestamp(next_change),
+                sequence=seq // 2,
+            )
+
+        raise SignalTableError("Slot %d of %s kept changing while read" % (slot, self.path))
+
+
+def _read_header(mapped):
+    '''
+    Returns: The number of slots of the table in `mapped`, None if its
+             header is not valid
+    '''
+    if len(mapped) < HEADER_SIZE:
+        return None
+    magic, version, slots, slot_size = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version != VERSION or slot_size != SLOT_SIZE \
+            or len(mapped) < HEADER_SIZE + slots * SLOT_SIZE:
+        return None
+    return slots
+
+
+def _encode(value, size, name):
+    encoded = value.encode('utf-8')
+    if len(encoded) > size:
+        raise ValueError("%s %r is longer than %d bytes" % (name, value, size))
+    return encoded
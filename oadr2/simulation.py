@@ -0,0 +1,192 @@
+'''
+Replays event schedules against many VENs in virtual time, for regression
+and capacity testing.  The VENs share a clock.SimulatedClock and have no
+threads: the simulation keeps a heap of what happens next, the payloads
+to deliver and the next change time of each VEN's controller, and jumps
+straight from one to the next, so a week of events takes only as long
+as its payloads and boundaries take to process.
+
+    sim = simulation.Simulation(datetime(2030, 1, 1))
+    for ven_id in ven_ids:
+        sim.add_ven(ven_id, event_config=dict(group_id='North'))
+    sim.deliver(datetime(2030, 1, 1, 6), payload)
+    changes = sim.run(datetime(2030, 1, 8))
+'''
+# pylint: disable=W1202
+import collections
+import heapq
+import itertools
+from datetime import timedelta
+
+from oadr2 import clock, controller, dispatch, event, eventdb, host, logger
+
+# Control passes run this long after a boundary: an interval still sets
+# the level at its end
+RESOLUTION = timedelta(microseconds=1)
+
+# A change of the signal level, or of the event setting it, of a VEN
+SignalChange = collections.namedtuple('SignalChange', ('time', 'ven_id', 'level', 'event_id'))
+
+_DELIVER, _OPTOUT, _CONTROL = range(3)
+
+
+class Simulation(object):
+    '''
+    A set of VENs, each an event.EventHandler and controller.EventController
+    sharing an in-memory database and an EventParseCache like those of a
+    host.VENHost, run in virtual time.
+
+    Member Variables:
+    --------
+    clock -- The clock.SimulatedClock of all the VENs
+    vens -- ven_id -> controller.EventController, whose `event_handler`
+            is the VEN's
+    engine -- The SQLAlchemy engine of all the VENs
+    parse_cache -- The host.EventParseCache shared by all the VENs
+    callbacks -- The dispatch.CoalescingDispatcher shared by all the VENs
+    max_step -- Longest time between two control passes of a VEN, None to
+                only run them at boundaries
+    changes -- SignalChange of every change so far, in time order
+    passes -- Number of control passes run so far
+    '''
+
+    def __init__(self, start, db_path=None, max_step=None):
+        '''
+        start -- UTC datetime the simulation starts at
+        db_path -- SQLite database for the events, in memory if None
+        max_step -- Also run a control pass of each VEN at least this often,
+                    a timedelta, e.g. for an optimize.LoadShifter
+        '''
+
+        self.clock = clock.SimulatedClock(start)
+        self.engine = eventdb.create_shared_engine(db_path) if db_path else eventdb.create_memory_engine()
+        self.parse_cache = host.EventParseCache()
+        self.callbacks = dispatch.CoalescingDispatcher(name='oadr2.simulation-callback')
+        self.max_step = max_step
+        self.vens = {}
+        self.changes = []
+        self.passes = 0
+
+        self._queue = []  # heap of (time, sequence, kind, args)
+        self._sequence = itertools.count()
+        self._due = {}  # ven_id -> time of its next control pass
+        self._states = {}  # ven_id -> (level, event ID) of its last pass
+
+    def add_ven(self, ven_id, event_config={}, control_opts={}):
+        '''
+        Add a VEN, whose first control pass runs now.
+
+        ven_id -- The VEN's ID, also its database namespace
+        event_config -- More keyword arguments for its EventHandler
+                        (vtn_ids, group_id, market_contexts...)
+        control_opts -- More keyword arguments for its EventController
+
+        Returns: The VEN's controller.EventController
+        '''
+
+        if ven_id in self.vens:
+            raise ValueError("VEN %s is already simulated" % ven_id)
+
+        event_handler = event.EventHandler(**dict(
+            event_config,
+            ven_id=ven_id,
+            db_engine=self.engine,
+            db_namespace=ven_id,
+            event_parser=self.parse_cache.parse,
+            clock=self.clock,
+        ))
+        self.vens[ven_id] = controller.EventController(
+            event_handler, **dict(dict(callback_dispatcher=self.callbacks, **control_opts), start_thread=False))
+        self._states[ven_id] = (0, None)
+        self._control(ven_id, self.clock.now())
+        return self.vens[ven_id]
+
+    def deliver(self, when, payload, ven_ids=None):
+        '''
+        Have VENs handle an oadrDistributeEvent at `when`, as if they had
+        polled it or had it pushed, and run their control pass.  Like a VTN
+        would, each payload should carry all the events not yet over: those
+        left out are cancelled.
+
+        payload -- The oadrDistributeEvent, an lxml element
+        ven_ids -- The VENs getting it, all of them if None
+        '''
+        self._push(when, _DELIVER, (payload, ven_ids))
+
+    def optout(self, when, ven_id, event_id):
+        '''
+        Have a VEN opt out of an event at `when`.
+        '''
+        self._push(when, _OPTOUT, (ven_id, event_id))
+
+    def run(self, until):
+        '''
+        Run up to and including `until`, and leave the clock there.
+
+        Returns: The SignalChanges of this run, in time order
+        '''
+
+        first = len(self.changes)
+        while self._queue and self._queue[0][0] <= until:
+            when, _, kind, args = heapq.heappop(self._queue)
+            if kind == _CONTROL and self._due.get(args) != when:
+                continue  # the pass was moved
+            self.clock.advance_to(when)
+
+            if kind == _DELIVER:
+                payload, ven_ids = args
+                for ven_id in (self.vens if ven_ids is None else ven_ids):
+                    self.vens[ven_id].event_handler.handle_payload(payload)
+                    self._control(ven_id, when)
+            elif kind == _OPTOUT:
+                ven_id, event_id = args
+                self.vens[ven_id].event_handler.optout_event(event_id)
+                self._control(ven_id, when)
+            else:
+                self._tick(args)
+
+        if until > self.clock.now():
+            self.clock.advance_to(until)
+        logger.debug("Simulated up to %s, %d passes", until, self.passes)
+        return self.changes[first:]
+
+    def exit(self):
+        '''
+        Shut down the VENs and release the database.
+        '''
+
+        for event_controller in self.vens.values():
+            event_controller.exit()
+        self.vens = {}
+        self.callbacks.stop(2)
+        self.engine.dispose()
+
+    def _push(self, when, kind, args):
+        heapq.heappush(self._queue, (when, next(self._sequence), kind, args))
+
+    def _control(self, ven_id, when):
+        '''
+        Run the control pass of a VEN at `when`, unless one is due sooner.
+        '''
+        due = self._due.get(ven_id)
+        if due is None or when < due:
+            self._due[ven_id] = when
+            self._push(when, _CONTROL, ven_id)
+
+    def _tick(self, ven_id):
+        event_controller = self.vens[ven_id]
+        del self._due[ven_id]
+        event_controller.tick()
+        self.passes += 1
+
+        now = self.clock.now()
+        state = (event_controller.current_signal_level, event_controller.current_event_id)
+        if state != self._states[ven_id]:
+            self._states[ven_id] = state
+            self.changes.append(SignalChange(now, ven_id, *state))
+
+        change = event_controller.next_change_time
+        if change is not None:
+            self._control(ven_id, change + RESOLUTION)
+        if self.max_step is not None:
+            self._control(ven_id, now + self.max_step)
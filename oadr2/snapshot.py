@@ -0,0 +1,234 @@
+'''
+A snapshot of the runtime state of a VEN, so that a restarted VEN is
+controlling again straight away: the events of the last control pass as
+the controller holds them, its compiled forecast, the opt-outs, the
+current level and the version of every stored event.  The controller
+writes it after each pass which changed its state and on exit, and
+restores it on start if the database still holds the same events, see
+`controller.EventController(snapshot=...)`.
+
+The file is replaced atomically, so a reader maps either the old or the
+new snapshot.  It is a 48 byte header followed by the forecast and a JSON
+document, all little-endian:
+
+    header:   magic b'OADRSNP1', uint32 version, uint32 CRC-32 of the
+              rest, int64 written, float64 level, int64 next change,
+              uint32 forecast boundaries, uint32 JSON length
+    forecast: int64 boundaries[n], float64 levels[n - 1], int32 index in
+              `events` of the event setting each level (-1 if none)
+    JSON:     {"event_id", "events", "optouts", "versions", "resources"}
+
+Times are microseconds since the UNIX epoch, NO_TIME for none.
+'''
+# pylint: disable=W1202
+import collections
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+from datetime import datetime, timedelta
+
+from oadr2 import timeline
+from oadr2.schemas import EventSchema, EventSignalSchema, SignalSchema
+
+MAGIC = b'OADRSNP1'
+VERSION = 1
+
+HEADER = struct.Struct('<8sIIqdqII')
+NO_TIME = -2 ** 63
+
+EPOCH = datetime(1970, 1, 1)
+
+# Stored as they are, the times as microseconds and the signals as lists
+_EVENT_FIELDS = ('id', 'cancellation_offset', 'group_ids', 'resource_ids', 'party_ids', 'ven_ids',
+                 'market_context', 'mod_number', 'status', 'test_event', 'priority')
+_TIME_FIELDS = ('start', 'original_start', 'end')
+
+# The state of a VEN restored on start.  `events` are those of the last
+# control pass, `timeline` its forecast (None if none), `versions` maps the
+# ID of every stored event, opted out of or not, to its (modification
+# number, status, end) and `resource_states` each resource ID to its
+# (level, event ID, next change time).
+VENState = collections.namedtuple('VENState', (
+    'written', 'level', 'event_id', 'next_change_time', 'events', 'timeline', 'optouts',
+    'versions', 'resource_states'))
+
+
+class SnapshotError(Exception):
+    '''
+    Raised for a file which is not a snapshot of this version, or which is
+    damaged.
+    '''
+
+
+class SnapshotFile(object):
+    '''
+    The snapshot file of one VEN.  Only one process may write it.
+
+    Member Variables:
+    --------
+    path -- The snapshot file
+    written -- Number of snapshots written so far
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.written = 0
+
+    def write(self, state):
+        '''
+        Replace the snapshot with the VENState `state`: written to a
+        temporary file next to it, synced and renamed over it.
+        '''
+
+        events = list(state.events)
+        index = dict((evt.id, position) for position, evt in enumerate(events))
+        forecast = state.timeline
+        if forecast is not None:
+            times = [_to_micros(when) for when in forecast.times]
+            pieces = struct.pack(
+                '<%dq%dd%di' % (len(times), len(forecast.levels), len(forecast.levels)),
+                *times, *forecast.levels, *[index.get(event_id, -1) for event_id in forecast.event_ids])
+        else:
+            times = []
+            pieces = b''
+
+        document = json.dumps(dict(
+            event_id=state.event_id,
+            events=[_encode_event(evt) for evt in events],
+            optouts=sorted(state.optouts),
+            versions=state.versions,
+            resources=dict(
+                (resource, [resource_level, event_id, _to_micros(next_change_time)])
+                for resource, (resource_level, event_id, next_change_time) in state.resource_states.items()),
+        ), separators=(',', ':')).encode('utf-8')
+
+        body = pieces + document
+        header = HEADER.pack(
+            MAGIC, VERSION, zlib.crc32(body), _to_micros(state.written), float(state.level),
+            _to_micros(state.next_change_time), len(times), len(document))
+
+        directory, name = os.path.split(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=name + '.', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as snapshot_file:
+                snapshot_file.write(header + body)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.written += 1
+
+    def read(self):
+        '''
+        Returns: The VENState of the snapshot, None if there is none
+
+        Raises: SnapshotError if the file is not a valid snapshot
+        '''
+
+        try:
+            snapshot_file = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        with snapshot_file:
+            if os.fstat(snapshot_file.fileno()).st_size < HEADER.size:
+                raise SnapshotError("%s is not a snapshot" % self.path)
+            with mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                return self._decode(mapped)
+
+    def remove(self):
+        '''
+        Delete the snapshot, if any.
+        '''
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def _decode(self, mapped):
+        magic, version, crc, written, level, next_change, boundaries, length = HEADER.unpack_from(mapped, 0)
+        if magic != MAGIC or version != VERSION:
+            raise SnapshotError("%s is not a version %d snapshot" % (self.path, VERSION))
+        pieces = max(boundaries - 1, 0)
+        forecast_size = boundaries * 8 + pieces * 12
+        if len(mapped) != HEADER.size + forecast_size + length \
+                or zlib.crc32(mapped[HEADER.size:]) != crc:
+            raise SnapshotError("%s is damaged" % self.path)
+
+        document = json.loads(mapped[HEADER.size + forecast_size:])
+        events = [_decode_event(evt) for evt in document['events']]
+
+        forecast = None
+        if boundaries:
+            values = struct.unpack_from('<%dq%dd%di' % (boundaries, pieces, pieces), mapped, HEADER.size)
+            forecast = timeline.Timeline(
+                [_from_micros(when) for when in values[:boundaries]],
+                list(values[boundaries:boundaries + pieces]),
+                [events[position].id if position >= 0 else None for position in values[boundaries + pieces:]],
+            )
+
+        return VENState(
+            written=_from_micros(written),
+            level=level,
+            event_id=document['event_id'],
+            next_change_time=_from_micros(next_change),
+            events=events,
+            timeline=forecast,
+            optouts=set(document['optouts']),
+            versions=dict((event_id, tuple(version)) for event_id, version in document['versions'].items()),
+            resource_states=dict(
+                (resource, (resource_level, event_id, _from_micros(resource_change)))
+                for resource, (resource_level, event_id, resource_change) in document['resources'].items()),
+        )
+
+
+def _encode_event(evt):
+    encoded = dict((field, getattr(evt, field)) for field in _EVENT_FIELDS)
+    for field in _TIME_FIELDS:
+        encoded[field] = _to_micros(getattr(evt, field))
+    encoded['signals'] = [[signal.index, signal.duration, signal.level] for signal in evt.signals]
+    encoded['event_signals'] = [
+        [
+            event_signal.name, event_signal.type, event_signal.id, event_signal.current_value,
+            [[signal.index, signal.duration, signal.level] for signal in event_signal.intervals]
+        ] for event_signal in evt.event_signals
+    ]
+    return encoded
+
+
+def _decode_event(encoded):
+    '''
+    Returns: The EventSchema of `_encode_event()`, built without validating
+             it again, which takes most of a restore
+    '''
+    fields = dict((field, encoded[field]) for field in _EVENT_FIELDS)
+    for field in _TIME_FIELDS:
+        fields[field] = _from_micros(encoded[field])
+    fields['signals'] = [
+        SignalSchema.construct(index=index, duration=duration, level=level)
+        for index, duration, level in encoded['signals']
+    ]
+    fields['event_signals'] = [
+        EventSignalSchema.construct(
+            name=name, type=signal_type, id=signal_id, current_value=current_value,
+            intervals=[SignalSchema.construct(index=index, duration=duration, level=level)
+                       for index, duration, level in intervals])
+        for name, signal_type, signal_id, current_value, intervals in encoded['event_signals']
+    ]
+    return EventSchema.construct(**fields)
+
+
+def _to_micros(when):
+    if when is None:
+        return NO_TIME
+    return (when - EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(micros):
+    if micros == NO_TIME:
+        return None
+    return EPOCH + timedelta(microseconds=micros)
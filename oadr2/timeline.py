@@ -0,0 +1,159 @@
+'''
+The signal level forecast: the piecewise constant level over a horizon,
+merged from the intervals of all the active events and resolved by the
+controller's priority rule, see `controller.EventController.forecast()`.
+'''
+import bisect
+from datetime import datetime
+from typing import List
+
+from oadr2 import schedule
+from oadr2.schemas import EventSchema
+
+EPOCH = datetime(1970, 1, 1)
+
+
+class Timeline(object):
+    '''
+    The signal level from `times[0]` to `times[-1]`: `levels[i]`, set by
+    `event_ids[i]` (None if no event), applies after `times[i]` up to and
+    including `times[i + 1]`, like the intervals of an event.  Consecutive
+    pieces always differ.
+
+    Member Variables:
+    --------
+    times -- UTC datetimes of the piece boundaries, one more than levels
+    levels -- Level of each piece
+    event_ids -- ID of the event setting each piece
+    '''
+
+    def __init__(self, times, levels, event_ids):
+        self.times = times
+        self.levels = levels
+        self.event_ids = event_ids
+
+    def __iter__(self):
+        '''
+        Yields: (start, end, level, event_id) of each piece
+        '''
+        for index, level in enumerate(self.levels):
+            yield self.times[index], self.times[index + 1], level, self.event_ids[index]
+
+    def __len__(self):
+        return len(self.levels)
+
+    def __eq__(self, other):
+        return isinstance(other, Timeline) and \
+            (self.times, self.levels, self.event_ids) == (other.times, other.levels, other.event_ids)
+
+    def __repr__(self):
+        return 'Timeline(%r)' % list(self)
+
+    def level_at(self, when):
+        '''
+        Returns: (level, event_id) at `when`, or None outside the timeline
+        '''
+        if not self.times or not self.times[0] <= when <= self.times[-1]:
+            return None
+        index = max(bisect.bisect_left(self.times, when) - 1, 0)
+        return self.levels[index], self.event_ids[index]
+
+    def window(self, start, end):
+        '''
+        Returns: The part of the timeline from `start` to `end`, which must
+                 lie within it
+        '''
+        first = max(bisect.bisect_right(self.times, start) - 1, 0)
+        last = bisect.bisect_left(self.times, end)
+        return Timeline(
+            [start] + self.times[first + 1:last] + [end],
+            self.levels[first:last],
+            self.event_ids[first:last],
+        )
+
+    def as_arrays(self):
+        '''
+        Returns: A dict of parallel lists for exporting: `times` as UNIX
+                 timestamps (one more than the others), `levels` and
+                 `event_ids`
+        '''
+        return dict(
+            times=[(when - EPOCH).total_seconds() for when in self.times],
+            levels=list(self.levels),
+            event_ids=list(self.event_ids),
+        )
+
+
+def event_intervals(evt: EventSchema, event_signal=None):
+    '''
+    event_signal -- One of the event's `event_signals`, the simple signal if
+                    None
+
+    Returns: A list of (start, end, signal) of the signal's intervals, cut
+             short by the event's end; end is None for an open ended
+             interval of an event without end
+    '''
+
+    intervals = []
+    start = evt.start
+    for signal in (event_signal.intervals if event_signal is not None else evt.signals):
+        duration = schedule.duration_to_delta(signal.duration)[0]
+        end = start + duration if duration else evt.end
+        if evt.end is not None and (end is None or end > evt.end):
+            end = evt.end
+        if end is not None and end <= start:
+            break
+        intervals.append((start, end, signal))
+        if end is None or end == evt.end:
+            break
+        start = end
+    return intervals
+
+
+def build(events: List[EventSchema], start, end, select, signal_type=None):
+    '''
+    Merge the intervals of `events` into the Timeline from `start` to `end`.
+
+    events -- The active events, in the order the controller sees them
+    select -- Picks (level, event) out of (event, interval) pairs, like
+              `EventController._select()`
+    signal_type -- Merge the signals of this type (e.g. 'price') instead of
+                   the simple signals
+
+    Returns: A Timeline
+    '''
+
+    intervals = []
+    times = {start, end}
+    for order, evt in enumerate(events):
+        if evt.status is None or evt.test_event:
+            continue
+        event_signals = [None] if signal_type is None else evt.get_signals_of_type(signal_type)
+        for event_signal in event_signals:
+            for interval_start, interval_end, signal in event_intervals(evt, event_signal):
+                interval_end = end if interval_end is None else min(interval_end, end)
+                if interval_end <= start or interval_start >= end:
+                    continue
+                interval_start = max(interval_start, start)
+                intervals.append((interval_start, interval_end, order, evt, signal))
+                times.update((interval_start, interval_end))
+
+    times = sorted(times)
+    position = dict((when, index) for index, when in enumerate(times))
+    pieces = [[] for _ in range(len(times) - 1)]
+    for interval_start, interval_end, order, evt, signal in intervals:
+        for index in range(position[interval_start], position[interval_end]):
+            pieces[index].append((order, evt, signal))
+
+    merged = Timeline([times[0]], [], [])
+    for index, candidates in enumerate(pieces):
+        candidates.sort(key=lambda candidate: candidate[0])
+        level, evt = select([(evt, signal) for _, evt, signal in candidates])
+        event_id = evt.id if evt else None
+        if merged.levels and (merged.levels[-1], merged.event_ids[-1]) == (level, event_id):
+            merged.times[-1] = times[index + 1]
+        else:
+            merged.levels.append(level)
+            merged.event_ids.append(event_id)
+            merged.times.append(times[index + 1])
+    return merged
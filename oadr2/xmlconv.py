@@ -0,0 +1,73 @@
+'''
+Helpers to move OpenADR payloads between lxml and the standard library's
+ElementTree without serializing and re-parsing them.
+
+SleekXMPP hands us (and expects back) `xml.etree.ElementTree` elements, while
+the rest of the package uses lxml.  `EventHandler.handle_payload()` only uses
+the ElementPath API (`find`, `findtext`, `iterfind`) which both libraries
+share, so an inbound stanza can be processed as is, and with `StdElementMaker`
+the reply is built as a standard library tree in the first place.
+'''
+
+from xml.etree import ElementTree as std_ElementTree
+
+from lxml import etree as lxml_etree
+from lxml.builder import ElementMaker
+
+
+def _std_makeelement(tag, attrib=None, nsmap=None):
+    # The standard library has no per-element namespace map, prefixes are
+    # assigned when the tree is serialized
+    return std_ElementTree.Element(tag, attrib or {})
+
+
+def _std_append(elem, item):
+    elem.append(item)
+
+
+def StdElementMaker(namespace=None, nsmap=None):
+    '''
+    An `lxml.builder.ElementMaker` which builds `xml.etree.ElementTree`
+    elements.  Takes the same arguments as `ElementMaker`.
+    '''
+    return ElementMaker(
+        namespace=namespace,
+        nsmap=nsmap,
+        makeelement=_std_makeelement,
+        typemap={std_ElementTree.Element: _std_append}
+    )
+
+
+def is_lxml(elem):
+    return lxml_etree.iselement(elem)
+
+
+def to_std(elem):
+    '''
+    Returns: `elem` as an `xml.etree.ElementTree.Element`; a no-op when it
+             already is one
+    '''
+    if not is_lxml(elem):
+        return elem
+    return std_ElementTree.fromstring(lxml_etree.tostring(elem))
+
+
+def to_lxml(elem):
+    '''
+    Returns: `elem` as an `lxml.etree._Element`; a no-op when it already is one
+    '''
+    if is_lxml(elem):
+        return elem
+    return lxml_etree.fromstring(std_ElementTree.tostring(elem))
+
+
+def tostring(elem, pretty_print=False):
+    '''
+    Serialize an lxml or standard library element.  `pretty_print` only
+    applies to lxml elements.
+
+    Returns: bytes
+    '''
+    if is_lxml(elem):
+        return lxml_etree.tostring(elem, pretty_print=pretty_print)
+    return std_ElementTree.tostring(elem)
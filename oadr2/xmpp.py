@@ -5,21 +5,20 @@
 
 __author__ = 'Thom Nichols <tnichols@enernoc.com>, Benjamin N. Summerton <bsummerton@enernoc.com>'
 
+import copy
 import logging
-from io import StringIO
-from xml.etree import cElementTree as std_ElementTree
-from xml.etree.cElementTree import XML as std_XML
 
 import sleekxmpp
 # NOTE: As stated in header, we are using two different XML libraries.
-#       The python standard XML library is needed because of SleekXMPP
-#       Yet we try to use the "lxml," module as much as we can.
-from lxml import etree as lxml_etree
+#       The python standard XML library is needed because of SleekXMPP.
+#       Payloads stay standard library elements end to end (see `xmlconv`),
+#       so they are never serialized and re-parsed just to switch libraries.
 from sleekxmpp.exceptions import XMPPError
 from sleekxmpp.plugins.base import base_plugin
 from sleekxmpp.stanza.iq import Iq
 
-from oadr2 import base, event
+from oadr2 import base, dispatch, event, xmlconv
+from oadr2.schemas import OADR_XMLNS_A
 
 
 class OpenADR2(base.BaseHandler):
@@ -36,9 +35,15 @@ class OpenADR2(base.BaseHandler):
     password - Password for accompanying JID
     server_addr - Address of the XMPP Server
     server_port - Port we should connect to
+    dispatcher - dispatch.OrderedDispatcher running the payload handling off
+                 the SleekXMPP event thread, in order per sending JID
+    vtn_jid - JID sent an oadrRequestEvent after a new (not resumed) session
+    sessions - Number of sessions started, not counting resumed ones
     '''
 
-    def __init__(self, event_config, user, password, server_addr='localhost', server_port=5222):
+    def __init__(self, event_config, user, password, server_addr='localhost', server_port=5222,
+                 workers=dispatch.DEFAULT_WORKERS, max_queued=dispatch.DEFAULT_MAX_QUEUED,
+                 vtn_jid=None):
         '''
         Initilize what will do XMPP magic for us
 
@@ -47,8 +52,16 @@ class OpenADR2(base.BaseHandler):
         password - Password for corresponding JID
         server_addr -- Address of where the XMPP server is located
         server_port -- Port that the XMPP server is listening on
+        workers -- Threads handling payloads; payloads from different VTNs are
+                   handled in parallel, those from one VTN in order
+        max_queued -- Payloads allowed to wait for a worker, further ones are
+                      refused with a 'resource-constraint' error
+        vtn_jid -- JID of the VTN, asked for the current events after a
+                   reconnect which could not resume the session (XEP-0198)
         '''
 
+        # Build replies as standard library elements, ready for SleekXMPP
+        event_config = dict(event_config, element_maker=xmlconv.StdElementMaker)
         base.BaseHandler.__init__(self, event_config)
 
         # Make sure we set these variables before calling the parent class' constructor
@@ -57,6 +70,9 @@ class OpenADR2(base.BaseHandler):
         self.password = password
         self.server_addr = server_addr
         self.server_port = int(server_port)
+        self.dispatcher = dispatch.OrderedDispatcher(workers, max_queued, name='xmpp-dispatch')
+        self.vtn_jid = vtn_jid
+        self.sessions = 0
 
         self._init_client(start_thread=True)
 
@@ -72,10 +88,14 @@ class OpenADR2(base.BaseHandler):
         # Setup the XMPP Client that we are going to be using
         self.xmpp_client = sleekxmpp.ClientXMPP(self.user, self.password)
         self.xmpp_client.add_event_handler('session_start', self.xmpp_session_start)
+        self.xmpp_client.add_event_handler('session_resumed', self.xmpp_session_resumed)
         self.xmpp_client.add_event_handler('message', self.xmpp_message)
         self.xmpp_client.register_plugin('xep_0030')
         self.xmpp_client.register_plugin('xep_0199',
                                          pconfig={'keepalive': True, 'frequency': 240})
+        # Stream management, so that a short outage resumes the session and
+        # the server re-sends what we missed instead of a full re-login
+        self.xmpp_client.register_plugin('xep_0198', pconfig={'allow_resume': True})
         self.xmpp_client.register_plugin('OpenADR2Plugin',
                                          module='oadr2.xmpp',
                                          pconfig={'callback': self._handle_oadr_payload})
@@ -102,6 +122,31 @@ class OpenADR2(base.BaseHandler):
         logging.info('XMPP session has started.')
         self.xmpp_client.sendPresence()
 
+        # Not resumed, so anything distributed while we were away is lost
+        if self.sessions:
+            self.resync()
+        self.sessions += 1
+
+    def xmpp_session_resumed(self, event):
+        '''
+        'session_resumed' event handler for our XMPP Client (XEP-0198); the
+        server re-sends the stanzas we missed, so there is nothing to do.
+        '''
+
+        logging.info('XMPP session resumed.')
+
+    def resync(self):
+        '''
+        Ask the VTN for the current events with an oadrRequestEvent; the
+        oadrDistributeEvent it answers with is handled like a pushed one.
+        '''
+
+        if self.vtn_jid is None:
+            logging.warning('New XMPP session but no vtn_jid to request the events from')
+            return
+        logging.info('Requesting the current events from %s', self.vtn_jid)
+        self.send_reply(self.event_handler.build_request_payload(), self.vtn_jid)
+
     def xmpp_message(self, msg):
         '''
         'message' event handler for our XMPP Client.
@@ -115,7 +160,30 @@ class OpenADR2(base.BaseHandler):
 
     def _handle_oadr_payload(self, msg):
         '''
-        Handle OpenADR2 payloads
+        Queue an OpenADR2 payload for the worker pool, so that a slow database
+        write or a big oadrDistributeEvent does not hold up keepalives and
+        other stanzas on the SleekXMPP event thread.
+
+        msg - A type of OADR2Message
+
+        Raises: XMPPError ('resource-constraint', type 'wait') if the queue is
+                full, so that the VTN retries later, or ('service-unavailable',
+                type 'cancel') once the dispatcher is stopped on exit
+        '''
+
+        try:
+            self.dispatcher.submit(str(msg.from_), self._process_oadr_payload, msg)
+        except dispatch.QueueFull as ex:
+            logging.warning('Refusing OADR2 payload from %s: %s %s',
+                            msg.from_, ex, self.dispatcher.stats())
+            raise XMPPError(condition='resource-constraint', etype='wait', text=str(ex))
+        except RuntimeError as ex:
+            logging.warning('Refusing OADR2 payload from %s: %s', msg.from_, ex)
+            raise XMPPError(condition='service-unavailable', etype='cancel', text=str(ex))
+
+    def _process_oadr_payload(self, msg):
+        '''
+        Handle OpenADR2 payloads, on a dispatcher worker thread
 
         msg - A type of OADR2Message
         '''
@@ -123,8 +191,10 @@ class OpenADR2(base.BaseHandler):
         # Try to generate a response payload and send it back
         try:
             response = self.event_handler.handle_payload(msg.payload)
-            logging.debug('Response Payload:\n%s\n----\n',
-                          lxml_etree.tostring(response, pretty_print=True))
+            if response is None:
+                return
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug('Response Payload:\n%s\n----\n', xmlconv.tostring(response))
             self.send_reply(response, msg.from_)
         except Exception as ex:
             logging.exception("Error processing OADR2 log request: %s", ex)
@@ -133,8 +203,9 @@ class OpenADR2(base.BaseHandler):
         '''
         Make and OADR2 Message and sends it to someone (if they are online)
 
-        payload - The body of the IQ stanza, i.e. the OpenADR xml stuff 
-                  (lxml.etree.Element object)
+        payload - The body of the IQ stanza, i.e. the OpenADR xml stuff
+                  (xml.etree.ElementTree.Element, or lxml.etree.Element
+                  which is converted)
         to - The JID of whom the messge will go to
         '''
 
@@ -145,8 +216,8 @@ class OpenADR2(base.BaseHandler):
 
         # Build the IQ reply and send it
         iq_reply = Iq(self.xmpp_client, sto=to, stype='set')
-        # Change the lxml object to a standard Python XML object
-        iq_reply.set_payload(std_XML(lxml_etree.tostring(payload)))
+        # A no-op for replies built by the EventHandler with StdElementMaker
+        iq_reply.set_payload(xmlconv.to_std(payload))
         self.xmpp_client.send(iq_reply)
 
     def exit(self):
@@ -157,6 +228,9 @@ class OpenADR2(base.BaseHandler):
         # Shutdown the xmpp client
         logging.info('Shutting down the XMPP Client...')
 
+        # Finish the payloads already accepted while we can still reply
+        self.dispatcher.stop(dispatch.DEFAULT_STOP_TIMEOUT)
+
         if self.xmpp_client.state.current_state() == 'connected':
             self.xmpp_client.send_presence(pstatus='unavailable')
             self.xmpp_client.disconnect()
@@ -190,7 +264,7 @@ class OADR2Message(object):
         '''
         Initizlise the message
 
-        payload -- What data we want to send (an lxml object)
+        payload -- What data we want to send (an ElementTree element)
         id_ -- ID of the stanza
         stanza_type -- What type of stanza (should be 'iq')
         iq_type -- What type of IQ
@@ -214,7 +288,7 @@ class OADR2Message(object):
         elif self.oadr_profile_level == event.OADR_PROFILE_20B:
             self.ns_map = event.NS_B
         else:
-            self.oadr_profile_level = OADR_PROFILE_20A  # Default/Safety, make it the 2.0a spec
+            self.oadr_profile_level = event.OADR_PROFILE_20A  # Default/Safety, make it the 2.0a spec
             self.ns_map = event.NS_A
 
     def get_events(self):
@@ -275,10 +349,8 @@ class OADR2Message(object):
     # Return: An XML String of the payload.  Does not include IQ tags
     def to_xml(self):
         data = []
-        buffer = StringIO()
         if self.payload is not None:
-            buffer.write(lxml_etree.tostring(self.payload))
-            data.append(buffer.getvalue())
+            data.append(xmlconv.tostring(self.payload).decode('utf-8'))
 
         return data
 
@@ -302,7 +374,11 @@ class OpenADR2Plugin(base_plugin):
         self.xep = 'OADR2'
         self.description = 'OpenADR 2.0 XMPP Plugin'
         self.xmpp.add_handler(
-            "<iq type='set'><oadrDistributeEvent xmlns='%s' /></iq>" % event.OADR_XMLNS_A,
+            "<iq type='set'><oadrDistributeEvent xmlns='%s' /></iq>" % OADR_XMLNS_A,
+            self._handle_iq)
+        # The VTN's answer to OpenADR2.resync()
+        self.xmpp.add_handler(
+            "<iq type='result'><oadrDistributeEvent xmlns='%s' /></iq>" % OADR_XMLNS_A,
             self._handle_iq)
         self.callback = self.config.get('callback')
 
@@ -314,20 +390,21 @@ class OpenADR2Plugin(base_plugin):
         iq -- A SleekXMPP Iq object.
         '''
 
-        logging.debug('OpenADR2 payload [from=%s, to=%s]',
-                      (iq.get('from'), iq.get('to')))
+        logging.debug('OpenADR2 payload [from=%s, to=%s]', iq.get('from'), iq.get('to'))
         try:
-            # Convert a "Standard Python Library XML object," to one from lxml
-            payload_element = lxml_etree.XML(std_ElementTree.tostring(iq[0]))
+            # The EventHandler reads the standard library element directly,
+            # on a worker thread: a copy, as SleekXMPP reuses the stanza
             msg = OADR2Message(
                 iq_type=iq.get('type'),
                 id_=iq.get('id'),
                 from_=iq.get('from'),
-                payload=payload_element
+                payload=copy.deepcopy(iq.xml[0])
             )
 
             # And pass it to the message handler
             self.callback(msg)
+        except XMPPError:
+            raise
         except Exception as e:
             logging.exception("OADR2 XMPP parse error: %s", e)
             raise XMPPError(text=e)
@@ -0,0 +1,733 @@
+# Classes for sending/receiving OpenADR 2.0 messages via XMPP on asyncio
+# --------
+# An alternative to xmpp.OpenADR2 which needs neither SleekXMPP nor a thread
+# set per client: every connection is a coroutine on one shared event loop.
+# pylint: disable=W1202
+import asyncio
+import base64
+import collections
+import copy
+import itertools
+import logging
+import ssl
+import threading
+import time
+
+from lxml import etree
+from lxml.builder import ElementMaker
+
+from oadr2 import base, dispatch, logger
+from oadr2.aioloop import shared_loop
+from oadr2.schemas import OADR_XMLNS_A
+
+NS_CLIENT = 'jabber:client'
+NS_STREAM = 'http://etherx.jabber.org/streams'
+NS_TLS = 'urn:ietf:params:xml:ns:xmpp-tls'
+NS_SASL = 'urn:ietf:params:xml:ns:xmpp-sasl'
+NS_BIND = 'urn:ietf:params:xml:ns:xmpp-bind'
+NS_SESSION = 'urn:ietf:params:xml:ns:xmpp-session'
+NS_STANZAS = 'urn:ietf:params:xml:ns:xmpp-stanzas'
+NS_DISCO_INFO = 'http://jabber.org/protocol/disco#info'
+NS_PING = 'urn:xmpp:ping'
+NS_SM = 'urn:xmpp:sm:3'
+
+IQ_TAG = '{%s}iq' % NS_CLIENT
+MESSAGE_TAG = '{%s}message' % NS_CLIENT
+STREAM_ERROR_TAG = '{%s}error' % NS_STREAM
+PRESENCE_TAG = '{%s}presence' % NS_CLIENT
+STANZA_TAGS = (IQ_TAG, MESSAGE_TAG, PRESENCE_TAG)  # what XEP-0198 counts
+DISTRIBUTE_EVENT_TAG = '{%s}oadrDistributeEvent' % OADR_XMLNS_A
+
+STREAM_HEADER = ("<?xml version='1.0'?><stream:stream xmlns='%s' xmlns:stream='%s' "
+                 "to='%%s' version='1.0'>" % (NS_CLIENT, NS_STREAM))
+STREAM_FOOTER = b'</stream:stream>'
+SM_REQUEST = ("<r xmlns='%s'/>" % NS_SM).encode('utf-8')
+
+# Connection parameters:
+CONNECT_TIMEOUT = 30  # seconds to open the TCP connection
+KEEPALIVE_INTERVAL = 240  # seconds between XEP-0199 pings, as with xmpp.OpenADR2
+KEEPALIVE_TIMEOUT = 30  # seconds to wait for the pong before reconnecting
+RECONNECT_DELAY = 1  # first delay before reconnecting, doubled up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 60
+MAX_STANZA_SIZE = 1024 * 1024  # largest stanza we accept, in bytes
+READ_CHUNK_SIZE = 16 * 1024
+
+DISCO_IDENTITY = dict(category='system', type='version', name='OpenADR2 Python VEN')
+
+CLIENT = ElementMaker(namespace=NS_CLIENT, nsmap={None: NS_CLIENT})
+
+
+class StreamError(Exception):
+    '''
+    The XMPP stream failed or was closed; the client reconnects.
+    '''
+
+
+class StreamManagement(object):
+    '''
+    Client side XEP-0198 state of a session, kept across a dropped connection
+    so it can be resumed.
+
+    Member Variables:
+    --------
+    id -- Stream id to resume, from the server's <enabled/>
+    resume -- Whether the server allows resuming the session
+    max -- Seconds the server keeps the session after a drop, if it said
+    handled -- Stanzas received from the server
+    sent -- Stanzas sent to the server
+    unacked -- Serialized stanzas sent but not acknowledged yet, re-sent
+               after resuming
+    dropped -- time.monotonic() of the last connection drop
+    '''
+
+    def __init__(self, id_, resume=False, max_=None):
+        self.id = id_
+        self.resume = resume
+        self.max = max_
+        self.handled = 0
+        self.sent = 0
+        self.unacked = collections.deque()
+        self.dropped = None
+
+    def resumable(self):
+        if not (self.id and self.resume):
+            return False
+        return self.max is None or self.dropped is None or time.monotonic() - self.dropped < self.max
+
+    def sending(self, data):
+        self.sent += 1
+        self.unacked.append(data)
+
+    def acked(self, h):
+        '''
+        Forget the stanzas the server acknowledged with `h`.
+        '''
+        # h counts from the start of the session and wraps at 2^32
+        acked = (h - (self.sent - len(self.unacked))) % 2 ** 32
+        for _ in range(min(acked, len(self.unacked))):
+            self.unacked.popleft()
+
+
+class XMLStream(object):
+    '''
+    Incremental parser for one direction of an XMPP stream.  Bytes go in
+    with `feed()`, complete top level stanzas come out, detached from the
+    `<stream:stream>` root so the document doesn't grow with the connection.
+
+    Member Variables:
+    --------
+    root -- The `<stream:stream>` element once its start tag was read
+    max_stanza_size -- Bytes a single stanza may span
+    '''
+
+    def __init__(self, max_stanza_size=MAX_STANZA_SIZE):
+        self.parser = etree.XMLPullParser(
+            events=('start', 'end'),
+            resolve_entities=False,
+            no_network=True,
+            huge_tree=False,
+        )
+        self.max_stanza_size = max_stanza_size
+        self.root = None
+        self._depth = 0
+        self._stanza_bytes = 0
+
+    def feed(self, data):
+        '''
+        data -- bytes read from the connection
+
+        Returns: A list of the stanzas completed by `data`
+        Raises: StreamError if the peer closed the stream, sent malformed XML
+                or a stanza over `max_stanza_size`
+        '''
+
+        try:
+            self.parser.feed(data)
+            events = list(self.parser.read_events())
+        except etree.XMLSyntaxError as ex:
+            raise StreamError("Malformed XML stream: %s" % ex)
+
+        self._stanza_bytes += len(data)
+        stanzas = []
+        for action, elem in events:
+            if action == 'start':
+                self._depth += 1
+                if self._depth == 1:
+                    self.root = elem
+                continue
+
+            self._depth -= 1
+            if self._depth == 1:
+                self.root.remove(elem)
+                stanzas.append(elem)
+                self._stanza_bytes = 0
+            elif self._depth == 0:
+                raise StreamError("Stream closed by peer")
+
+        if self._stanza_bytes > self.max_stanza_size:
+            raise StreamError("Stanza larger than %d bytes" % self.max_stanza_size)
+        return stanzas
+
+
+def split_jid(jid):
+    '''
+    Returns: A 3-tuple of the local part, domain and resource of `jid`;
+             resource is None if `jid` has none
+    '''
+
+    bare, _, resource = jid.partition('/')
+    local, _, domain = bare.rpartition('@')
+    return local, domain, resource or None
+
+
+async def start_tls(writer, context, server_side=False, server_hostname=None):
+    '''
+    Upgrade the stream of `writer` and its reader to TLS in place, like
+    `StreamWriter.start_tls()` which only exists from Python 3.11.
+    '''
+
+    transport = writer.transport
+    protocol = transport.get_protocol()
+    await writer.drain()
+    tls_transport = await asyncio.get_event_loop().start_tls(
+        transport, protocol, context, server_side=server_side, server_hostname=server_hostname)
+    # Attach the TLS transport to the existing streams, as
+    # StreamWriter.start_tls() does; a new writer would close the old
+    # transport when the old one is collected
+    writer._transport = tls_transport  # pylint: disable=protected-access
+    if hasattr(protocol, '_replace_writer'):
+        protocol._replace_writer(writer)  # pylint: disable=protected-access
+    else:
+        protocol._over_ssl = True  # pylint: disable=protected-access
+
+
+class OpenADR2(base.BaseHandler):
+    '''
+    xmpp_async.OpenADR2 behaves like xmpp.OpenADR2: it waits for
+    oadrDistributeEvent IQ stanzas, answers disco#info and XEP-0199 pings,
+    keeps the connection alive and sends the oadrCreatedEvent back in an IQ
+    set.  The stream itself is handled by a coroutine on a shared event loop
+    instead of SleekXMPP's threads, and every accepted IQ set is acknowledged
+    with an IQ result.
+
+    If the server supports XEP-0198 stream management, a dropped connection
+    is resumed right away: stanzas missed in between are re-sent by the
+    server and our unacknowledged ones by us.  If it cannot be resumed, the
+    new session asks `vtn_jid` for the current events with an
+    oadrRequestEvent, so nothing distributed while offline stays lost.
+
+    Member Variables:
+    --------
+    (Everything from base.BaseHandler class)
+    user - JID of user for the VEN
+    password - Password for accompanying JID
+    server_addr - Address of the XMPP Server
+    server_port - Port we should connect to
+    jid - Full JID bound by the server for the current session
+    connected - threading.Event, set while the session is up
+    loop - The aioloop.EventLoopThread running the connection
+    dispatcher - dispatch.OrderedDispatcher handling the payloads off the loop
+    vtn_jid - JID sent an oadrRequestEvent after a new session
+    sessions - Number of sessions started, not counting resumed ones
+    resumptions - Number of times the session was resumed
+    '''
+
+    def __init__(self, event_config, user, password, server_addr='localhost', server_port=5222,
+                 control_opts={},
+                 vtn_jid=None,
+                 ssl_context=None,
+                 allow_unencrypted_plain=False,
+                 keepalive_interval=KEEPALIVE_INTERVAL,
+                 keepalive_timeout=KEEPALIVE_TIMEOUT,
+                 max_stanza_size=MAX_STANZA_SIZE,
+                 loop=None,
+                 dispatcher=None,
+                 workers=dispatch.DEFAULT_WORKERS,
+                 max_queued=dispatch.DEFAULT_MAX_QUEUED,
+                 start_thread=True):
+        '''
+        Initialize the client and, with `start_thread`, start connecting.
+
+        event_config -- A dictionary of keyword arguments for the EventHandler
+        user -- JID to log in as, preferably with a resource
+        password -- Password for `user`
+        server_addr -- Address of where the XMPP server is located
+        server_port -- Port that the XMPP server is listening on
+        control_opts -- A dict of opts for `controller.EventController`
+        vtn_jid -- JID of the VTN, asked for the current events after a
+                   reconnect which could not resume the session
+        ssl_context -- Used for STARTTLS; the default verifies the server
+        allow_unencrypted_plain -- Send the password over a connection
+                                   without TLS, e.g. to a local test server
+        keepalive_interval -- Seconds between XEP-0199 pings
+        keepalive_timeout -- Seconds to wait for a pong before reconnecting
+        max_stanza_size -- Stanzas larger than this (bytes) drop the connection
+        loop -- aioloop.EventLoopThread to run on; the process wide one if not set
+        dispatcher -- dispatch.OrderedDispatcher to handle payloads on, may be
+                      shared by many clients; one is created if not set
+        workers -- Worker threads for a dispatcher created here
+        max_queued -- Queue depth for a dispatcher created here
+        start_thread -- Connect right away
+        '''
+
+        super(OpenADR2, self).__init__(event_config, control_opts)
+
+        self.user = user
+        self.password = password
+        self.server_addr = server_addr
+        self.server_port = int(server_port)
+        self.local, self.domain, self.resource = split_jid(user)
+        self.ssl_context = ssl_context
+        self.allow_unencrypted_plain = allow_unencrypted_plain
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_timeout = keepalive_timeout
+        self.max_stanza_size = max_stanza_size
+        self.vtn_jid = vtn_jid
+
+        self.loop = loop or shared_loop()
+        self._own_dispatcher = dispatcher is None
+        self.dispatcher = dispatcher or dispatch.OrderedDispatcher(
+            workers, max_queued, name='xmpp-dispatch')
+
+        self.jid = None
+        self.connected = threading.Event()
+        self.sessions = 0
+        self.resumptions = 0
+        self._sm = None  # StreamManagement, while the server supports it
+        self._stopping = False
+        self._run_future = None
+        self._reader = None
+        self._writer = None
+        self._stream = None
+        self._stanzas = []
+        self._pending_iqs = {}  # IQ id -> asyncio.Future for its result
+        self._ids = itertools.count()
+
+        if start_thread:
+            self.start()
+
+    def start(self):
+        '''
+        Start connecting on the event loop.
+        '''
+        self._stopping = False
+        self._run_future = self.loop.submit(self._run())
+
+    async def _run(self):
+        '''
+        Keep a session up, reconnecting with exponential backoff until exit()
+        '''
+
+        delay = RECONNECT_DELAY
+        while not self._stopping:
+            try:
+                await self._session()
+            except asyncio.CancelledError:
+                raise
+            except Exception as ex:
+                if not self._stopping:
+                    logger.warning('XMPP connection to %s:%d lost: %s',
+                                   self.server_addr, self.server_port, ex)
+            finally:
+                if self.connected.is_set():
+                    # Try to resume a lost session before the server drops it
+                    resumable = self._sm is not None and self._sm.resumable()
+                    delay = 0 if resumable else RECONNECT_DELAY
+                self._disconnected()
+
+            if self._stopping:
+                break
+            await asyncio.sleep(delay)
+            delay = max(RECONNECT_DELAY, min(delay * 2, MAX_RECONNECT_DELAY))
+
+    async def _session(self):
+        '''
+        Connect, negotiate the stream and handle stanzas until it fails.
+        '''
+
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.server_addr, self.server_port), CONNECT_TIMEOUT)
+
+        features = await self._open_stream()
+        encrypted = False
+        if features.find('{%s}starttls' % NS_TLS) is not None:
+            features = await self._starttls()
+            encrypted = True
+
+        if not encrypted and not self.allow_unencrypted_plain:
+            raise StreamError("Server does not offer STARTTLS, refusing to send the password")
+        features = await self._authenticate(features)
+
+        sm_offered = features.find('{%s}sm' % NS_SM) is not None
+        if sm_offered and self._sm is not None and self._sm.resumable() and await self._resume():
+            self.resumptions += 1
+            self.connected.set()
+            logger.info('XMPP session of %s resumed.', self.jid)
+        else:
+            self._sm = None
+            await self._bind(features)
+            if sm_offered:
+                await self._enable_sm()
+
+            self._send(CLIENT.presence())
+            self.connected.set()
+            logger.info('XMPP session has started as %s.', self.jid)
+
+            # Whatever was distributed while we were away is gone with the
+            # old session, so ask for it
+            if self.sessions:
+                self.resync()
+            self.sessions += 1
+
+        keepalive = asyncio.ensure_future(self._keepalive())
+        try:
+            while True:
+                self._handle_stanza(await self._next_stanza())
+                await self._writer.drain()
+        finally:
+            keepalive.cancel()
+
+    async def _open_stream(self):
+        '''
+        (Re)start the stream with a fresh parser.
+
+        Returns: The server's <stream:features>
+        '''
+
+        self._stream = XMLStream(self.max_stanza_size)
+        self._stanzas = []
+        self._writer.write((STREAM_HEADER % self.domain).encode('utf-8'))
+        features = await self._next_stanza()
+        if features.tag != '{%s}features' % NS_STREAM:
+            raise StreamError("Expected stream features, got %s" % features.tag)
+        return features
+
+    async def _starttls(self):
+        self._writer.write(("<starttls xmlns='%s'/>" % NS_TLS).encode('utf-8'))
+        answer = await self._next_stanza()
+        if answer.tag != '{%s}proceed' % NS_TLS:
+            raise StreamError("STARTTLS refused")
+
+        context = self.ssl_context or ssl.create_default_context()
+        await start_tls(self._writer, context, server_hostname=self.domain)
+        return await self._open_stream()
+
+    async def _authenticate(self, features):
+        '''
+        SASL PLAIN authentication.
+
+        Returns: The features of the restarted stream
+        '''
+
+        mechanisms = [mech.text for mech in features.iterfind(
+            '{%(sasl)s}mechanisms/{%(sasl)s}mechanism' % dict(sasl=NS_SASL))]
+        if 'PLAIN' not in mechanisms:
+            raise StreamError("Server does not offer SASL PLAIN: %s" % mechanisms)
+
+        token = base64.b64encode(
+            b'\0' + self.local.encode('utf-8') + b'\0' + self.password.encode('utf-8'))
+        self._writer.write(b"<auth xmlns='%s' mechanism='PLAIN'>%s</auth>" % (NS_SASL.encode(), token))
+        answer = await self._next_stanza()
+        if answer.tag != '{%s}success' % NS_SASL:
+            raise StreamError("Authentication as %s failed" % self.user)
+
+        return await self._open_stream()
+
+    async def _bind(self, features):
+        bind = ElementMaker(namespace=NS_BIND, nsmap={None: NS_BIND})
+        request = bind.bind(bind.resource(self.resource)) if self.resource else bind.bind()
+        result = await self._negotiation_iq('set', request)
+        self.jid = result.findtext('{%(bind)s}bind/{%(bind)s}jid' % dict(bind=NS_BIND))
+
+        # RFC 3921 servers may still want a session established
+        session = features.find('{%s}session' % NS_SESSION)
+        if session is not None and session.find('{%s}optional' % NS_SESSION) is None:
+            await self._negotiation_iq('set', etree.Element('{%s}session' % NS_SESSION,
+                                                            nsmap={None: NS_SESSION}))
+
+    async def _enable_sm(self):
+        self._writer.write(("<enable xmlns='%s' resume='true'/>" % NS_SM).encode('utf-8'))
+        answer = await self._next_stanza()
+        if answer.tag != '{%s}enabled' % NS_SM:
+            logger.info('XMPP stream management refused')
+            return
+
+        max_ = answer.get('max')
+        self._sm = StreamManagement(
+            answer.get('id'),
+            resume=answer.get('resume') in ('true', '1'),
+            max_=int(max_) if max_ else None
+        )
+
+    async def _resume(self):
+        '''
+        Resume the previous session and re-send what the server hasn't
+        acknowledged.
+
+        Returns: False if the server refused, a new session is needed
+        '''
+
+        self._writer.write(("<resume xmlns='%s' h='%d' previd='%s'/>" % (
+            NS_SM, self._sm.handled, self._sm.id)).encode('utf-8'))
+        answer = await self._next_stanza()
+        if answer.tag != '{%s}resumed' % NS_SM:
+            logger.info('XMPP stream resumption refused, starting a new session')
+            return False
+
+        self._sm.acked(int(answer.get('h')))
+        for data in self._sm.unacked:
+            self._writer.write(data)
+        if self._sm.unacked:
+            self._writer.write(SM_REQUEST)
+        return True
+
+    def resync(self):
+        '''
+        Ask the VTN for the current events with an oadrRequestEvent; it
+        answers like any other oadrDistributeEvent.  Called on the loop thread.
+        '''
+
+        if self.vtn_jid is None:
+            logger.warning('New XMPP session but no vtn_jid to request the events from')
+            return
+        logger.info('Requesting the current events from %s', self.vtn_jid)
+        self._send(self._iq('set', self.event_handler.build_request_payload(), to=self.vtn_jid))
+
+    async def _negotiation_iq(self, iq_type, payload):
+        '''
+        Send an IQ while negotiating, nothing else is expected until its result.
+        '''
+
+        iq = self._iq(iq_type, payload)
+        self._send(iq)
+        while True:
+            answer = await self._next_stanza()
+            if answer.tag == IQ_TAG and answer.get('id') == iq.get('id'):
+                if answer.get('type') != 'result':
+                    raise StreamError("%s refused" % etree.QName(payload).localname)
+                return answer
+
+    async def _next_stanza(self):
+        while not self._stanzas:
+            data = await self._reader.read(READ_CHUNK_SIZE)
+            if not data:
+                raise StreamError("Connection closed by server")
+            self._stanzas.extend(self._stream.feed(data))
+
+        stanza = self._stanzas.pop(0)
+        if stanza.tag == STREAM_ERROR_TAG:
+            raise StreamError("Stream error: %s" % [etree.QName(child).localname for child in stanza])
+        return stanza
+
+    async def _keepalive(self):
+        '''
+        Ping the server every `keepalive_interval`, and drop the connection if
+        it doesn't answer within `keepalive_timeout`.
+        '''
+
+        while True:
+            await asyncio.sleep(self.keepalive_interval)
+            iq = self._iq('get', etree.Element('{%s}ping' % NS_PING, nsmap={None: NS_PING}),
+                          to=self.domain)
+            answer = asyncio.get_event_loop().create_future()
+            self._pending_iqs[iq.get('id')] = answer
+            self._send(iq)
+            try:
+                await asyncio.wait_for(answer, self.keepalive_timeout)
+            except asyncio.TimeoutError:
+                logger.warning('XMPP keepalive timed out, reconnecting')
+                self._writer.close()
+                return
+            finally:
+                self._pending_iqs.pop(iq.get('id'), None)
+
+    def _handle_stanza(self, stanza):
+        if self._sm is not None:
+            if stanza.tag in STANZA_TAGS:
+                self._sm.handled += 1
+            elif stanza.tag == '{%s}r' % NS_SM:
+                self._writer.write(("<a xmlns='%s' h='%d'/>" % (NS_SM, self._sm.handled)).encode('utf-8'))
+                return
+            elif stanza.tag == '{%s}a' % NS_SM:
+                self._sm.acked(int(stanza.get('h')))
+                return
+
+        if stanza.tag == MESSAGE_TAG:
+            # OpenADR 2.0 XMPP does not use Message stanzas at all
+            logger.info('XMPP message: %s', etree.tostring(stanza))
+            return
+        if stanza.tag != IQ_TAG:
+            return
+
+        iq_type = stanza.get('type')
+        if iq_type in ('result', 'error'):
+            answer = self._pending_iqs.pop(stanza.get('id'), None)
+            if answer is not None and not answer.done():
+                answer.set_result(stanza)
+            elif iq_type == 'result' and len(stanza) and stanza[0].tag == DISTRIBUTE_EVENT_TAG:
+                self._handle_distribute(stanza, ack=False)  # the answer to resync()
+            return
+
+        child = stanza[0] if len(stanza) else None
+        tag = child.tag if child is not None else None
+        if iq_type == 'set' and tag == DISTRIBUTE_EVENT_TAG:
+            self._handle_distribute(stanza)
+        elif iq_type == 'get' and tag == '{%s}query' % NS_DISCO_INFO:
+            self._send(self._disco_info(stanza))
+        elif iq_type == 'get' and tag == '{%s}ping' % NS_PING:
+            self._send(self._reply(stanza))
+        else:
+            self._send(self._error(stanza, 'cancel', 'service-unavailable'))
+
+    def _handle_distribute(self, iq, ack=True):
+        '''
+        Acknowledge an oadrDistributeEvent and queue it for the dispatcher,
+        refusing it with 'resource-constraint' if the queue is full, or with
+        'service-unavailable' once the dispatcher is stopped on exit.
+
+        iq -- The IQ carrying the oadrDistributeEvent
+        ack -- Answer it; False for an IQ result
+        '''
+
+        sender = iq.get('from')
+        logger.debug('OpenADR2 payload [from=%s, to=%s]', sender, iq.get('to'))
+
+        # A copy has its own document, so it can be read on a worker thread
+        # while this thread keeps parsing the stream
+        payload = copy.deepcopy(iq[0])
+        try:
+            self.dispatcher.submit((self.user, sender), self._process_payload, payload, sender)
+        except dispatch.QueueFull as ex:
+            logger.warning('Refusing OADR2 payload from %s: %s %s',
+                           sender, ex, self.dispatcher.stats())
+            if ack:
+                self._send(self._error(iq, 'wait', 'resource-constraint'))
+            return
+        except RuntimeError as ex:
+            # A stanza read while exiting, after the dispatcher stopped
+            logger.warning('Refusing OADR2 payload from %s: %s', sender, ex)
+            if ack:
+                self._send(self._error(iq, 'cancel', 'service-unavailable'))
+            return
+        if ack:
+            self._send(self._reply(iq))
+
+    def _process_payload(self, payload, sender):
+        '''
+        Handle an OpenADR2 payload, on a dispatcher worker thread
+
+        payload -- The oadrDistributeEvent element
+        sender -- JID of the VTN which sent it
+        '''
+
+        try:
+            response = self.event_handler.handle_payload(payload)
+            if response is None:
+                return
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug('Response Payload:\n%s\n----\n',
+                             etree.tostring(response, pretty_print=True))
+            self.send_reply(response, sender)
+        except Exception as ex:
+            logger.exception("Error processing OADR2 log request: %s", ex)
+
+    def send_reply(self, payload, to):
+        '''
+        Send an OpenADR payload in an IQ set (if we are connected).  Safe to
+        call from any thread.
+
+        payload - The body of the IQ stanza, an lxml element
+        to - The JID of whom the message will go to
+        '''
+
+        self.loop.call(self._send_iq_set, payload, to)
+
+    def _send_iq_set(self, payload, to):
+        if not self.connected.is_set():
+            if self._sm is not None and self._sm.resumable():
+                # Sent along with the other unacknowledged ones on resuming
+                self._sm.sending(etree.tostring(self._iq('set', payload, to=to)))
+                return
+            logger.error('Not connected, cannot send response')
+            return
+        self._send(self._iq('set', payload, to=to))
+
+    def _iq(self, iq_type, payload=None, to=None):
+        iq = CLIENT.iq(type=iq_type, id='oadr2-%d' % next(self._ids))
+        if to is not None:
+            iq.set('to', to)
+        if payload is not None:
+            iq.append(payload)
+        return iq
+
+    def _reply(self, iq, *children):
+        reply = CLIENT.iq(*children, type='result', id=iq.get('id', ''))
+        if iq.get('from') is not None:
+            reply.set('to', iq.get('from'))
+        return reply
+
+    def _error(self, iq, error_type, condition):
+        reply = self._reply(iq, CLIENT.error(
+            etree.Element('{%s}%s' % (NS_STANZAS, condition), nsmap={None: NS_STANZAS}),
+            type=error_type))
+        reply.set('type', 'error')
+        return reply
+
+    def _disco_info(self, iq):
+        disco = ElementMaker(namespace=NS_DISCO_INFO, nsmap={None: NS_DISCO_INFO})
+        return self._reply(iq, disco.query(
+            disco.identity(**DISCO_IDENTITY),
+            disco.feature(var=NS_DISCO_INFO),
+            disco.feature(var=NS_PING),
+        ))
+
+    def _send(self, stanza):
+        data = etree.tostring(stanza)
+        self._writer.write(data)
+        if self._sm is not None:
+            self._sm.sending(data)
+            self._writer.write(SM_REQUEST)
+
+    def _disconnected(self):
+        if self.connected.is_set() and self._sm is not None:
+            self._sm.dropped = time.monotonic()
+        self.connected.clear()
+        for answer in self._pending_iqs.values():
+            answer.cancel()
+        self._pending_iqs.clear()
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _shutdown(self):
+        if self._writer is not None and self.connected.is_set():
+            self._send(CLIENT.presence(type='unavailable'))
+            self._writer.write(STREAM_FOOTER)
+            try:
+                await asyncio.wait_for(self._writer.drain(), 1)
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+
+    def exit(self):
+        '''
+        Shutdown the client, its dispatcher (unless shared) and the parent
+        threads.  The event loop keeps running for other clients.
+        '''
+
+        logger.info('Shutting down the XMPP Client...')
+
+        # Finish the payloads already accepted while we can still reply
+        if self._own_dispatcher:
+            self.dispatcher.stop(dispatch.DEFAULT_STOP_TIMEOUT)
+
+        self._stopping = True
+        if self._run_future is not None:
+            try:
+                self.loop.submit(self._shutdown()).result(5)
+            except Exception as ex:
+                logger.warning('Unclean XMPP shutdown: %s', ex)
+            self._run_future.cancel()
+            self._run_future = None
+
+        logger.info('XMPP Client shutdown.')
+        super(OpenADR2, self).exit()
@@ -0,0 +1,62 @@
+# A file to run the Push module's OpenADR2 class (HTTP push from the VTN)
+
+__author__ = 'Benjamin N. Summerton <bsummerton@enernoc.com'
+
+# Make sure to run this from the root directory
+import sys, os
+sys.path.insert(0, os.getcwd())
+
+import threading, logging
+logging.basicConfig(
+        level=logging.DEBUG,
+        format="%(asctime)s  %(message)s" )
+
+from oadr2 import push
+
+# Some constants that we might need
+LISTEN_ADDR = '0.0.0.0'
+LISTEN_PORT = 8443
+SERVER_CERT_KEY_PATH = None #'./ven_key.pem'
+SERVER_CERT_PATH = None #'./ven_cert.pem'
+TRUST_CERTS = None #'./oadr_trust_certs.pem'
+
+# Constants relating to VEN and VTN settings
+VEN_ID = 'ven_py'
+VTN_IDS = 'vtn_1,vtn_2,vtn_3,TH_VTN,vtn_rsa'
+
+
+def main():
+    logging.info('Testing HTTP Push Transmisssions')
+
+    config = {
+        'listen_addr': LISTEN_ADDR,
+        'listen_port': LISTEN_PORT,
+        'server_cert_key': SERVER_CERT_KEY_PATH,
+        'server_cert_pem': SERVER_CERT_PATH,
+        'ven_ca_certs': TRUST_CERTS,
+        'event_config': {
+            'ven_id': VEN_ID,
+            'vtn_ids': VTN_IDS,
+        }
+    }
+
+    receiver = push.OpenADR2(**config)
+
+    # Some sort of loop thingy here
+    print('Running...')
+    _exit = threading.Event()
+    try:
+        while not _exit.is_set():
+            _exit.wait(1)
+    except:
+        pass
+
+    # Close the receiver
+    print('Exiting the OpenADR 2 Push receiver')
+    receiver.exit()
+
+    print('========DONE========')
+
+
+if __name__ == '__main__':
+    main()
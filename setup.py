@@ -12,6 +12,7 @@ setup(
     url = 'http://open.enernoc.com',
     packages = find_packages('.', exclude=['*.tests']),
     install_requires = ['lxml', 'sleekxmpp', 'dnspython', 'python-dateutil', 'requests'],
+    extras_require = {'optimize': ['numpy']},
     tests_require = ['freezegun'],
     zip_safe = False,
 )
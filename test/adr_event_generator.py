@@ -5,7 +5,13 @@ from typing import Dict, List, Optional, Union
 
 from lxml import etree
 
-from oadr2.schemas import EventSchema, SignalSchema
+from oadr2.schemas import EventSchema, EventSignalSchema, SignalSchema
+
+# A fixed time for the tests which freeze the clock
+NOW = datetime(2030, 1, 1, 12, 0)
+
+# The tests' database, in their tmpdir
+TEST_DB_ADDR = "%s/test2.db"
 
 
 def format_duration(duration: Union[timedelta, None]) -> str:
@@ -72,7 +78,9 @@ class AdrEvent:
             test_event: bool = False,
             priority: int = 1,
             response_required: bool = True,
-            signal_name: str = "simple"
+            signal_name: str = "simple",
+            signal_type: str = "level",
+            extra_signals: Optional[List[Dict]] = None
     ):
 
         self.id = id
@@ -103,6 +111,9 @@ class AdrEvent:
         self.priority = priority
         self.response_required = response_required
         self.signal_name = signal_name
+        self.signal_type = signal_type
+        # dicts of name, type, id and signals like `signals`
+        self.extra_signals = extra_signals or []
 
     def to_obj(self):
         _signals = [
@@ -112,6 +123,18 @@ class AdrEvent:
                 duration=format_duration(s["duration"])
             ) for s in self.signals
         ]
+        event_signals = [
+            EventSignalSchema(
+                name=name,
+                type=signal_type,
+                id=signal_id,
+                current_value=0.0,
+                intervals=[
+                    SignalSchema(index=s["index"], level=s["level"], duration=format_duration(s["duration"]))
+                    for s in signals
+                ]
+            ) for name, signal_type, signal_id, signals in self._all_signals()
+        ]
         return EventSchema(
             id=self.id,
             vtn_id=self.vtn_id,
@@ -120,6 +143,7 @@ class AdrEvent:
             original_start=self.original_start,
             end=self.end,
             signals=[SignalSchema(**signal) for signal in _signals],
+            event_signals=event_signals,
             status=self.status.value,
             cancellation_offset=format_duration(self.cancellation_offset) if self.cancellation_offset else None,
             ven_ids=self.ven_ids,
@@ -131,8 +155,28 @@ class AdrEvent:
             priority=self.priority
         )
 
+    def _all_signals(self):
+        return [(self.signal_name, self.signal_type, "SignalID", self.signals)] + [
+            (signal["name"], signal["type"], signal["id"], signal["signals"]) for signal in self.extra_signals
+        ]
+
     def to_xml(self):
-        intervals_xml = "".join([interval.to_xml() for interval in self.intervals])
+        signals_xml = "".join([
+            f"""
+      <ei:eiEventSignal>
+        <strm:intervals>
+          {"".join([AdrInterval(**signal).to_xml() for signal in signals])}
+        </strm:intervals>
+        <ei:signalName>{name}</ei:signalName>
+        <ei:signalType>{signal_type}</ei:signalType>
+        <ei:signalID>{signal_id}</ei:signalID>
+        <ei:currentValue>
+          <ei:payloadFloat>
+            <ei:value>0.0</ei:value>
+          </ei:payloadFloat>
+        </ei:currentValue>
+      </ei:eiEventSignal>""" for name, signal_type, signal_id, signals in self._all_signals()
+        ])
         start_after = f"""<ical:tolerance>
         <ical:tolerate>
           <ical:startafter>{format_duration(self.start_after)}</ical:startafter>
@@ -174,20 +218,7 @@ class AdrEvent:
       </ical:properties>
       <ical:components xsi:nil="true"/>
     </ei:eiActivePeriod>
-    <ei:eiEventSignals>
-      <ei:eiEventSignal>
-        <strm:intervals>
-          {intervals_xml}
-        </strm:intervals>
-        <ei:signalName>{self.signal_name}</ei:signalName>
-        <ei:signalType>level</ei:signalType>
-        <ei:signalID>SignalID</ei:signalID>
-        <ei:currentValue>
-          <ei:payloadFloat>
-            <ei:value>0.0</ei:value>
-          </ei:payloadFloat>
-        </ei:currentValue>
-      </ei:eiEventSignal>
+    <ei:eiEventSignals>{signals_xml}
     </ei:eiEventSignals>
     <ei:eiTarget>
       {ven_xml}
@@ -201,6 +232,25 @@ class AdrEvent:
 """
 
 
+def make_event(
+        id: str = "FooEvent",
+        start: Optional[datetime] = None,
+        levels: List[float] = (1.0,),
+        duration: timedelta = timedelta(minutes=10),
+        status: AdrEventStatus = AdrEventStatus.ACTIVE,
+        **kwargs
+) -> AdrEvent:
+    """An AdrEvent starting at `start` (NOW if None) with one interval of
+    `duration` for each of `levels`, the other AdrEvent arguments as given."""
+    return AdrEvent(
+        id=id,
+        start=start or NOW,
+        signals=[dict(index=index, duration=duration, level=level) for index, level in enumerate(levels)],
+        status=status,
+        **kwargs
+    )
+
+
 def generate_payload(event_list, vtn_id="TH_VTN"):
     evt_xml = "".join([event.to_xml() for event in event_list])
     template = f"""
@@ -0,0 +1,23 @@
+'''
+A throwaway self-signed certificate for the tests of the TLS transports.
+'''
+import shutil
+import subprocess
+
+import pytest
+
+needs_openssl = pytest.mark.skipif(shutil.which("openssl") is None, reason="needs openssl to make a certificate")
+
+
+def make_certificate(directory, host="127.0.0.1"):
+    '''
+    Returns: The paths of the PEM certificate and key made in `directory`,
+             valid for `host` for a day
+    '''
+    cert, key = "%s/cert.pem" % directory, "%s/key.pem" % directory
+    subject_alt_name = ("IP:%s" if host.replace(".", "").isdigit() else "DNS:%s") % host
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=%s" % host,
+         "-addext", "subjectAltName=%s" % subject_alt_name,
+         "-keyout", key, "-out", cert], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
@@ -0,0 +1,359 @@
+'''
+A small local stand-in for a VTN's simple HTTP EiEvent service, so that the
+poll client can be exercised end to end without a real VTN.
+
+Run it as a script to benchmark `poll.OpenADR2` against a generated
+scenario, e.g.:
+
+    python -m test.mock_vtn --vens 20 --events 10 --intervals 4 --churn 0.05
+'''
+import argparse
+import logging
+import random
+import re
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from test.adr_event_generator import AdrEvent, AdrEventStatus, generate_payload
+from typing import List, Optional
+
+from lxml import etree
+
+from oadr2.poll import OADR2_URI_PATH
+from oadr2.schemas import NS_A
+
+PREFER_WAIT_REX = re.compile(r'wait=(\d+)')
+
+
+@dataclass
+class Scenario:
+    '''
+    A generated set of events plus the misbehaviour to inject.
+
+    events -- Number of events served
+    intervals -- Number of intervals per event
+    interval_duration -- Duration of each interval
+    churn -- Chance (0..1) that a request modifies one of the events first
+    latency -- Seconds to wait before answering each request
+    latency_jitter -- Extra random 0..X seconds added to `latency`
+    error_rate -- Chance (0..1) that a request gets a 500 response
+    seed -- Seed for the random generator, for reproducible runs
+    '''
+    events: int = 1
+    intervals: int = 1
+    interval_duration: timedelta = timedelta(minutes=15)
+    churn: float = 0.0
+    latency: float = 0.0
+    latency_jitter: float = 0.0
+    error_rate: float = 0.0
+    seed: Optional[int] = None
+
+    def build_events(self, now=None) -> List[AdrEvent]:
+        now = now or datetime.utcnow().replace(microsecond=0)
+        return [
+            AdrEvent(
+                id=f"Event{index}",
+                start=now + index * self.intervals * self.interval_duration,
+                signals=[
+                    dict(index=interval, duration=self.interval_duration, level=float(interval % 3 + 1))
+                    for interval in range(self.intervals)
+                ],
+                status=AdrEventStatus.ACTIVE if index == 0 else AdrEventStatus.PENDING,
+            ) for index in range(self.events)
+        ]
+
+
+class MockVTN(object):
+    '''
+    Serves the current list of `AdrEvent`s to every oadrRequestEvent and
+    records the oadrCreatedEvent replies.
+
+    With `long_poll=True` a request carrying a `Prefer: wait=N` header is held
+    open until `publish()` changes the events or N seconds have passed.
+
+    With a `scenario` the events are generated from it, and requests get the
+    churn, latency and errors it describes.  `stats()` reports throughput and
+    the time between serving a new modification of an event and receiving
+    the oadrCreatedEvent for it.
+    '''
+
+    def __init__(self, events=None, vtn_id="TH_VTN", long_poll=False, scenario=None,
+                 host="127.0.0.1", port=0):
+        self.scenario = scenario
+        self.random = random.Random(scenario.seed if scenario else None)
+        if events is None and scenario is not None:
+            events = scenario.build_events()
+        self.events = list(events or [])
+        self.vtn_id = vtn_id
+        self.long_poll = long_poll
+
+        self.created_events = []  # lxml oadrCreatedEvent payloads received
+        self.request_count = 0
+        self.error_count = 0
+        self.waiting = 0  # requests currently held open
+        self.response_times = []  # seconds spent answering each oadrRequestEvent
+        self.ack_latencies = []  # seconds from serving a modification to its oadrCreatedEvent
+
+        self._version = 0
+        self._served = {}  # venID -> version of the events last sent to it
+        self._first_served = {}  # (venID, eventID, modificationNumber) -> time
+        self._changed = threading.Condition()
+        self._stopping = False
+        self._started = None
+
+        self.server = ThreadingHTTPServer((host, port), _MockVTNRequestHandler)
+        self.server.daemon_threads = True
+        self.server.request_queue_size = 128
+        self.server.vtn = self
+        self._thread = None
+
+    @property
+    def base_uri(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def start(self):
+        self._started = time.monotonic()
+        self._thread = threading.Thread(name='mock_vtn', target=self.server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._changed:
+            self._stopping = True
+            self._changed.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def publish(self, events):
+        '''
+        Replace the served events and release any held long-poll requests.
+        '''
+        with self._changed:
+            self.events = list(events)
+            self._version += 1
+            self._changed.notify_all()
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def distribute(self, ven_id, wait=None):
+        '''
+        Build the oadrDistributeEvent for `ven_id`, holding the request for up
+        to `wait` seconds if long-polling and nothing changed since the last
+        one sent to that VEN.
+
+        Returns: A 2-tuple of (HTTP status, response body bytes)
+        '''
+        started = time.monotonic()
+        if self.scenario and self.scenario.latency + self.scenario.latency_jitter:
+            time.sleep(self.scenario.latency + self.random.uniform(0, self.scenario.latency_jitter))
+
+        with self._changed:
+            self.request_count += 1
+            if self.scenario and self.random.random() < self.scenario.error_rate:
+                self.error_count += 1
+                return 500, b''
+
+            if self.scenario and self.events and self.random.random() < self.scenario.churn:
+                self._modify(self.random.choice(self.events))
+
+            if wait and self.long_poll:
+                deadline = time.monotonic() + wait
+                self.waiting += 1
+                try:
+                    while self._served.get(ven_id) == self._version and not self._stopping:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._changed.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self._served[ven_id] = self._version
+            payload = generate_payload(self.events, vtn_id=self.vtn_id)
+            now = time.monotonic()
+            for evt in self.events:
+                self._first_served.setdefault((ven_id, evt.id, evt.mod_number), now)
+            self.response_times.append(now - started)
+
+        payload.find('pyld:requestID', namespaces=NS_A).text = str(uuid.uuid4())
+        return 200, etree.tostring(payload)
+
+    def created_event(self, payload):
+        now = time.monotonic()
+        ven_id = payload.findtext('pyld:eiCreatedEvent/ei:venID', namespaces=NS_A)
+        with self._changed:
+            self.created_events.append(payload)
+            for response in payload.iterfind(
+                    'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse', namespaces=NS_A):
+                key = (
+                    ven_id,
+                    response.findtext('ei:qualifiedEventID/ei:eventID', namespaces=NS_A),
+                    int(response.findtext('ei:qualifiedEventID/ei:modificationNumber', namespaces=NS_A))
+                )
+                served = self._first_served.pop(key, None)
+                if served is not None:
+                    self.ack_latencies.append(now - served)
+
+    def stats(self):
+        '''
+        Returns: A dict of request counts, throughput and latency percentiles
+        '''
+        with self._changed:
+            elapsed = time.monotonic() - self._started if self._started else 0
+            return dict(
+                requests=self.request_count,
+                errors=self.error_count,
+                replies=len(self.created_events),
+                elapsed=elapsed,
+                requests_per_second=self.request_count / elapsed if elapsed else 0,
+                response_time=_percentiles(self.response_times),
+                ack_latency=_percentiles(self.ack_latencies),
+            )
+
+    def _modify(self, evt):
+        '''
+        Bump an event's modification number and change its first level.
+        Called with `self._changed` held.
+        '''
+        evt.mod_number += 1
+        evt.signals[0]["level"] = float(evt.mod_number % 3 + 1)
+        evt.intervals[0].level = evt.signals[0]["level"]
+        self._version += 1
+        self._changed.notify_all()
+
+
+def _percentiles(samples):
+    if not samples:
+        return dict(count=0, p50=None, p95=None, max=None)
+    ordered = sorted(samples)
+    return dict(
+        count=len(ordered),
+        p50=statistics.median(ordered),
+        p95=ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        max=ordered[-1],
+    )
+
+
+class _MockVTNRequestHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        vtn = self.server.vtn
+        if self.path.rstrip('/') != '/' + OADR2_URI_PATH + 'EiEvent':
+            self._respond(404)
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        payload = etree.fromstring(body)
+        name = etree.QName(payload).localname
+
+        if name == 'oadrRequestEvent':
+            match = PREFER_WAIT_REX.search(self.headers.get('Prefer', ''))
+            ven_id = payload.findtext('pyld:eiRequestEvent/ei:venID', namespaces=NS_A)
+            self._respond(*vtn.distribute(ven_id, int(match.group(1)) if match else None))
+
+        elif name == 'oadrCreatedEvent':
+            vtn.created_event(payload)
+            self._respond(200)
+
+        else:
+            self._respond(400)
+
+    def _respond(self, status, body=b''):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark(scenario, vens=1, duration=10.0):
+    '''
+    Drive `vens` poll clients against a MockVTN serving `scenario`, each
+    calling `query_vtn()` back to back for `duration` seconds.
+
+    Returns: The MockVTN stats plus the client side `query_vtn()` timings
+    '''
+    from oadr2 import poll
+
+    vtn = MockVTN(scenario=scenario).start()
+    db_dir = tempfile.TemporaryDirectory()
+    clients = [
+        poll.OpenADR2(
+            event_config=dict(ven_id=f"VEN_{index}", db_path=f"{db_dir.name}/ven_{index}.db"),
+            vtn_base_uri=vtn.base_uri,
+            control_opts=dict(start_thread=False),
+            start_thread=False,
+        ) for index in range(vens)
+    ]
+    query_times = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def run(client):
+        while time.monotonic() < deadline:
+            started = time.monotonic()
+            client.query_vtn()
+            with lock:
+                query_times.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=run, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stats = vtn.stats()
+    stats.update(
+        polls=len(query_times),
+        polls_per_second=len(query_times) / duration,
+        query_time=_percentiles(query_times),
+    )
+    vtn.stop()
+    for client in clients:
+        client.exit()
+    db_dir.cleanup()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark poll.OpenADR2 against a local mock VTN")
+    parser.add_argument('--vens', type=int, default=1, help="number of polling VENs")
+    parser.add_argument('--events', type=int, default=1, help="events per oadrDistributeEvent")
+    parser.add_argument('--intervals', type=int, default=1, help="intervals per event")
+    parser.add_argument('--churn', type=float, default=0.0, help="chance a request modifies an event")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="random extra response latency")
+    parser.add_argument('--errors', type=float, default=0.0, help="chance a request gets a 500")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds to run")
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    scenario = Scenario(
+        events=args.events, intervals=args.intervals, churn=args.churn,
+        latency=args.latency, latency_jitter=args.jitter, error_rate=args.errors, seed=args.seed
+    )
+    stats = benchmark(scenario, vens=args.vens, duration=args.duration)
+
+    for key, value in stats.items():
+        print(f"{key:>20}: {value}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+'''
+A minimal local stand-in for an XMPP server, enough to exercise
+`xmpp_async.OpenADR2` end to end: optional STARTTLS, SASL PLAIN, resource
+binding, pings, XEP-0198 stream management, and a VTN JID which can send
+IQs to connected clients.
+'''
+import asyncio
+import base64
+import collections
+import itertools
+import threading
+import time
+
+from lxml import etree
+
+from oadr2 import aioloop, xmpp_async
+from oadr2.xmpp_async import (
+    CLIENT, IQ_TAG, NS_BIND, NS_CLIENT, NS_PING, NS_SASL, NS_SM, NS_STREAM, NS_TLS, SM_REQUEST,
+    STANZA_TAGS, XMLStream
+)
+
+
+class _Session(object):
+    '''
+    A bound client session, which outlives its connection if resumable.
+    '''
+
+    def __init__(self, jid, writer):
+        self.jid = jid
+        self.writer = writer
+        self.sm_id = None
+        self.handled = 0  # stanzas received from the client
+        self.sent = 0  # stanzas sent to the client
+        self.unacked = collections.deque()
+
+    def acked(self, h):
+        for _ in range(min(h - (self.sent - len(self.unacked)), len(self.unacked))):
+            self.unacked.popleft()
+
+
+SERVER_HEADER = ("<?xml version='1.0'?><stream:stream xmlns='%s' xmlns:stream='%s' "
+                 "from='%%s' id='%%s' version='1.0'>" % (NS_CLIENT, NS_STREAM))
+
+
+class MockXMPPServer(object):
+    '''
+    Accepts clients whose local part and password are in `users`, and
+    records every stanza they send.
+
+    Member Variables:
+    --------
+    received -- full JID -> list of stanzas received from that client
+    sessions -- Number of sessions bound so far
+    pings -- Number of pings received from clients
+    answer_pings -- Whether pings to the server get an answer
+    stream_management -- Offer XEP-0198
+    allow_resume -- Whether sessions can be resumed
+    resumptions -- Number of sessions resumed
+    tls_context -- An ssl.SSLContext to require STARTTLS with, None to not offer it
+    encrypted -- Number of connections switched to TLS
+    '''
+
+    def __init__(self, users, domain='localhost', vtn_jid='vtn@localhost/vtn', host='127.0.0.1',
+                 tls_context=None):
+        self.users = dict(users)
+        self.domain = domain
+        self.vtn_jid = vtn_jid
+        self.received = {}
+        self.sessions = 0
+        self.pings = 0
+        self.answer_pings = True
+        self.stream_management = True
+        self.allow_resume = True
+        self.resumptions = 0
+        self.tls_context = tls_context
+        self.encrypted = 0
+
+        self._clients = {}  # full JID -> _Session
+        self._resumable = {}  # stream management id -> _Session
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._loop = aioloop.EventLoopThread(name='mock-xmpp')
+        self._server = self._loop.submit(
+            asyncio.start_server(self._serve, host, 0)).result(5)
+        self.host = host
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    def stop(self):
+        async def close():
+            self._server.close()
+            for session in list(self._clients.values()):
+                if session.writer is not None:
+                    session.writer.close()
+        self._loop.submit(close()).result(5)
+        self._loop.stop()
+
+    def send_iq(self, to, payload, iq_type='set'):
+        '''
+        Send an IQ from the VTN JID to the client bound as `to`.  While it is
+        disconnected but resumable, the IQ is sent once it resumes.
+
+        Returns: The id of the IQ
+        '''
+        iq_id = 'vtn-%d' % next(self._ids)
+        iq = CLIENT.iq(payload, type=iq_type, id=iq_id, to=to)
+        iq.set('from', self.vtn_jid)
+        self._loop.call(self._send, self._clients[to], etree.tostring(iq))
+        return iq_id
+
+    def drop(self, jid):
+        '''
+        Close the connection of the client bound as `jid`.
+        '''
+        self._loop.call(self._clients[jid].writer.close)
+
+    def stanzas(self, jid, tag=IQ_TAG, **attrib):
+        '''
+        Returns: The stanzas received from `jid` with `tag` and `attrib`
+        '''
+        with self._lock:
+            return [
+                stanza for stanza in self.received.get(jid, [])
+                if stanza.tag == tag and all(stanza.get(key) == value for key, value in attrib.items())
+            ]
+
+    def wait_for(self, predicate, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    async def _serve(self, reader, writer):
+        session = None
+        try:
+            if self.tls_context is not None:
+                await self._starttls(reader, writer)
+            stream = await self._open(reader, writer, features=(
+                "<mechanisms xmlns='%s'><mechanism>PLAIN</mechanism></mechanisms>" % NS_SASL))
+            local = await self._authenticate(reader, writer, stream)
+            if local is None:
+                return
+
+            features = "<bind xmlns='%s'/>" % NS_BIND
+            if self.stream_management:
+                features += "<sm xmlns='%s'/>" % NS_SM
+            stream = await self._open(reader, writer, features=features)
+            while True:
+                for stanza in await self._read(reader, stream):
+                    if session is None:
+                        session = self._start(writer, stanza, local)
+                        continue
+                    self._handle(session, stanza)
+        except (xmpp_async.StreamError, ConnectionError):
+            pass
+        finally:
+            if session is not None and session.writer is writer:
+                session.writer = None
+                if session.sm_id is None:
+                    del self._clients[session.jid]
+            writer.close()
+
+    async def _open(self, reader, writer, features):
+        stream = XMLStream()
+        await self._read(reader, stream)  # the client's stream header
+        writer.write((SERVER_HEADER % (self.domain, next(self._ids))).encode('utf-8'))
+        writer.write(("<stream:features>%s</stream:features>" % features).encode('utf-8'))
+        return stream
+
+    async def _starttls(self, reader, writer):
+        stream = await self._open(reader, writer, features="<starttls xmlns='%s'><required/></starttls>" % NS_TLS)
+        stanzas = []
+        while not stanzas:
+            stanzas = await self._read(reader, stream)
+        if stanzas[0].tag != '{%s}starttls' % NS_TLS:
+            raise xmpp_async.StreamError("Expected STARTTLS, got %s" % stanzas[0].tag)
+        writer.write(("<proceed xmlns='%s'/>" % NS_TLS).encode('utf-8'))
+        await xmpp_async.start_tls(writer, self.tls_context, server_side=True)
+        with self._lock:
+            self.encrypted += 1
+
+    async def _read(self, reader, stream):
+        data = await reader.read(16 * 1024)
+        if not data:
+            raise ConnectionError("client went away")
+        return stream.feed(data)
+
+    async def _authenticate(self, reader, writer, stream):
+        stanzas = []
+        while not stanzas:
+            stanzas = await self._read(reader, stream)
+        _, local, password = base64.b64decode(stanzas[0].text).decode('utf-8').split('\0')
+        if self.users.get(local) != password:
+            writer.write(("<failure xmlns='%s'><not-authorized/></failure>" % NS_SASL).encode('utf-8'))
+            return None
+        writer.write(("<success xmlns='%s'/>" % NS_SASL).encode('utf-8'))
+        return local
+
+    def _start(self, writer, stanza, local):
+        '''
+        Returns: The _Session bound or resumed by `stanza`, None if refused
+        '''
+
+        if stanza.tag != '{%s}resume' % NS_SM:
+            return self._bind(writer, stanza, local)
+
+        session = self._resumable.get(stanza.get('previd')) if self.allow_resume else None
+        if session is None:
+            writer.write(("<failed xmlns='%s'><item-not-found xmlns='urn:ietf:params:xml:ns:xmpp-stanzas'/>"
+                          "</failed>" % NS_SM).encode('utf-8'))
+            return None
+
+        session.acked(int(stanza.get('h')))
+        session.writer = writer
+        writer.write(("<resumed xmlns='%s' previd='%s' h='%d'/>" % (
+            NS_SM, session.sm_id, session.handled)).encode('utf-8'))
+        for data in session.unacked:
+            writer.write(data)
+        with self._lock:
+            self.resumptions += 1
+        return session
+
+    def _bind(self, writer, iq, local):
+        resource = iq.findtext('{%(bind)s}bind/{%(bind)s}resource' % dict(bind=NS_BIND)) or 'auto'
+        jid = '%s@%s/%s' % (local, self.domain, resource)
+        reply = CLIENT.iq(
+            etree.Element('{%s}bind' % NS_BIND, nsmap={None: NS_BIND}),
+            type='result', id=iq.get('id'))
+        etree.SubElement(reply[0], '{%s}jid' % NS_BIND).text = jid
+        writer.write(etree.tostring(reply))
+
+        old = self._clients.get(jid)
+        if old is not None and old.sm_id is not None:
+            del self._resumable[old.sm_id]
+        session = self._clients[jid] = _Session(jid, writer)
+        with self._lock:
+            self.sessions += 1
+        return session
+
+    def _send(self, session, data):
+        if session.sm_id is not None:
+            session.sent += 1
+            session.unacked.append(data)
+        if session.writer is not None:
+            session.writer.write(data)
+            if session.sm_id is not None:
+                session.writer.write(SM_REQUEST)
+
+    def _handle(self, session, stanza):
+        writer = session.writer
+        if stanza.tag == '{%s}enable' % NS_SM:
+            session.sm_id = 'sm-%d' % next(self._ids)
+            self._resumable[session.sm_id] = session
+            writer.write(("<enabled xmlns='%s' id='%s' resume='true'/>" % (
+                NS_SM, session.sm_id)).encode('utf-8'))
+            return
+        if stanza.tag == '{%s}r' % NS_SM:
+            writer.write(("<a xmlns='%s' h='%d'/>" % (NS_SM, session.handled)).encode('utf-8'))
+            return
+        if stanza.tag == '{%s}a' % NS_SM:
+            session.acked(int(stanza.get('h')))
+            return
+        if stanza.tag in STANZA_TAGS and session.sm_id is not None:
+            session.handled += 1
+
+        with self._lock:
+            self.received.setdefault(session.jid, []).append(stanza)
+
+        ping = stanza.find('{%s}ping' % NS_PING)
+        if stanza.tag == IQ_TAG and ping is not None and stanza.get('to') == self.domain:
+            with self._lock:
+                self.pings += 1
+            if self.answer_pings:
+                self._send(session, etree.tostring(CLIENT.iq(type='result', id=stanza.get('id'))))
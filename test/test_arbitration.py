@@ -0,0 +1,71 @@
+import itertools
+import random
+from datetime import timedelta
+from test.adr_event_generator import NOW, TEST_DB_ADDR, make_event
+from unittest import mock
+
+from freezegun import freeze_time
+
+from oadr2 import arbitration, controller, event
+
+def test_select_is_deterministic():
+    events = [
+        make_event("Low", NOW - timedelta(minutes=5), [3.0]).to_obj(),
+        make_event("First", NOW - timedelta(minutes=5), [1.0], priority=2).to_obj(),
+        make_event("Later", NOW - timedelta(minutes=1), [2.0], priority=2).to_obj(),
+        make_event("Second", NOW - timedelta(minutes=5), [1.0], priority=2).to_obj(),
+    ]
+    current = [(evt, evt.signals[0]) for evt in events]
+
+    # Priority first, then the event which started first, then level and ID
+    for candidates in itertools.permutations(current):
+        level, evt = arbitration.select(list(candidates))
+        assert (level, evt.id) == (1.0, "First")
+
+    assert arbitration.select(current[:1] + current[2:3]) == (2.0, events[2])
+    assert arbitration.select([]) == (0, None)
+
+
+def test_arbiter_matches_a_full_scan(tmpdir):
+    rng = random.Random(3)
+    events = []
+    for index in range(60):
+        evt = make_event(
+            "Evt%d" % index, NOW + timedelta(minutes=rng.randrange(120)), [float(rng.randrange(1, 4))],
+            priority=rng.randrange(1, 3), duration=timedelta(minutes=rng.randrange(1, 30)),
+            test_event=rng.random() < 0.1).to_obj()
+        if rng.random() < 0.2:
+            evt.cancel()
+        events.append(evt)
+    event_controller = controller.EventController(
+        event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir), start_thread=False)
+
+    arbiter = arbitration.Arbiter(events)
+    ended = []
+    for minute in range(0, 160):
+        now = NOW + timedelta(minutes=minute, seconds=rng.choice((0, 30)))
+        ended += arbiter.advance(now)
+        current, expired = event_controller._current_intervals(events, now)
+
+        assert arbiter.winner() == arbitration.select(current)
+        assert sorted(evt.id for evt, _ in arbiter.current()) == sorted(evt.id for evt, _ in current)
+        assert sorted(ended) == sorted(expired)
+
+
+def test_control_pass_loads_events_once(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, start_thread=False)
+    event_handler.db.add_event(make_event("First", NOW - timedelta(minutes=5), [1.0]).to_obj())
+    event_handler.db.add_event(make_event("Second", NOW + timedelta(minutes=20), [2.0], priority=2).to_obj())
+    load_events = mock.MagicMock(wraps=event_handler.db.get_active_events)
+    event_handler.db.get_active_events = load_events
+
+    for minute in range(0, 30):
+        with freeze_time(NOW + timedelta(minutes=minute, seconds=1)):
+            event_controller.tick()
+            level, event_id = event_controller.get_current_signal_level()
+        assert (event_controller.current_signal_level, event_controller.current_event_id) == (level, event_id)
+
+    assert event_controller.current_event_id == "Second"
+    # Removing "First" is applied to the loaded events, see test_changes.py
+    assert load_events.call_count == 1
@@ -0,0 +1,103 @@
+import time
+from datetime import datetime, timedelta
+from test.adr_event_generator import NOW, TEST_DB_ADDR, AdrEventStatus, generate_payload, make_event
+from unittest import mock
+
+from freezegun import freeze_time
+
+from oadr2 import controller, event
+
+def test_changes_are_recorded(tmpdir):
+    callback = mock.MagicMock()
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir, event_callback=callback)
+    changes = []
+    event_handler.subscribe(changes.append)
+
+    first = make_event("First", NOW - timedelta(minutes=1), [1.0])
+    second = make_event("Second", NOW + timedelta(minutes=5), [2.0], status=AdrEventStatus.PENDING)
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([first, second]))
+        event_handler.handle_payload(generate_payload([first, second]))  # nothing new
+        second.mod_number = 1
+        second.signals[0]["level"] = 3.0
+        event_handler.handle_payload(generate_payload([first, second]))
+        event_handler.handle_payload(generate_payload([second]))
+        event_handler.optout_event("Second")
+        event_handler.remove_events(["First"])
+
+    assert [[(change.kind, change.event_id) for change in batch] for batch in changes] == [
+        [(event.ADDED, "First"), (event.ADDED, "Second")],
+        [(event.MODIFIED, "Second")],
+        [(event.CANCELLED, "First")],
+        [(event.OPTED_OUT, "Second")],
+        [(event.REMOVED, "First")],
+    ]
+    records = [change for batch in changes for change in batch]
+    assert [change.generation for change in records] == list(range(1, 7))
+    assert records[2].event.signals[0].level == 3.0
+    assert records[3].event.status == "cancelled"
+    assert records[5].event is None
+    assert event_handler.generation == 6
+
+    # The callback gets the same changes as dicts
+    assert callback.call_count == 5
+    updated, removed = callback.call_args_list[1][0]
+    assert (list(updated), removed) == (["Second"], {})
+    updated, removed = callback.call_args_list[4][0]
+    assert (updated, removed) == ({}, {"First": None})
+
+
+def test_controller_applies_changes(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, start_thread=False)
+    first = make_event("First", NOW - timedelta(minutes=1), [1.0])
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([first]))
+        event_controller.tick()
+    load_events = mock.MagicMock(wraps=event_handler.db.get_active_events)
+    event_handler.db.get_active_events = load_events
+
+    high = make_event("High", NOW + timedelta(minutes=1), [5.0], priority=2)
+    with freeze_time(NOW + timedelta(minutes=2)):
+        event_handler.handle_payload(generate_payload([first, high]))
+        event_controller.tick()
+        assert (event_controller.current_signal_level, event_controller.current_event_id) == (5.0, "High")
+
+        event_handler.optout_event("High")
+        event_controller.tick()
+        assert (event_controller.current_signal_level, event_controller.current_event_id) == (1.0, "First")
+
+        # The same as loading them all again
+        reloaded = controller.EventController(event_handler, start_thread=False)
+        reloaded.tick()
+        assert [evt.id for evt in event_controller.active_events] == \
+            [evt.id for evt in reloaded.active_events] == ["First"]
+
+    # Only by handle_payload(), looking for implicitly cancelled events, and `reloaded`
+    assert load_events.call_count == 2
+
+    # A change missed while unsubscribed has the events loaded again
+    event_handler.unsubscribe(event_controller._events_changed)
+    with freeze_time(NOW + timedelta(minutes=3)):
+        event_handler.remove_events(["First"])
+        event_handler.subscribe(event_controller._events_changed)
+        event_handler.handle_payload(generate_payload([high]))
+        event_controller.tick()
+    assert load_events.call_count == 4
+    assert event_controller.active_events == []
+
+
+def test_change_wakes_control_loop(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, control_loop_interval=60)
+    try:
+        time.sleep(0.1)  # the first pass
+        now = datetime.utcnow()
+        event_handler.handle_payload(generate_payload([make_event("Evt", now - timedelta(minutes=1), [2.0])]))
+
+        deadline = time.time() + 5
+        while event_controller.current_signal_level != 2.0 and time.time() < deadline:
+            time.sleep(0.01)
+        assert event_controller.current_signal_level == 2.0
+    finally:
+        event_controller.exit()
@@ -1,5 +1,5 @@
 from datetime import datetime, timedelta
-from test.adr_event_generator import AdrEvent, AdrEventStatus, generate_payload
+from test.adr_event_generator import TEST_DB_ADDR, AdrEvent, AdrEventStatus, generate_payload
 from unittest import mock
 
 import pytest
@@ -9,8 +9,6 @@ from oadr2 import controller, event
 from oadr2.poll import OpenADR2
 from oadr2.schemas import NS_A
 
-TEST_DB_ADDR = "%s/test2.db"
-
 responseCode = 'pyld:eiCreatedEvent/ei:eiResponse/ei:responseCode'
 requestID = 'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse/pyld:requestID'
 optType = 'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse/ei:optType'
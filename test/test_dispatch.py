@@ -0,0 +1,158 @@
+import threading
+import time
+
+import pytest
+
+from oadr2 import dispatch
+
+
+@pytest.fixture
+def dispatcher():
+    pool = dispatch.OrderedDispatcher(workers=4, max_queued=100)
+    yield pool
+    pool.stop(timeout=5)
+
+
+def test_same_key_runs_in_order(dispatcher):
+    handled = []
+    running = []
+
+    def handle(key, index):
+        running.append(key)
+        assert running.count(key) == 1  # never two at once for one key
+        time.sleep(0.001)
+        handled.append((key, index))
+        running.remove(key)
+
+    for index in range(20):
+        for key in ("vtn_a", "vtn_b", "vtn_c"):
+            dispatcher.submit(key, handle, key, index)
+
+    assert dispatcher.join(timeout=10)
+    for key in ("vtn_a", "vtn_b", "vtn_c"):
+        assert [index for k, index in handled if k == key] == list(range(20))
+    assert dispatcher.stats()["processed"] == 60
+
+
+def test_stop_timeout_bounds_stuck_workers():
+    pool = dispatch.OrderedDispatcher(workers=4, max_queued=100)
+    release = threading.Event()
+    for key in ("vtn_a", "vtn_b", "vtn_c"):
+        pool.submit(key, release.wait, 10)
+
+    started = time.monotonic()
+    pool.stop(timeout=0.2)  # in all, not per worker
+    assert time.monotonic() - started < 0.5
+    with pytest.raises(RuntimeError):
+        pool.submit("vtn_a", release.wait, 10)
+    release.set()
+
+
+def test_different_keys_run_in_parallel(dispatcher):
+    barrier = threading.Barrier(2, timeout=5)
+
+    # Each job waits for the other, which would deadlock if run one at a time
+    dispatcher.submit("vtn_a", barrier.wait)
+    dispatcher.submit("vtn_b", barrier.wait)
+
+    assert dispatcher.join(timeout=10)
+    assert dispatcher.stats()["failed"] == 0
+
+
+def test_queue_depth_backpressure():
+    pool = dispatch.OrderedDispatcher(workers=1, max_queued=2)
+    release = threading.Event()
+    try:
+        pool.submit("vtn", release.wait)
+        assert pool.join(timeout=0.2) is False  # the worker is blocked
+
+        pool.submit("vtn", time.sleep, 0)
+        pool.submit("other", time.sleep, 0)
+        with pytest.raises(dispatch.QueueFull):
+            pool.submit("vtn", time.sleep, 0)
+
+        stats = pool.stats()
+        assert stats["queued"] == 2
+        assert stats["busy"] == 1
+        assert stats["rejected"] == 1
+        assert stats["max_queued"] == 2
+    finally:
+        release.set()
+        assert pool.join(timeout=5)
+        pool.stop(timeout=5)
+
+    assert pool.stats()["processed"] == 3
+
+
+def test_failing_job_does_not_block_key(dispatcher):
+    handled = []
+
+    dispatcher.submit("vtn", lambda: 1 / 0)
+    dispatcher.submit("vtn", handled.append, "next")
+
+    assert dispatcher.join(timeout=5)
+    assert handled == ["next"]
+    stats = dispatcher.stats()
+    assert stats["failed"] == 1
+    assert stats["processed"] == 1
+    assert stats["keys"] == 0
+
+
+def test_coalesces_changes_behind_a_slow_call():
+    callbacks = dispatch.CoalescingDispatcher(workers=2, timeout=None)
+    release = threading.Event()
+    delivered = []
+
+    def actuate(old, new):
+        delivered.append((old, new))
+        release.wait(5)
+
+    callbacks.submit("relay", actuate, 0, 1)
+    for level in (2, 3, 4):
+        callbacks.submit("relay", actuate, level - 1, level)
+    release.set()
+    assert callbacks.join(5)
+
+    assert delivered == [(0, 1), (1, 4)]
+    stats = callbacks.stats("relay")
+    assert (stats["submitted"], stats["delivered"], stats["coalesced"]) == (4, 2, 2)
+    assert stats["latency_max"] > 0
+    callbacks.stop(1)
+
+
+def test_forget_drops_key_stats():
+    callbacks = dispatch.CoalescingDispatcher(workers=2, timeout=None)
+    release = threading.Event()
+
+    callbacks.submit("relay_1", lambda old, new: None, 0, 1)
+    callbacks.submit("relay_2", lambda old, new: release.wait(5), 0, 1)
+    callbacks.forget("relay_1")
+    callbacks.forget("relay_2")  # still running
+    release.set()
+    assert callbacks.join(5)
+
+    assert callbacks._key_stats == {}
+    assert callbacks.stats("relay_2")["submitted"] == 0
+    assert callbacks.stats()["delivered"] == 2
+    callbacks.stop(1)
+
+
+def test_abandons_callback_past_timeout():
+    callbacks = dispatch.CoalescingDispatcher(workers=2, timeout=0.1)
+    release = threading.Event()
+    delivered = []
+
+    def actuate(old, new):
+        delivered.append((old, new))
+        if new == 1:
+            release.wait(5)  # a hung relay write
+
+    callbacks.submit("relay", actuate, 0, 1)
+    callbacks.submit("relay", actuate, 1, 2)
+    assert callbacks.join(2)
+
+    assert delivered == [(0, 1), (1, 2)]
+    assert callbacks.stats()["timed_out"] == 1
+    assert callbacks.stats()["delivered"] == 1
+    release.set()
+    callbacks.stop(1)
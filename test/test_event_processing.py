@@ -1,15 +1,15 @@
+import json
+import time
 from datetime import datetime, timedelta
-from test.adr_event_generator import AdrEvent, AdrEventStatus, generate_payload
+from test.adr_event_generator import NOW, TEST_DB_ADDR, AdrEvent, AdrEventStatus, generate_payload, make_event
 from unittest import mock
 
 import pytest
 from freezegun import freeze_time
 
-from oadr2 import controller, event
+from oadr2 import controller, dispatch, event, eventdb
 from oadr2.schemas import NS_A
 
-TEST_DB_ADDR = "%s/test2.db"
-
 scenario = dict(
     not_started=AdrEvent(
         id="FooEvent",
@@ -602,3 +602,207 @@ def test_event_object_random_cancellation():
     with freeze_time(now + timedelta(seconds=30)):
         test_event.cancel()
         assert cancellation_time < test_event.end < cancellation_time + timedelta(minutes=1)
+
+
+def test_current_signal_level_cached(tmpdir):
+    now = datetime(2030, 1, 1, 12, 0)
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, start_thread=False)
+    with freeze_time(now):
+        event_handler.handle_payload(generate_payload([AdrEvent(
+            id="FooEvent",
+            start=now - timedelta(minutes=5),
+            signals=[
+                dict(index=0, duration=timedelta(minutes=10), level=1.0),
+                dict(index=1, duration=timedelta(minutes=10), level=2.0),
+            ],
+            status=AdrEventStatus.ACTIVE,
+        )]))
+    load_events = mock.MagicMock(wraps=event_handler.db.get_events_between)
+    event_handler.db.get_events_between = load_events
+
+    with freeze_time(now):
+        for _ in range(10):
+            assert event_controller.get_current_signal_level() == (1.0, "FooEvent")
+    assert load_events.call_count == 1
+
+    # At the boundary the first interval still applies, right after it the second
+    with freeze_time(now + timedelta(minutes=5)):
+        assert event_controller.get_current_signal_level() == (1.0, "FooEvent")
+    with freeze_time(now + timedelta(minutes=5, seconds=1)):
+        assert event_controller.get_current_signal_level() == (2.0, "FooEvent")
+        assert event_controller.get_current_signal_level() == (2.0, "FooEvent")
+    assert load_events.call_count == 3
+
+    with freeze_time(now + timedelta(minutes=6)):
+        event_handler.optout_event("FooEvent")
+        assert event_controller.get_current_signal_level() == (0, None)
+        event_controller.events_updated()
+        assert event_controller.get_current_signal_level() == (0, None)
+        assert event_controller.get_current_signal_level() == (0, None)
+    assert load_events.call_count == 5
+
+    event_handler.remove_events(["FooEvent"])
+    with freeze_time(now + timedelta(minutes=6)):
+        assert event_controller.get_current_signal_level() == (0, None)
+    assert load_events.call_count == 6
+
+
+def test_slow_signal_callback_does_not_block_control(tmpdir):
+    levels = []
+
+    def slow_relay(old_level, new_level):
+        levels.append((old_level, new_level))
+        time.sleep(0.5)
+
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(
+        event_handler, signal_changed_callback=slow_relay, start_thread=False)
+
+    started = time.monotonic()
+    for level in (1.0, 2.0, 3.0):
+        event_controller._update_signal_level(level)
+    assert time.monotonic() - started < 0.5
+    assert event_controller.current_signal_level == 3.0
+
+    assert event_controller.callback_dispatcher.join(5)
+    assert levels == [(0, 1.0), (1.0, 3.0)]
+    assert event_controller.callback_stats()["coalesced"] == 1
+    event_controller.exit()
+
+
+def test_controls_resources_in_one_pass(tmpdir):
+    resources = ["relay_1", "relay_2", "relay_3"]
+    changes = []
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir, resource_ids=resources)
+    event_controller = controller.EventController(
+        event_handler, start_thread=False, resources=resources,
+        resource_changed_callback=lambda *change: changes.append(change))
+
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([
+            make_event("Everyone", NOW - timedelta(minutes=1), [1.0]),
+            make_event("Relay2", NOW - timedelta(minutes=1), [2.0], resource_ids=["relay_2"], priority=2),
+            make_event("Relay3Later", NOW + timedelta(minutes=5), [3.0], resource_ids=["relay_3"], priority=2),
+            make_event("NotOurs", NOW - timedelta(minutes=1), [4.0], resource_ids=["relay_9"], ven_ids=None),
+        ]))
+        assert {evt.id: evt.resource_ids for evt in event_handler.get_active_events()} == \
+            dict(Everyone=None, Relay2=["relay_2"], Relay3Later=["relay_3"])
+
+        event_controller.tick()
+
+    assert event_controller.resource_states == dict(
+        relay_1=controller.ResourceState(1.0, "Everyone", NOW + timedelta(minutes=9)),
+        relay_2=controller.ResourceState(2.0, "Relay2", NOW + timedelta(minutes=9)),
+        relay_3=controller.ResourceState(1.0, "Everyone", NOW + timedelta(minutes=5)),
+    )
+    assert event_controller.current_signal_level == 2.0
+
+    with freeze_time(NOW + timedelta(minutes=6)):
+        event_controller.tick()
+    assert event_controller.resource_states["relay_3"].level == 3.0
+
+    assert event_controller.callback_dispatcher.join(5)
+    assert sorted(changes) == [
+        ("relay_1", 0, 1.0), ("relay_2", 0, 2.0), ("relay_3", 0, 1.0), ("relay_3", 1.0, 3.0)]
+    assert event_controller.callback_stats("relay_3")["delivered"] == 2
+    event_controller.exit()
+
+
+def test_exit_forgets_keys_of_shared_dispatcher(tmpdir):
+    callbacks = dispatch.CoalescingDispatcher(workers=2, timeout=None)
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir, resource_ids=["relay_1"])
+    event_controller = controller.EventController(
+        event_handler, start_thread=False, resources=["relay_1"], callback_dispatcher=callbacks)
+
+    event_controller._update_signal_level(1.0)
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([make_event("Everyone", NOW - timedelta(minutes=1))]))
+        event_controller.tick()
+    assert callbacks.join(5)
+    assert len(callbacks._key_stats) == 2
+
+    event_controller.exit()
+    assert callbacks._key_stats == {}
+    assert callbacks.stats()["delivered"] == 2
+    callbacks.stop(1)
+
+
+def test_every_signal_parsed_and_evaluated(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, start_thread=False)
+
+    def priced_event(id_, price, priority=1):
+        return make_event(
+            id_, NOW - timedelta(minutes=5), duration=timedelta(minutes=20), priority=priority,
+            extra_signals=[
+                dict(name="ELECTRICITY_PRICE", type="price", id="Price", signals=[
+                    dict(index=0, duration=timedelta(minutes=10), level=price),
+                    dict(index=1, duration=timedelta(minutes=10), level=price * 2),
+                ]),
+                dict(name="LOAD_DISPATCH", type="x-loadControlCapacity", id="Capacity", signals=[
+                    dict(index=0, duration=timedelta(minutes=20), level=0.5),
+                ]),
+            ],
+        )
+
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([priced_event("Cheap", 0.1), priced_event("Dear", 0.3, 2)]))
+
+        stored = event_handler.db.get_event("Cheap")
+        assert [(signal.name, signal.type, signal.id) for signal in stored.event_signals] == [
+            ("simple", "level", "SignalID"),
+            ("ELECTRICITY_PRICE", "price", "Price"),
+            ("LOAD_DISPATCH", "x-loadControlCapacity", "Capacity"),
+        ]
+        assert [interval.level for interval in stored.get_signals_of_type("price")[0].intervals] == [0.1, 0.2]
+        assert stored.event_signals[0].current_value == 0.0
+        assert [signal.level for signal in stored.signals] == [1.0]
+        # The simple signal's intervals are only kept in the signals table
+        assert stored.event_signals[0].intervals == stored.signals
+        row = event_handler.db.session.query(eventdb.Event).filter_by(id="Cheap").one()
+        assert json.loads(row._event_signals)[0][4] is None
+
+        event_controller.tick()
+        assert event_controller.current_signals == {
+            "level": controller.SignalValue(1.0, "Dear", "SignalID"),
+            "price": controller.SignalValue(0.3, "Dear", "Price"),
+            "x-loadControlCapacity": controller.SignalValue(0.5, "Dear", "Capacity"),
+        }
+        assert event_controller.forecast(hours=1, signal_type="price").levels == [0.3, 0.6, 0]
+        assert event_controller.forecast(hours=1, signal_type="setpoint").levels == [0]
+
+    with freeze_time(NOW + timedelta(minutes=16)):
+        event_controller.tick()
+    assert event_controller.current_signals == {}
+
+
+def test_level_of_many_scheduled_events(tmpdir):
+    now = datetime(2030, 1, 1, 12, 0)
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, start_thread=False)
+    for index in range(200):
+        event_handler.db.add_event(AdrEvent(
+            id=f"Day{index}",
+            start=now + timedelta(days=index, hours=1),
+            signals=[dict(index=0, duration=timedelta(hours=2), level=float(index % 3 + 1))],
+            status=AdrEventStatus.PENDING,
+        ).to_obj())
+    load_events = mock.MagicMock(wraps=event_handler.db.get_events_between)
+    event_handler.db.get_events_between = load_events
+
+    with freeze_time(now):
+        assert event_controller.get_current_signal_level() == (0, None)
+        assert [evt.id for evt in event_handler.get_events_between(now, now + timedelta(days=2))] == \
+            ["Day0", "Day1"]
+
+    # Cached until the first event starts, then only it is loaded
+    with freeze_time(now + timedelta(minutes=59)):
+        assert event_controller.get_current_signal_level() == (0, None)
+    assert load_events.call_count == 2
+    with freeze_time(now + timedelta(days=5, hours=2)):
+        assert event_controller.get_current_signal_level() == (3.0, "Day5")
+        assert [evt.id for evt in event_handler.get_events_at(datetime.utcnow())] == ["Day5"]
+
+    event_handler.remove_events(["Day6"])
+    assert event_handler.next_event_start(now + timedelta(days=5, hours=2)) == now + timedelta(days=7, hours=1)
@@ -0,0 +1,77 @@
+from datetime import datetime, timedelta
+from test.adr_event_generator import AdrEvent, AdrEventStatus
+from test.mock_vtn import MockVTN
+
+import pytest
+
+from oadr2 import fleet
+
+
+@pytest.fixture
+def vtn():
+    vtn = MockVTN(events=[AdrEvent(
+        id="FooEvent",
+        start=datetime.utcnow().replace(microsecond=0) + timedelta(minutes=5),
+        signals=[dict(index=0, duration=timedelta(minutes=10), level=1.0)],
+        status=AdrEventStatus.PENDING,
+    )])
+    vtn.start()
+    yield vtn
+    vtn.stop()
+
+
+@pytest.fixture
+def make_fleet(tmpdir):
+    fleets = []
+
+    def make_fleet(**kwargs):
+        kwargs.setdefault('host_opts', dict(workers=2, startup_spread=0))
+        fleets.append(fleet.Fleet(str(tmpdir), heartbeat_interval=0.1, **kwargs))
+        return fleets[-1]
+
+    yield make_fleet
+    for ven_fleet in fleets:
+        ven_fleet.exit()
+
+
+def test_shard_for_is_stable():
+    shards = [fleet.shard_for(f"VEN_{index}", 4) for index in range(100)]
+
+    assert shards == [fleet.shard_for(f"VEN_{index}", 4) for index in range(100)]
+    assert set(shards) == {0, 1, 2, 3}
+
+
+def test_fleet_runs_vens_across_processes(vtn, make_fleet):
+    ven_fleet = make_fleet(shards=2)
+    for index in range(6):
+        ven_fleet.add_ven(f"VEN_{index}", vtn.base_uri, vtn_poll_interval=60)
+    ven_fleet.start()
+
+    assert vtn.wait_for(lambda: ven_fleet.stats()['polls'] >= 6, timeout=30)
+    stats = ven_fleet.stats()
+    assert stats['vens'] == 6
+    assert stats['alive'] == 2
+    assert stats['parse_cache']['misses'] == 2  # parsed once per shard
+    assert len({shard['pid'] for shard in stats['per_shard']}) == 2
+    assert sum(shard['assigned'] for shard in stats['per_shard']) == 6
+    assert {created.findtext('{*}eiCreatedEvent/{*}venID') for created in vtn.created_events} \
+        == {f"VEN_{index}" for index in range(6)}
+
+    with pytest.raises(RuntimeError):
+        ven_fleet.add_ven("VEN_late", vtn.base_uri)
+
+
+def test_supervisor_restarts_dead_shard(vtn, make_fleet, monkeypatch):
+    monkeypatch.setattr(fleet, 'RESTART_DELAY', 0.1)
+    ven_fleet = make_fleet(shards=1)
+    ven_fleet.add_ven("VEN_0", vtn.base_uri, vtn_poll_interval=60)
+    ven_fleet.start()
+    assert vtn.wait_for(lambda: ven_fleet.stats()['polls'] >= 1, timeout=30)
+
+    first_pid = ven_fleet.shards[0].pid
+    ven_fleet.shards[0].process.kill()
+
+    assert vtn.wait_for(lambda: ven_fleet.stats()['restarts'] == 1, timeout=10)
+    assert vtn.wait_for(lambda: ven_fleet.stats()['polls'] >= 1, timeout=30)
+    assert ven_fleet.shards[0].pid != first_pid
+    assert ven_fleet.stats()['alive'] == 1
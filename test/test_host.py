@@ -0,0 +1,174 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from test.adr_event_generator import TEST_DB_ADDR, AdrEventStatus, generate_payload, make_event
+from test.mock_vtn import MockVTN
+
+import pytest
+from lxml import etree
+
+from oadr2 import eventdb, host
+from oadr2.schemas import NS_A
+
+def pending_event(id_="FooEvent", **kwargs):
+    return make_event(
+        id_, datetime.utcnow().replace(microsecond=0) + timedelta(minutes=5), status=AdrEventStatus.PENDING, **kwargs)
+
+
+def ei_event(evt):
+    return generate_payload([evt]).find('oadr:oadrEvent/ei:eiEvent', namespaces=NS_A)
+
+
+def test_parse_cache_shares_parsed_events():
+    cache = host.EventParseCache()
+    evt = pending_event()
+    first = cache.parse(ei_event(evt))
+    second = cache.parse(ei_event(evt))
+
+    assert cache.stats() == dict(size=1, hits=1, misses=1)
+    assert first == second
+    second.cancel()
+    assert cache.parse(ei_event(evt)).status == first.status != "cancelled"
+
+
+def test_parse_cache_randomizes_start_per_copy():
+    cache = host.EventParseCache()
+    xml = ei_event(pending_event(start_after=timedelta(hours=1)))
+
+    events = [cache.parse(xml) for _ in range(10)]
+
+    assert cache.stats()["hits"] == 9
+    assert len({evt.start for evt in events}) > 1
+    for evt in events:
+        assert evt.original_start <= evt.start <= evt.original_start + timedelta(hours=1)
+        assert evt.end - evt.start == timedelta(minutes=10)
+
+
+def test_db_namespaces_share_engine(tmpdir):
+    engine = eventdb.create_shared_engine(TEST_DB_ADDR % tmpdir)
+    ven_a = eventdb.DBHandler(engine=engine, namespace="VEN_A")
+    ven_b = eventdb.DBHandler(engine=engine, namespace="VEN_B")
+    evt = host.EventParseCache().parse(ei_event(pending_event()))
+
+    ven_a.add_event(evt)
+    ven_b.add_event(evt)
+    ven_a.remove_events([evt.id])
+
+    assert ven_a.get_active_events() == []
+    assert [e.id for e in ven_b.get_active_events()] == ["FooEvent"]
+    assert ven_b.get_active_events()[0].signals == evt.signals
+    engine.dispose()
+
+
+def test_db_migrates_legacy_tables(tmpdir):
+    db_path = TEST_DB_ADDR % tmpdir
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE events (id VARCHAR NOT NULL, mod_number INTEGER NOT NULL, _start VARCHAR,
+            _original_start VARCHAR, _end VARCHAR, cancellation_offset VARCHAR, status VARCHAR,
+            priority INTEGER, test_event BOOLEAN, PRIMARY KEY (id));
+        CREATE UNIQUE INDEX ix_events_id ON events (id);
+        CREATE TABLE signals (event_id VARCHAR NOT NULL, "index" INTEGER NOT NULL, duration VARCHAR,
+            level FLOAT, PRIMARY KEY (event_id, "index"), FOREIGN KEY(event_id) REFERENCES events (id));
+        INSERT INTO events VALUES ('Old', 2, '2020-01-01T00:00:00', '2020-01-01T00:00:00', NULL,
+            NULL, 'far', 1, 0);
+        INSERT INTO signals VALUES ('Old', 0, 'PT1H', 3.0);
+    ''')
+    conn.close()
+
+    db = eventdb.DBHandler(db_path)
+
+    events = db.get_active_events()
+    assert [(evt.id, evt.mod_number) for evt in events] == [("Old", 2)]
+    assert events[0].signals[0].level == 3.0
+    assert eventdb.DBHandler(db_path, namespace="other").get_active_events() == []
+
+
+def test_db_adds_new_columns(tmpdir):
+    db_path = TEST_DB_ADDR % tmpdir
+    conn = sqlite3.connect(db_path)
+    conn.executescript('''
+        CREATE TABLE events (namespace VARCHAR NOT NULL, id VARCHAR NOT NULL, mod_number INTEGER NOT NULL,
+            _start VARCHAR, _original_start VARCHAR, _end VARCHAR, cancellation_offset VARCHAR,
+            status VARCHAR, priority INTEGER, test_event BOOLEAN, PRIMARY KEY (namespace, id));
+        CREATE TABLE signals (namespace VARCHAR NOT NULL, event_id VARCHAR NOT NULL, "index" INTEGER NOT NULL,
+            duration VARCHAR, level FLOAT, PRIMARY KEY (namespace, event_id, "index"));
+        INSERT INTO events VALUES ('', 'Old', 2, '2020-01-01T00:00:00', '2020-01-01T00:00:00', NULL,
+            NULL, 'far', 1, 0);
+    ''')
+    conn.close()
+
+    db = eventdb.DBHandler(db_path)
+    evt = host.EventParseCache().parse(ei_event(pending_event("New", resource_ids=["relay_1"])))
+    db.add_event(evt)
+
+    assert [(evt.id, evt.resource_ids) for evt in db.get_active_events()] == [("Old", None), ("New", ["relay_1"])]
+    assert [[signal.type for signal in evt.event_signals] for evt in db.get_active_events()] == [[], ["level"]]
+
+
+@pytest.fixture
+def vtn():
+    vtn = MockVTN(events=[pending_event("Everyone", ven_ids=None), pending_event("OnlyA", ven_ids=["VEN_0"])])
+    vtn.start()
+    yield vtn
+    vtn.stop()
+
+
+def oadr2_threads():
+    return {thread for thread in threading.enumerate() if thread.name.startswith("oadr2")}
+
+
+def test_host_runs_many_vens(vtn, tmpdir):
+    threads_before = oadr2_threads()
+    ven_host = host.VENHost(TEST_DB_ADDR % tmpdir, workers=4, startup_spread=0)
+    try:
+        vens = [ven_host.add_ven(f"VEN_{index}", vtn.base_uri, vtn_poll_interval=60) for index in range(10)]
+
+        assert vtn.wait_for(lambda: len(vtn.created_events) >= 10, timeout=10)
+        # a scheduler thread plus the workers, however many VENs
+        assert len(oadr2_threads() - threads_before) <= 1 + ven_host.workers
+
+        assert ven_host.parse_cache.stats()["misses"] == 2
+        assert ven_host.parse_cache.stats()["hits"] == 18
+        assert [evt.id for evt in vens[0].event_handler.get_active_events()] == ["Everyone", "OnlyA"]
+        for ven in vens[1:]:
+            assert [evt.id for evt in ven.event_handler.get_active_events()] == ["Everyone"]
+
+        vens[1].event_handler.optout_event("Everyone")
+        assert vens[1].event_handler.get_active_events() == []
+        assert [evt.id for evt in vens[2].event_handler.get_active_events()] == ["Everyone"]
+
+        assert ven_host.stats()["polls"] >= 10
+        ven_host.remove_ven("VEN_9")
+        assert ven_host.stats()["vens"] == 9
+    finally:
+        ven_host.exit()
+
+    created = vtn.created_events[0]
+    assert etree.QName(created).localname == "oadrCreatedEvent"
+
+
+def test_updating_poll_moves_the_control_pass(tmpdir):
+    ven_host = host.VENHost(TEST_DB_ADDR % tmpdir, workers=4, startup_spread=0)
+    try:
+        ven = ven_host.add_ven("VEN_ID", "http://127.0.0.1:1/")
+        running = []
+        overlaps = []
+
+        def tick():
+            running.append(None)
+            overlaps.append(len(running) > 1)
+            time.sleep(0.02)
+            running.pop()
+
+        # Every poll brings new events, and each asks for a control pass
+        ven.query_vtn = lambda: True
+        ven._poll_delay = lambda elapsed, updated: 0.01
+        ven.event_controller.tick = tick
+        time.sleep(0.5)
+    finally:
+        ven_host.exit()
+
+    assert ven_host.stats()["updates"] > 10
+    assert len(overlaps) > 5 and not any(overlaps)
@@ -0,0 +1,57 @@
+import random
+from datetime import datetime, timedelta
+
+from oadr2 import intervals
+
+START = datetime(2030, 1, 1)
+
+
+def minutes(count):
+    return START + timedelta(minutes=count)
+
+
+def test_queries_match_brute_force():
+    rng = random.Random(7)
+    index = intervals.IntervalIndex(seed=1)
+    ranges = {}
+
+    for _ in range(2000):
+        key = "evt%d" % rng.randrange(300)
+        if rng.random() < 0.25:
+            index.remove(key)
+            ranges.pop(key, None)
+        else:  # add, or move an existing one
+            start = minutes(rng.randrange(10000))
+            end = None if rng.random() < 0.05 else start + timedelta(minutes=rng.randrange(200))
+            index.add(key, start, end)
+            ranges[key] = (start, end)
+
+        if rng.random() < 0.1:
+            low = minutes(rng.randrange(10000))
+            high = low + timedelta(minutes=rng.randrange(300))
+            expected = sorted(
+                (start, key) for key, (start, end) in ranges.items()
+                if start <= high and (end is None or end >= low)
+            )
+            assert index.overlapping(low, high) == [key for _, key in expected]
+            assert set(index.at(low)) == {
+                key for key, (start, end) in ranges.items() if start <= low and (end is None or end >= low)}
+            assert index.next_start(low) == min(
+                (start for start, _ in ranges.values() if start > low), default=None)
+
+    assert len(index) == len(ranges)
+    assert all(index.get(key) == value for key, value in ranges.items())
+
+
+def test_closed_ranges():
+    index = intervals.IntervalIndex()
+    index.add("a", minutes(0), minutes(10))
+    index.add("b", minutes(10), None)
+
+    assert index.at(minutes(10)) == ["a", "b"]
+    assert index.at(minutes(10000)) == ["b"]
+    assert index.overlapping(minutes(-5), minutes(-1)) == []
+    assert "a" in index
+    index.remove("a")
+    index.remove("a")
+    assert "a" not in index and index.at(minutes(5)) == []
@@ -0,0 +1,150 @@
+import json
+import socket
+from datetime import datetime, timedelta
+from test.adr_event_generator import NOW, TEST_DB_ADDR, AdrEvent, AdrEventStatus
+from unittest import mock
+
+import pytest
+from freezegun import freeze_time
+
+from oadr2 import controller, event, localapi
+
+@pytest.fixture
+def api(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, start_thread=False)
+    for evt in (
+        AdrEvent(
+            id="Active",
+            start=NOW - timedelta(minutes=5),
+            signals=[
+                dict(index=0, duration=timedelta(minutes=10), level=1.0),
+                dict(index=1, duration=timedelta(minutes=10), level=2.0),
+            ],
+            status=AdrEventStatus.ACTIVE,
+        ),
+        AdrEvent(
+            id="Later",
+            start=NOW + timedelta(hours=2),
+            signals=[dict(index=0, duration=timedelta(minutes=30), level=3.0)],
+            status=AdrEventStatus.PENDING,
+        ),
+    ):
+        event_handler.db.add_event(evt.to_obj())
+    with freeze_time(NOW):
+        event_controller.tick()
+
+    api = localapi.LocalAPI(str(tmpdir.join("api.sock")), event_handler, event_controller)
+    yield api
+    api.exit()
+
+
+class Client(object):
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(5)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rb')
+
+    def send(self, *requests):
+        self.sock.sendall(b''.join(
+            (request if isinstance(request, bytes) else json.dumps(request).encode()) + b'\n'
+            for request in requests))
+        return [json.loads(self.file.readline()) for _ in requests]
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+def test_queries(api):
+    client = Client(api.path)
+    with freeze_time(NOW):
+        level, events, upcoming, soon, forecast = client.send(
+            dict(id=1, method="level"),
+            dict(id=2, method="events"),
+            dict(id=3, method="schedule"),
+            dict(id=4, method="schedule", params=dict(horizon=3600)),
+            dict(id=5, method="forecast", params=dict(hours=3)),
+        )
+    client.close()
+
+    assert level == dict(id=1, result=dict(
+        level=1.0, event_id="Active", next_change="2030-01-01T12:05:00.000000Z"))
+    assert [evt["id"] for evt in events["result"]] == ["Active", "Later"]
+    assert events["result"][0]["intervals"][1] == dict(
+        index=1, start="2030-01-01T12:05:00.000000Z", end="2030-01-01T12:15:00.000000Z", level=2.0)
+    assert [(item["event_id"], item["index"]) for item in upcoming["result"]] == \
+        [("Active", 0), ("Active", 1), ("Later", 0)]
+    assert [(item["event_id"], item["index"]) for item in soon["result"]] == [("Active", 0), ("Active", 1)]
+    assert forecast["result"]["levels"] == [1.0, 2.0, 0, 3.0, 0]
+    assert forecast["result"]["event_ids"] == ["Active", "Active", None, "Later", None]
+    assert forecast["result"]["times"][0] == (NOW - datetime(1970, 1, 1)).total_seconds()
+
+
+def test_optout(api):
+    api.event_controller.events_updated = mock.MagicMock()
+    client = Client(api.path)
+
+    first, missing, events = client.send(
+        dict(id="a", method="optout", params=dict(event_id="Later")),
+        dict(id="b", method="optout", params=dict(event_id="Missing")),
+        dict(id="c", method="events"),
+    )
+    client.close()
+
+    assert first == dict(id="a", result=dict(opted_out=True))
+    assert missing == dict(id="b", result=dict(opted_out=False))
+    assert [evt["id"] for evt in events["result"]] == ["Active"]
+    api.event_controller.events_updated.assert_called_once_with()
+
+
+def test_errors(api):
+    client = Client(api.path)
+
+    responses = client.send(
+        b"not json",
+        dict(id=1, method="reboot"),
+        dict(id=2, method="optout", params=dict(nope=1)),
+        dict(id=3, method="level", params=[1]),
+    )
+
+    assert [response["error"]["code"] for response in responses] == \
+        ["bad-request", "unknown-method", "bad-params", "bad-request"]
+    assert [response["id"] for response in responses] == [None, 1, 2, 3]
+    assert client.send(dict(id=4, method="level"))[0]["result"]["level"] == 1.0
+
+    responses = client.send(
+        dict(id=5, method="schedule", params=dict(horizon="soon")),
+        dict(id=6, method="forecast", params=dict(hours=-1)),
+        dict(id=7, method="forecast", params=dict(hours=True)),
+        dict(id=8, method="optout", params=dict(event_id=["FooEvent"])),
+    )
+    assert [response["error"]["code"] for response in responses] == ["bad-params"] * 4
+
+    client.sock.sendall(b"x" * (localapi.MAX_REQUEST_SIZE + 10) + b"\n")
+    assert json.loads(client.file.readline())["error"]["code"] == "too-large"
+    assert client.file.readline() == b""
+    client.close()
+
+
+def test_many_clients(api):
+    clients = [Client(api.path) for _ in range(50)]
+    for index, client in enumerate(clients):
+        client.sock.sendall(json.dumps(dict(id=index, method="level")).encode() + b"\n")
+
+    assert [json.loads(client.file.readline())["id"] for client in clients] == list(range(50))
+    assert api.clients == 50
+    for client in clients:
+        client.close()
+
+
+def test_method_errors_are_internal(api, caplog):
+    client = Client(api.path)
+    with mock.patch.object(api.event_controller, "forecast", side_effect=TypeError("broken")):
+        response, = client.send(dict(id=1, method="forecast", params=dict(hours=1)))
+
+    assert response["error"] == dict(code="internal", message="broken")
+    assert "Local API error: broken" in caplog.text
+    client.close()
@@ -0,0 +1,96 @@
+import itertools
+import time
+from datetime import timedelta
+from test.adr_event_generator import NOW, TEST_DB_ADDR, AdrEvent, AdrEventStatus, generate_payload
+
+import pytest
+from freezegun import freeze_time
+
+from oadr2 import controller, event
+
+numpy = pytest.importorskip("numpy")
+optimize = pytest.importorskip("oadr2.optimize")
+
+def brute_force(prices, device, step_hours):
+    best = None
+    powers = [device.max_power * k / device.power_steps for k in range(device.power_steps + 1)]
+    for schedule in itertools.product(powers, repeat=len(prices)):
+        if sum(schedule) * step_hours < device.energy - 1e-9:
+            continue
+        cost = sum(price * power * step_hours for price, power in zip(prices, schedule))
+        cost += device.start_cost * sum(
+            1 for previous, power in zip((0,) + schedule, schedule) if power and not previous)
+        if best is None or cost < best - 1e-9:
+            best = cost
+    return best
+
+
+@pytest.mark.parametrize("power_steps, start_cost", [(1, 0.0), (1, 3.0), (2, 0.0), (2, 1.5)])
+def test_solve_finds_cheapest_schedule(power_steps, start_cost):
+    random = numpy.random.RandomState(power_steps)
+    for _ in range(10):
+        prices = random.uniform(-1, 10, 7)
+        device = optimize.Device(3.0, 2.0, power_steps=power_steps, start_cost=start_cost)
+
+        powers, cost = optimize.solve(prices, device, 0.5)
+
+        assert powers.sum() * 0.5 >= device.energy - 1e-9
+        assert cost == pytest.approx(brute_force(prices, device, 0.5))
+
+
+def test_solve_limits():
+    powers, cost = optimize.solve([5.0, 1.0], optimize.Device(0, 1.0), 1.0)
+    assert list(powers) == [0, 0] and cost == 0
+
+    with pytest.raises(optimize.OptimizerError):
+        optimize.solve([1.0, 1.0], optimize.Device(3.0, 1.0), 1.0)
+
+    # A day at 1 minute steps is quick enough to solve on every event update
+    prices = numpy.random.RandomState(0).uniform(0, 10, 24 * 60)
+    started = time.monotonic()
+    powers, cost = optimize.solve(prices, optimize.Device(40.0, 7.2, power_steps=2, start_cost=0.5), 1 / 60)
+    assert time.monotonic() - started < 5
+    assert powers.sum() / 60 >= 40.0
+
+
+def test_controller_emits_setpoints(tmpdir):
+    setpoints = []
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    shifter = optimize.LoadShifter(
+        optimize.Device(1.0, 2.0, deadline=NOW + timedelta(hours=3)), default_price=5.0)
+    event_controller = controller.EventController(
+        event_handler, start_thread=False, optimizer=shifter,
+        setpoint_changed_callback=lambda *change: setpoints.append(change))
+
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([AdrEvent(
+            id="Prices",
+            start=NOW,
+            signals=[
+                dict(index=0, duration=timedelta(minutes=60), level=10.0),
+                dict(index=1, duration=timedelta(minutes=30), level=1.0),
+                dict(index=2, duration=timedelta(minutes=90), level=10.0),
+            ],
+            status=AdrEventStatus.ACTIVE,
+            signal_type="price",
+        )]))
+        event_controller.tick()
+    assert event_controller.current_setpoint == 0
+    assert shifter.plan.cost == pytest.approx(1.0)
+
+    for minute in (61, 75):
+        with freeze_time(NOW + timedelta(minutes=minute)):
+            event_controller.tick()
+    assert event_controller.current_setpoint == 2.0
+
+    # Half the energy was delivered when the prices went away
+    with freeze_time(NOW + timedelta(minutes=75)):
+        event_handler.optout_event("Prices")
+        event_controller.tick()
+    assert shifter.delivered == pytest.approx(0.5)
+    assert shifter.plan.powers.sum() / 60 == pytest.approx(0.5)
+    assert shifter.plan.cost == pytest.approx(2.5)
+
+    assert event_controller.callback_dispatcher.join(5)
+    assert setpoints[0] == (0, 2.0)
+    event_controller.exit()
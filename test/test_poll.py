@@ -0,0 +1,214 @@
+import time
+from datetime import timedelta
+from test.adr_event_generator import TEST_DB_ADDR, AdrEventStatus, generate_payload, make_event
+from test.mock_vtn import MockVTN, Scenario, benchmark
+from unittest import mock
+
+import pytest
+from lxml import etree
+
+from oadr2 import poll
+from oadr2.schemas import NS_A
+
+requestID = 'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse/pyld:requestID'
+
+test_event = make_event(duration=timedelta(seconds=10), status=AdrEventStatus.PENDING)
+
+
+def distribute(request_id, events=(test_event,)):
+    payload = generate_payload(list(events))
+    payload.find("pyld:requestID", namespaces=NS_A).text = request_id
+    return etree.tostring(payload)
+
+
+def response(body, chunk_size=1000, headers=None):
+    resp = mock.MagicMock()
+    resp.headers = headers or {}
+    resp.iter_content.side_effect = lambda size: (
+        body[offset:offset + chunk_size] for offset in range(0, len(body), chunk_size)
+    )
+    return resp
+
+
+def make_client(tmpdir):
+    return poll.OpenADR2(
+        event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir),
+        vtn_base_uri="http://localhost:8080/oadr2-vtn",
+        control_opts=dict(start_thread=False),
+        start_thread=False,
+    )
+
+
+def test_payload_fingerprint_ignores_request_id():
+    first = etree.fromstring(distribute("request_1"))
+    second = etree.fromstring(distribute("request_2"))
+
+    assert poll.payload_fingerprint(first) == poll.payload_fingerprint(second)
+    assert first.findtext("pyld:requestID", namespaces=NS_A) == "request_1"
+
+
+def test_payload_fingerprint_detects_changes():
+    changed_event = make_event(duration=timedelta(seconds=10), status=AdrEventStatus.PENDING, mod_number=1)
+    first = etree.fromstring(distribute("request_1"))
+    second = etree.fromstring(distribute("request_1", [changed_event]))
+
+    assert poll.payload_fingerprint(first) != poll.payload_fingerprint(second)
+
+
+def test_query_vtn_short_circuits_unchanged_payload(tmpdir):
+    client = make_client(tmpdir)
+    handle_payload = mock.MagicMock(wraps=client.event_handler.handle_payload)
+    client.event_handler.handle_payload = handle_payload
+
+    with mock.patch("oadr2.poll.requests.post") as post:
+        post.return_value = response(distribute("request_1"))
+        client.query_vtn()
+        first_reply = etree.fromstring(post.call_args[1]["data"])
+
+        post.return_value = response(distribute("request_2"))
+        client.query_vtn()
+        second_reply = etree.fromstring(post.call_args[1]["data"])
+
+    handle_payload.assert_called_once()
+    assert first_reply.findtext(requestID, namespaces=NS_A) == "request_1"
+    assert second_reply.findtext(requestID, namespaces=NS_A) == "request_2"
+
+
+def test_query_vtn_reprocesses_after_optout(tmpdir):
+    client = make_client(tmpdir)
+    handle_payload = mock.MagicMock(wraps=client.event_handler.handle_payload)
+    client.event_handler.handle_payload = handle_payload
+
+    with mock.patch("oadr2.poll.requests.post") as post:
+        post.return_value = response(distribute("request_1"))
+        client.query_vtn()
+
+        client.event_handler.optout_event("FooEvent")
+        client.query_vtn()
+        reply = etree.fromstring(post.call_args[1]["data"])
+
+    assert handle_payload.call_count == 2
+    assert reply.findtext(
+        'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse/ei:optType', namespaces=NS_A
+    ) == "optOut"
+
+
+def test_query_vtn_streams_response_into_parser(tmpdir):
+    client = make_client(tmpdir)
+    parser = client._parser
+
+    with mock.patch("oadr2.poll.requests.post") as post:
+        post.return_value = response(distribute("request_1"), chunk_size=100)
+        assert client.query_vtn()
+
+    assert post.call_args_list[0][1]["stream"] is True
+    post.return_value.close.assert_called_once()
+    assert client._parser is parser
+    assert [evt.id for evt in client.event_handler.get_active_events()] == ["FooEvent"]
+
+
+@pytest.mark.parametrize(
+    "body, headers",
+    [
+        pytest.param(b"<a>" + b"x" * 10000 + b"</a>", None, id="streamed body too large"),
+        pytest.param(b"<a/>", {"Content-Length": "10000"}, id="declared length too large"),
+        pytest.param(b"<a><b></a>", None, id="malformed"),
+    ]
+)
+def test_query_vtn_rejects_bad_response(body, headers, tmpdir):
+    client = make_client(tmpdir)
+    client.max_response_size = 5000
+    handle_payload = mock.MagicMock(return_value=None)
+    client.event_handler.handle_payload = handle_payload
+
+    with mock.patch("oadr2.poll.requests.post") as post:
+        post.return_value = response(body, headers=headers)
+        assert not client.query_vtn()
+
+        # the parser is reset and reusable after a failure
+        post.return_value = response(distribute("request_1"))
+        assert client.query_vtn()
+
+    handle_payload.assert_called_once()
+
+
+def test_poll_delay_falls_back_to_interval(tmpdir):
+    client = make_client(tmpdir)
+    client.long_poll_timeout = 30
+    interval = client.vtn_poll_interval * (1 - poll.POLLING_JITTER)
+
+    # Held for the whole wait, or until something changed
+    assert client._poll_delay(elapsed=29, updated=False) == 0
+    assert client._poll_delay(elapsed=10, updated=True) == 0
+    assert client._poll_delay(elapsed=0.1, updated=True) == poll.LONG_POLL_RETRY_DELAY
+    assert client._poll_delay(elapsed=0.1, updated=False) >= interval
+    # Just slow, unless the VTN says it held the request
+    assert client._poll_delay(elapsed=10, updated=False) >= interval
+    client._poll_confirmed = True
+    assert client._poll_delay(elapsed=0.1, updated=False) == 0
+
+    client.long_poll_timeout = None
+    assert client._poll_delay(elapsed=10, updated=True) >= \
+        client.vtn_poll_interval * (1 - poll.POLLING_JITTER)
+
+
+def test_failed_long_polls_back_off(tmpdir):
+    client = make_client(tmpdir)
+    client.long_poll_timeout = 30
+
+    with mock.patch("oadr2.poll.requests.post") as post:
+        post.return_value = response(b"")
+        post.return_value.ok = False
+        post.return_value.status_code = 503
+        delays = []
+        for _ in range(12):
+            assert not client.query_vtn()
+            # However long the VTN took to fail
+            delays.append(client._poll_delay(elapsed=10, updated=False))
+
+        post.return_value = response(distribute("request_1"), headers={"Preference-Applied": "wait=30"})
+        assert client.query_vtn()
+        assert client._poll_delay(elapsed=0.1, updated=True) == 0
+
+    assert poll.LONG_POLL_RETRY_DELAY * (1 - poll.POLLING_JITTER) <= delays[0] <= \
+        poll.LONG_POLL_RETRY_DELAY * (1 + poll.POLLING_JITTER)
+    assert all(earlier < later for earlier, later in zip(delays[:8], delays[1:9]))
+    assert delays[-1] <= client.vtn_poll_interval * (1 + poll.POLLING_JITTER)
+
+    with mock.patch("oadr2.poll.requests.post", side_effect=ConnectionError("refused")):
+        assert not client.query_vtn()
+    assert client._poll_delay(elapsed=10, updated=False) == pytest.approx(poll.LONG_POLL_RETRY_DELAY, rel=0.2)
+
+
+def test_long_poll_delivers_event_without_waiting_for_interval(tmpdir):
+    vtn = MockVTN(long_poll=True).start()
+    client = poll.OpenADR2(
+        event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir),
+        vtn_base_uri=vtn.base_uri,
+        control_opts=dict(start_thread=False),
+        long_poll_timeout=30,
+    )
+    try:
+        assert vtn.wait_for(lambda: vtn.waiting == 1)
+
+        published = time.monotonic()
+        vtn.publish([test_event])
+        assert vtn.wait_for(lambda: vtn.created_events)
+
+        assert time.monotonic() - published < 1
+        assert [evt.id for evt in client.event_handler.get_active_events()] == ["FooEvent"]
+    finally:
+        client.stop()
+        vtn.stop()
+        client.exit()
+
+
+def test_mock_vtn_benchmark_scenario():
+    scenario = Scenario(events=3, intervals=2, churn=0.2, error_rate=0.2, seed=1)
+
+    stats = benchmark(scenario, vens=2, duration=1)
+
+    assert stats["polls"] == stats["requests"] > 0
+    assert 0 < stats["errors"] < stats["requests"]
+    assert stats["replies"] == stats["requests"] - stats["errors"]
+    assert stats["ack_latency"]["count"] >= 2 * scenario.events
@@ -0,0 +1,137 @@
+import http.client
+import socket
+import time
+from datetime import timedelta
+from test.adr_event_generator import TEST_DB_ADDR, AdrEventStatus, generate_payload, make_event
+from test.certificate import make_certificate, needs_openssl
+
+import pytest
+import requests
+from lxml import etree
+
+from oadr2 import push
+from oadr2.poll import OADR2_URI_PATH
+from oadr2.schemas import NS_A
+
+optType = 'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse/ei:optType'
+
+test_event = make_event(duration=timedelta(seconds=10), status=AdrEventStatus.PENDING)
+
+
+@pytest.fixture
+def receiver(tmpdir):
+    handler = push.OpenADR2(
+        event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir),
+        control_opts=dict(start_thread=False),
+        listen_addr="127.0.0.1",
+        listen_port=0,
+        max_request_size=64 * 1024,
+        max_concurrent_requests=1,
+        max_connections=2,
+    )
+    yield handler
+    handler.exit()
+
+
+def event_uri(receiver):
+    return f"http://127.0.0.1:{receiver.listen_port}/{OADR2_URI_PATH}EiEvent"
+
+
+def test_push_distribute_event(receiver):
+    resp = requests.post(event_uri(receiver), data=etree.tostring(generate_payload([test_event])))
+
+    assert resp.status_code == 200
+    reply = etree.fromstring(resp.content)
+    assert reply.findtext(optType, namespaces=NS_A) == "optIn"
+    assert [evt.id for evt in receiver.event_handler.get_active_events()] == ["FooEvent"]
+
+
+def test_push_rejects_oversized_payload(receiver):
+    resp = requests.post(event_uri(receiver), data=b"<a/>" * 20000)
+
+    assert resp.status_code == 413
+    assert receiver.event_handler.get_active_events() == []
+
+
+@pytest.mark.parametrize(
+    "path, body, status",
+    [
+        pytest.param("wrong/path", b"<a/>", 404, id="unknown path"),
+        pytest.param(None, b"<not xml", 400, id="invalid xml"),
+        pytest.param(None, b"<oadrRequestEvent/>", 400, id="unexpected payload"),
+    ]
+)
+def test_push_rejects_bad_requests(receiver, path, body, status):
+    uri = f"http://127.0.0.1:{receiver.listen_port}/{path}" if path else event_uri(receiver)
+
+    assert requests.post(uri, data=body).status_code == status
+
+
+def test_push_concurrency_cap(receiver):
+    receiver.server.slots.acquire()  # simulate a request in progress
+    try:
+        resp = requests.post(event_uri(receiver), data=etree.tostring(generate_payload([test_event])))
+    finally:
+        receiver.server.slots.release()
+
+    assert resp.status_code == 503
+    assert resp.headers["Retry-After"] == str(push.RETRY_AFTER)
+
+
+def test_push_refuses_connections_over_limit(receiver):
+    idle = [socket.create_connection(("127.0.0.1", receiver.listen_port), timeout=5) for _ in range(2)]
+    try:
+        with socket.create_connection(("127.0.0.1", receiver.listen_port), timeout=5) as refused:
+            try:
+                assert refused.recv(1) == b""
+            except ConnectionResetError:
+                pass
+    finally:
+        for sock in idle:
+            sock.close()
+
+    # The slots of the closed connections are given back
+    deadline = time.monotonic() + 5
+    while not receiver.server.connections.acquire(blocking=False):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    receiver.server.connections.release()
+    resp = requests.post(event_uri(receiver), data=etree.tostring(generate_payload([test_event])))
+    assert resp.status_code == 200
+
+
+def test_push_rejects_negative_length(receiver):
+    conn = http.client.HTTPConnection("127.0.0.1", receiver.listen_port, timeout=5)
+    conn.putrequest("POST", f"/{OADR2_URI_PATH}EiEvent")
+    conn.putheader("Content-Length", "-1")
+    conn.endheaders()
+    conn.send(b"<a/>" * 20000)
+
+    assert conn.getresponse().status == 400
+    conn.close()
+    assert receiver.event_handler.get_active_events() == []
+
+
+@needs_openssl
+def test_push_stalled_handshake_does_not_block(tmpdir):
+    cert, key = make_certificate(tmpdir)
+    receiver = push.OpenADR2(
+        event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir),
+        control_opts=dict(start_thread=False),
+        listen_addr="127.0.0.1",
+        listen_port=0,
+        server_cert_pem=cert,
+        server_cert_key=key,
+    )
+    # Connects but never sends its ClientHello
+    stalled = socket.create_connection(("127.0.0.1", receiver.listen_port))
+    try:
+        started = time.monotonic()
+        resp = requests.post(
+            f"https://127.0.0.1:{receiver.listen_port}/{OADR2_URI_PATH}EiEvent",
+            data=etree.tostring(generate_payload([test_event])), verify=cert, timeout=5)
+        assert resp.status_code == 200
+        assert time.monotonic() - started < 5
+    finally:
+        stalled.close()
+        receiver.exit()
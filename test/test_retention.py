@@ -0,0 +1,126 @@
+import os
+import sqlite3
+from datetime import timedelta
+from test.adr_event_generator import NOW, TEST_DB_ADDR, make_event
+from unittest import mock
+
+from freezegun import freeze_time
+from sqlalchemy import event as sqla_event
+
+from oadr2 import controller, event, eventdb, retention
+
+def test_batched_removal_keeps_history(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    for index in range(1200):
+        event_handler.db.add_event(make_event("Evt%d" % index, NOW + timedelta(minutes=index)).to_obj())
+    event_handler.optout_event("Evt3")
+
+    statements = []
+
+    def count(connection, cursor, statement, *args):
+        statements.append(statement.split()[0])
+
+    engine = event_handler.db.session.bind
+    sqla_event.listen(engine, "before_cursor_execute", count)
+    with freeze_time(NOW):
+        event_handler.remove_events(["Evt%d" % index for index in range(1100)], archive=True)
+    sqla_event.remove(engine, "before_cursor_execute", count)
+
+    # Three batches, each inserting into the history and deleting signals and events
+    assert statements.count("DELETE") == 6 and statements.count("INSERT") == 3
+    assert [evt.id for evt in event_handler.get_active_events()] == ["Evt%d" % index for index in range(1100, 1200)]
+    assert event_handler.optouts == set()
+
+    history = event_handler.get_history()
+    assert len(history) == 1100
+    assert {entry.event_id: entry for entry in history}["Evt5"] == eventdb.HistoryEntry(
+        "Evt5", 0, NOW + timedelta(minutes=5), NOW + timedelta(minutes=15), "active", 1, NOW)
+    assert event_handler.get_history(since=NOW) == []
+
+    # Dropped without history, and history past its age
+    with freeze_time(NOW + timedelta(days=1)):
+        event_handler.remove_events(["Evt1100"])
+    assert len(event_handler.get_history()) == 1100
+    assert event_handler.prune_history(NOW + timedelta(seconds=1)) == 1100
+    assert event_handler.get_history() == []
+
+
+def test_ended_events_are_removed_off_the_control_pass(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    collector = retention.Retention(retention.Policy(history_age=timedelta(days=1)), start_thread=False)
+    event_controller = controller.EventController(event_handler, start_thread=False, retention=collector)
+    event_handler.db.add_event(make_event("First", NOW - timedelta(minutes=5)).to_obj())
+    event_handler.db.add_event(make_event("Second", NOW + timedelta(minutes=20)).to_obj())
+    remove_events = mock.MagicMock(wraps=event_handler.remove_events)
+    event_handler.remove_events = remove_events
+
+    with freeze_time(NOW):
+        event_controller.tick()
+    with freeze_time(NOW + timedelta(minutes=10)):
+        event_controller.tick()
+        event_controller.tick()
+    assert remove_events.call_count == 0
+    assert [evt.id for evt in event_controller.active_events] == ["Second"]
+    assert len(event_handler.get_active_events()) == 2
+
+    load_events = mock.MagicMock(wraps=event_handler.db.get_active_events)
+    event_handler.db.get_active_events = load_events
+    with freeze_time(NOW + timedelta(minutes=11)):
+        assert collector.collect() == 1
+        event_controller.tick()
+    assert remove_events.call_args == mock.call(["First"], archive=True)
+    assert [entry.event_id for entry in event_handler.get_history()] == ["First"]
+    assert [evt.id for evt in event_controller.active_events] == ["Second"]
+    assert load_events.call_count == 0
+
+    with freeze_time(NOW + timedelta(days=2)):
+        collector.maintain()
+    assert event_handler.get_history() == []
+    collector.exit()
+
+
+def test_events_changed_since_they_ended_are_kept(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    collector = retention.Retention(retention.Policy(), start_thread=False)
+    event_controller = controller.EventController(event_handler, start_thread=False, retention=collector)
+    event_handler.db.add_event(make_event("First", NOW - timedelta(minutes=5)).to_obj())
+    event_handler.db.add_event(make_event("Second", NOW - timedelta(minutes=5)).to_obj())
+    with freeze_time(NOW + timedelta(minutes=10)):
+        event_controller.tick()
+
+    # The VTN extends the first one before the collector gets to it
+    modified = make_event("First", NOW - timedelta(minutes=5), duration=timedelta(minutes=30)).to_obj()
+    modified.mod_number = 1
+    event_handler.db.update_event(modified)
+    with freeze_time(NOW + timedelta(minutes=11)):
+        assert collector.collect() == 1
+    assert [evt.id for evt in event_handler.get_active_events()] == ["First"]
+    collector.exit()
+
+
+def test_vacuum_gives_pages_back(tmpdir):
+    db_path = TEST_DB_ADDR % tmpdir
+    legacy = sqlite3.connect(db_path)
+    legacy.execute("CREATE TABLE legacy (x)")
+    legacy.close()
+
+    event_handler = event.EventHandler("VEN_ID", db_path=db_path)
+    engine = event_handler.db.session.bind
+    # An existing database is switched over by a full vacuum
+    assert engine.execute("PRAGMA auto_vacuum").scalar() == 0
+    assert retention.vacuum(engine) == 0
+    assert engine.execute("PRAGMA auto_vacuum").scalar() == retention.INCREMENTAL
+
+    for index in range(300):
+        event_handler.db.add_event(make_event("Evt%d" % index, NOW, [1.0] * 20, duration=timedelta(minutes=1)).to_obj())
+    event_handler.db.session.flush()
+    size = os.path.getsize(db_path)
+    event_handler.remove_events(["Evt%d" % index for index in range(300)])
+    free = engine.execute("PRAGMA freelist_count").scalar()
+    assert free > 10
+
+    assert retention.vacuum(engine, pages=10) == 10
+    assert engine.execute("PRAGMA freelist_count").scalar() == free - 10
+    assert retention.vacuum(engine) == free - 10
+    assert engine.execute("PRAGMA freelist_count").scalar() == 0
+    assert os.path.getsize(db_path) < size
@@ -0,0 +1,133 @@
+import subprocess
+import sys
+from datetime import datetime, timedelta
+from test.adr_event_generator import TEST_DB_ADDR, AdrEvent, AdrEventStatus
+
+import pytest
+from freezegun import freeze_time
+
+from oadr2 import controller, event, shm
+
+TEST_TABLE_ADDR = "%s/signals.shm"
+
+
+def test_publish_and_read(tmpdir):
+    path = TEST_TABLE_ADDR % tmpdir
+    next_change = datetime(2030, 1, 1, 12, 30)
+    with shm.SignalTable(path, writable=True, slots=4) as writer:
+        writer.publish("relay_1", 2.0, "FooEvent", next_change)
+        reader = shm.SignalTable(path)
+
+        assert reader.read("relay_1") == shm.SignalState("relay_1", 2.0, "FooEvent", next_change, 1)
+        assert reader.read("relay_2") is None
+
+        writer.publish("relay_2", 1.0)
+        writer.publish("relay_1", 0.0)
+        assert reader.read("relay_1") == shm.SignalState("relay_1", 0.0, None, None, 2)
+        assert set(reader.read_all()) == {"relay_1", "relay_2"}
+
+        with pytest.raises(shm.SignalTableError):
+            reader.publish("relay_1", 1.0)
+        reader.close()
+
+
+def test_read_from_another_process(tmpdir):
+    path = TEST_TABLE_ADDR % tmpdir
+    with shm.SignalTable(path, writable=True) as writer:
+        writer.publish("VEN_ID", 3.0, "FooEvent")
+
+        output = subprocess.check_output([
+            sys.executable, "-c",
+            "import sys; from oadr2 import shm; "
+            "state = shm.SignalTable(sys.argv[1]).read('VEN_ID'); print(state.level, state.event_id)",
+            path
+        ])
+    assert output.split() == [b"3.0", b"FooEvent"]
+
+
+def test_reader_never_sees_a_write_in_progress(tmpdir, monkeypatch):
+    monkeypatch.setattr(shm, 'READ_RETRIES', 3)
+    path = TEST_TABLE_ADDR % tmpdir
+    writer = shm.SignalTable(path, writable=True)
+    writer.publish("relay_1", 1.0)
+    reader = shm.SignalTable(path)
+
+    offset = shm.HEADER_SIZE
+    shm.SEQ.pack_into(writer._map, offset, 3)  # as if the writer stopped mid-write
+    with pytest.raises(shm.SignalTableError):
+        reader.read("relay_1")
+
+    # A restarted writer reuses the table and completes the slot
+    writer.close()
+    writer = shm.SignalTable(path, writable=True)
+    writer.publish("relay_1", 2.0)
+    assert reader.read("relay_1").level == 2.0
+    assert reader.read("relay_1").sequence == 2
+    writer.close()
+
+
+def test_resized_table_is_replaced_under_readers(tmpdir):
+    path = TEST_TABLE_ADDR % tmpdir
+    writer = shm.SignalTable(path, writable=True, slots=4)
+    writer.publish("relay_1", 2.0)
+    writer.close()
+    reader = shm.SignalTable(path)
+
+    # A new file, the reader's mapping of the old one is left as it was
+    with shm.SignalTable(path, writable=True, slots=8) as writer:
+        assert writer.slots == 8
+        assert writer.read("relay_1") is None
+        writer.publish("relay_2", 1.0)
+    assert reader.read("relay_1").level == 2.0
+    assert reader.read("relay_2") is None
+    reader.close()
+
+    with shm.SignalTable(path) as reader:
+        assert (reader.slots, set(reader.read_all())) == (8, {"relay_2"})
+    assert tmpdir.listdir(lambda entry: entry.basename != "signals.shm") == []
+
+
+def test_table_limits(tmpdir):
+    path = TEST_TABLE_ADDR % tmpdir
+    with shm.SignalTable(path, writable=True, slots=1) as writer:
+        writer.publish("relay_1", 1.0)
+        with pytest.raises(shm.SignalTableError):
+            writer.publish("relay_2", 1.0)
+        with pytest.raises(ValueError):
+            writer.publish("relay_1", 1.0, "x" * 200)
+
+    tmpdir.join("other").write("not a table")
+    with pytest.raises(shm.SignalTableError):
+        shm.SignalTable(str(tmpdir.join("other")))
+
+
+def test_controller_publishes_changes(tmpdir):
+    now = datetime(2030, 1, 1, 12, 0)
+    table = shm.SignalTable(TEST_TABLE_ADDR % tmpdir, writable=True)
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(event_handler, start_thread=False, signal_table=table)
+    event_handler.db.add_event(AdrEvent(
+        id="FooEvent",
+        start=now - timedelta(minutes=5),
+        signals=[
+            dict(index=0, duration=timedelta(minutes=10), level=1.0),
+            dict(index=1, duration=timedelta(minutes=10), level=2.0),
+        ],
+        status=AdrEventStatus.ACTIVE,
+    ).to_obj())
+
+    with freeze_time(now):
+        event_controller.tick()
+        event_controller.tick()
+    assert table.read("VEN_ID") == shm.SignalState(
+        "VEN_ID", 1.0, "FooEvent", now + timedelta(minutes=5), 1)
+
+    with freeze_time(now + timedelta(minutes=6)):
+        event_controller.tick()
+    assert table.read("VEN_ID") == shm.SignalState(
+        "VEN_ID", 2.0, "FooEvent", now + timedelta(minutes=15), 2)
+
+    with freeze_time(now + timedelta(minutes=16)):
+        event_controller.tick()
+    assert table.read("VEN_ID") == shm.SignalState("VEN_ID", 0, None, None, 3)
+    table.close()
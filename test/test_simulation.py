@@ -0,0 +1,106 @@
+from datetime import datetime, timedelta
+from test.adr_event_generator import AdrEventStatus, generate_payload, make_event
+
+import pytest
+from freezegun import freeze_time
+
+from oadr2 import clock, controller, event, simulation
+
+START = datetime(2030, 1, 1)
+
+
+def group_event(id_, start, levels, group="North", **kwargs):
+    return make_event(
+        id_, start, levels, duration=timedelta(hours=1), status=AdrEventStatus.PENDING,
+        ven_ids=None, group_ids=[group], **kwargs)
+
+
+def hours(count):
+    return START + timedelta(hours=count)
+
+
+def test_simulated_clock(tmpdir):
+    sim_clock = clock.SimulatedClock(START)
+    sim_clock.advance(timedelta(minutes=90))
+    assert (sim_clock.now(), sim_clock.monotonic()) == (hours(1.5), 5400)
+    with pytest.raises(ValueError):
+        sim_clock.advance_to(hours(1))
+
+    # The controller follows the clock of its handler, not the system's
+    event_handler = event.EventHandler("VEN_ID", db_path="%s/test2.db" % tmpdir, clock=sim_clock)
+    event_controller = controller.EventController(event_handler, start_thread=False)
+    event_handler.handle_payload(generate_payload([
+        make_event("Evt", hours(1), [2.0], duration=timedelta(hours=1))
+    ]))
+    event_controller.tick()
+    assert (event_controller.current_signal_level, event_controller.next_change_time) == (2.0, hours(2))
+    sim_clock.advance_to(hours(3))
+    event_controller.tick()
+    assert (event_controller.current_signal_level, event_controller.active_events) == (0, [])
+
+    # The current interval is looked up when called, not at import
+    evt = group_event("Evt", hours(0), [1.0, 2.0]).to_obj()
+    with freeze_time(hours(0.5)):
+        assert evt.get_current_interval().level == 1.0
+    with freeze_time(hours(1.5)):
+        assert evt.get_current_interval().level == 2.0
+
+
+def test_simulation_visits_each_boundary():
+    sim = simulation.Simulation(START)
+    for ven_id, group in (("A", "North"), ("B", "North"), ("C", "South")):
+        sim.add_ven(ven_id, event_config=dict(group_id=group))
+
+    low = group_event("Low", hours(2), [1.0, 2.0])
+    high = group_event("High", hours(2.5), [5.0], priority=2)
+    south = group_event("South", hours(1), [3.0], group="South")
+    sim.deliver(hours(0), generate_payload([low, south]))
+    sim.deliver(hours(2.25), generate_payload([low, high, south]))
+    sim.optout(hours(3), "B", "High")
+    try:
+        changes = sim.run(hours(24))
+    finally:
+        sim.exit()
+
+    just_after = simulation.RESOLUTION
+    assert [(change.time, change.ven_id, change.level, change.event_id) for change in changes] == [
+        (hours(1) + just_after, "C", 3.0, "South"),
+        (hours(2) + just_after, "A", 1.0, "Low"),
+        (hours(2) + just_after, "B", 1.0, "Low"),
+        (hours(2) + just_after, "C", 0, None),
+        (hours(2.5) + just_after, "A", 5.0, "High"),
+        (hours(2.5) + just_after, "B", 5.0, "High"),
+        (hours(3), "B", 1.0, "Low"),  # the first interval of "Low" includes its end
+        (hours(3) + just_after, "B", 2.0, "Low"),
+        (hours(3.5) + just_after, "A", 2.0, "Low"),
+        (hours(4) + just_after, "B", 0, None),
+        (hours(4) + just_after, "A", 0, None),
+    ]
+    assert sim.clock.now() == hours(24)
+    # A pass at each delivery, boundary and opt-out, not every 30 seconds
+    assert sim.passes < 30
+
+
+def test_week_of_events_across_many_vens():
+    sim = simulation.Simulation(START)
+    for index in range(20):
+        sim.add_ven("VEN%d" % index, event_config=dict(group_id="North" if index % 2 else "South"))
+
+    events = [
+        group_event("Evt%d_%d" % (day, hour), START + timedelta(days=day, hours=hour), [1.0, 2.0])
+        for day in range(7) for hour in (8, 17)
+    ]
+    for evt in events:
+        # Like a VTN, each payload carries the events which are not over yet
+        when = evt.start - timedelta(hours=2)
+        sim.deliver(when, generate_payload([other for other in events if when < other.start + timedelta(hours=2)][:2]))
+    try:
+        changes = sim.run(START + timedelta(days=7))
+    finally:
+        sim.exit()
+
+    # Each North VEN goes to 1, 2 and back to 0 for every event
+    assert len(changes) == 10 * len(events) * 3
+    assert sorted(set(change.ven_id for change in changes)) == sorted("VEN%d" % index for index in range(1, 20, 2))
+    assert all(earlier.time <= later.time for earlier, later in zip(changes, changes[1:]))
+    assert changes[-1].time == events[-1].start + timedelta(hours=2) + simulation.RESOLUTION
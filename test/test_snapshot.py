@@ -0,0 +1,118 @@
+import struct
+from datetime import timedelta
+from test.adr_event_generator import NOW, TEST_DB_ADDR, generate_payload, make_event
+from unittest import mock
+
+import pytest
+from freezegun import freeze_time
+
+from oadr2 import controller, event, snapshot
+
+TEST_SNAPSHOT_ADDR = "%s/state.snap"
+
+
+def start_ven(tmpdir, **control_opts):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    event_controller = controller.EventController(
+        event_handler, start_thread=False, snapshot=snapshot.SnapshotFile(TEST_SNAPSHOT_ADDR % tmpdir),
+        **control_opts)
+    return event_handler, event_controller
+
+
+def test_restart_restores_the_state(tmpdir):
+    event_handler, event_controller = start_ven(tmpdir, resources=["relay_1"])
+    assert not event_controller.restored
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([
+            make_event("Low", NOW - timedelta(minutes=5), [1.0, 2.0]),
+            make_event("High", NOW - timedelta(minutes=1), [5.0], priority=2),
+            make_event("Later", NOW + timedelta(hours=1), [3.0]),
+        ]))
+        event_handler.optout_event("High")
+        event_controller.tick()
+        event_controller.tick()  # nothing changed, nothing written
+    assert event_controller.snapshot.written == 1
+    assert (event_controller.current_signal_level, event_controller.current_event_id) == (1.0, "Low")
+    with freeze_time(NOW):
+        forecast = event_controller.forecast(hours=3)
+        event_controller.exit()
+
+    callback = mock.MagicMock()
+    event_handler, event_controller = start_ven(tmpdir, resources=["relay_1"], signal_changed_callback=callback)
+    load_events = mock.MagicMock(wraps=event_handler.db.get_active_events)
+    event_handler.db.get_active_events = load_events
+    assert event_controller.restored
+    assert event_handler.optouts == {"High"}
+    assert [evt.id for evt in event_controller.active_events] == ["Low", "Later"]
+    assert event_controller.resource_states["relay_1"] == controller.ResourceState(1.0, "Low", NOW + timedelta(minutes=5))
+
+    later = NOW + timedelta(seconds=1)
+    with freeze_time(later):
+        assert event_controller.forecast(hours=2) == forecast.window(later, later + timedelta(hours=2))
+        event_controller.tick()
+        event_controller.exit()
+    assert (event_controller.current_signal_level, event_controller.current_event_id) == (1.0, "Low")
+    assert load_events.call_count == 0
+    assert callback.call_count == 0
+
+
+def test_out_of_date_snapshot_is_not_restored(tmpdir):
+    event_handler, event_controller = start_ven(tmpdir)
+    payload = [make_event("First", NOW - timedelta(minutes=5), [1.0]), make_event("Second", NOW, [2.0])]
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload(payload))
+        event_handler.optout_event("Second")
+        event_controller.tick()
+        event_controller.exit()
+
+    # Changed after the snapshot was written, e.g. by a crash in between
+    payload[0].mod_number = 1
+    payload[0].signals[0]["level"] = 4.0
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload(payload))
+
+    event_handler, event_controller = start_ven(tmpdir)
+    assert not event_controller.restored
+    assert event_handler.optouts == {"Second"}  # kept all the same
+    with freeze_time(NOW):
+        event_controller.tick()
+    assert (event_controller.current_signal_level, event_controller.current_event_id) == (4.0, "First")
+    event_controller.exit()
+
+
+def test_snapshot_file(tmpdir):
+    snapshot_file = snapshot.SnapshotFile(TEST_SNAPSHOT_ADDR % tmpdir)
+    assert snapshot_file.read() is None
+
+    evt = event.EventSchema.from_xml(generate_payload([make_event("Evt", NOW, [1.0])]).find(
+        "oadr:oadrEvent/ei:eiEvent", namespaces=event.NS_A))
+    state = snapshot.VENState(
+        written=NOW,
+        level=1.0,
+        event_id="Evt",
+        next_change_time=NOW + timedelta(minutes=10),
+        events=[evt],
+        timeline=controller.timeline.Timeline(
+            [NOW, NOW + timedelta(microseconds=1), NOW + timedelta(minutes=10)], [0, 1.0], [None, "Evt"]),
+        optouts={"Other"},
+        versions={"Evt": (0, "active", (NOW + timedelta(minutes=10)).isoformat()), "Other": (2, "far", None)},
+        resource_states={"relay_1": (1.0, "Evt", None)},
+    )
+    snapshot_file.write(state)
+    assert snapshot_file.read() == state
+
+    with open(snapshot_file.path, "r+b") as raw:
+        raw.seek(snapshot.HEADER.size)
+        raw.write(b"\xff")
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot_file.read()
+
+    snapshot_file.write(state._replace(timeline=None, events=[], event_id=None))
+    assert snapshot_file.read().timeline is None
+    with open(snapshot_file.path, "r+b") as raw:
+        raw.seek(8)
+        raw.write(struct.pack("<I", snapshot.VERSION + 1))
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot_file.read()
+    snapshot_file.remove()
+    assert snapshot_file.read() is None
@@ -0,0 +1,120 @@
+from datetime import timedelta
+from test.adr_event_generator import NOW, TEST_DB_ADDR, AdrEvent, AdrEventStatus, generate_payload
+from unittest import mock
+
+import pytest
+from freezegun import freeze_time
+
+from oadr2 import controller, event, timeline
+
+def minutes(count):
+    return NOW + timedelta(minutes=count)
+
+
+@pytest.fixture
+def handler(tmpdir):
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir)
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([
+            AdrEvent(
+                id="Low",
+                start=minutes(-2),
+                signals=[
+                    dict(index=0, duration=timedelta(minutes=5), level=1.0),
+                    dict(index=1, duration=timedelta(minutes=5), level=1.0),
+                    dict(index=2, duration=timedelta(minutes=10), level=2.0),
+                ],
+                status=AdrEventStatus.ACTIVE,
+            ),
+            AdrEvent(
+                id="High",
+                start=minutes(10),
+                signals=[dict(index=0, duration=timedelta(minutes=30), level=3.0)],
+                status=AdrEventStatus.PENDING,
+                priority=2,
+            ),
+            AdrEvent(
+                id="Test",
+                start=minutes(0),
+                signals=[dict(index=0, duration=timedelta(hours=1), level=4.0)],
+                status=AdrEventStatus.ACTIVE,
+                test_event=True,
+            ),
+        ]))
+    return event_handler
+
+
+def test_forecast_resolves_priority(handler):
+    event_controller = controller.EventController(handler, start_thread=False)
+    with freeze_time(NOW):
+        forecast = event_controller.forecast(hours=2)
+
+    assert list(forecast) == [
+        (minutes(0), minutes(8), 1.0, "Low"),
+        (minutes(8), minutes(10), 2.0, "Low"),
+        (minutes(10), minutes(40), 3.0, "High"),
+        (minutes(40), minutes(120), 0, None),
+    ]
+    assert forecast.as_arrays() == dict(
+        times=[(when - timeline.EPOCH).total_seconds()
+               for when in (minutes(0), minutes(8), minutes(10), minutes(40), minutes(120))],
+        levels=[1.0, 2.0, 3.0, 0],
+        event_ids=["Low", "Low", "High", None],
+    )
+
+    # The same levels as the control loop would see at each time
+    for offset in range(0, 120, 1):
+        with freeze_time(minutes(offset)):
+            level, event_id = event_controller.get_current_signal_level()
+        assert forecast.level_at(minutes(offset)) == (level, event_id)
+    assert forecast.level_at(minutes(121)) is None
+    event_controller.exit()
+
+
+def test_forecast_cached_until_events_change(handler):
+    event_controller = controller.EventController(handler, start_thread=False)
+    load_events = mock.MagicMock(wraps=handler.db.get_active_events)
+    handler.db.get_active_events = load_events
+
+    with freeze_time(NOW):
+        first = event_controller.forecast(hours=2)
+        assert event_controller.forecast(hours=2) == first
+    with freeze_time(minutes(9)):
+        assert list(event_controller.forecast(hours=1)) == [
+            (minutes(9), minutes(10), 2.0, "Low"),
+            (minutes(10), minutes(40), 3.0, "High"),
+            (minutes(40), minutes(69), 0, None),
+        ]
+    assert load_events.call_count == 1
+
+    # Past the horizon it was built for
+    with freeze_time(minutes(9)):
+        event_controller.forecast(hours=controller.FORECAST_HOURS)
+    assert load_events.call_count == 2
+
+    with freeze_time(minutes(9)):
+        handler.optout_event("High")
+        assert [level for _, _, level, _ in event_controller.forecast(hours=1)] == [2.0, 0]
+    assert load_events.call_count == 3
+    event_controller.exit()
+
+
+def test_forecast_of_a_resource(tmpdir):
+    resources = ["relay_1", "relay_2"]
+    event_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir, resource_ids=resources)
+    event_controller = controller.EventController(event_handler, start_thread=False, resources=resources)
+    with freeze_time(NOW):
+        event_handler.handle_payload(generate_payload([AdrEvent(
+            id="Relay2",
+            start=minutes(10),
+            signals=[dict(index=0, duration=timedelta(minutes=10), level=1.0)],
+            status=AdrEventStatus.PENDING,
+            resource_ids=["relay_2"],
+        )]))
+
+        assert event_controller.forecast(hours=1, resource="relay_1").levels == [0]
+        assert event_controller.forecast(hours=1, resource="relay_2").levels == [0, 1.0, 0]
+        assert event_controller.forecast(hours=1).levels == [0, 1.0, 0]
+        with pytest.raises(ValueError):
+            event_controller.forecast(hours=1, resource="relay_9")
+    event_controller.exit()
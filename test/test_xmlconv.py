@@ -0,0 +1,56 @@
+from datetime import timedelta
+from test.adr_event_generator import TEST_DB_ADDR, AdrEventStatus, generate_payload, make_event
+from xml.etree import ElementTree as std_ElementTree
+
+from lxml import etree as lxml_etree
+
+from oadr2 import event, xmlconv
+from oadr2.schemas import NS_A
+
+optType = 'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse/ei:optType'
+
+test_event = make_event(levels=[1.0, 2.0], duration=timedelta(seconds=10), status=AdrEventStatus.PENDING)
+
+
+def structure(elem):
+    return [(e.tag, e.text, dict(e.attrib)) for e in elem.iter()]
+
+
+def test_std_element_maker():
+    ei = xmlconv.StdElementMaker(namespace=NS_A['ei'], nsmap=NS_A)
+    pyld = xmlconv.StdElementMaker(namespace=NS_A['pyld'], nsmap=NS_A)
+
+    elem = pyld.eiCreatedEvent(ei.eiResponse(ei.responseCode('200'), pyld.requestID()))
+
+    assert isinstance(elem, std_ElementTree.Element)
+    assert elem.findtext('ei:eiResponse/ei:responseCode', namespaces=NS_A) == '200'
+    assert elem.find('ei:eiResponse/pyld:requestID', namespaces=NS_A) is not None
+
+
+def test_handle_std_payload(tmpdir):
+    lxml_payload = generate_payload([test_event])
+    std_payload = std_ElementTree.fromstring(lxml_etree.tostring(lxml_payload))
+
+    lxml_handler = event.EventHandler("VEN_ID", db_path=TEST_DB_ADDR % tmpdir.mkdir("lxml"))
+    std_handler = event.EventHandler(
+        "VEN_ID", db_path=TEST_DB_ADDR % tmpdir.mkdir("std"), element_maker=xmlconv.StdElementMaker
+    )
+
+    lxml_reply = lxml_handler.handle_payload(lxml_payload)
+    std_reply = std_handler.handle_payload(std_payload)
+
+    assert xmlconv.is_lxml(lxml_reply)
+    assert isinstance(std_reply, std_ElementTree.Element)
+    assert std_reply.findtext(optType, namespaces=NS_A) == "optIn"
+    assert structure(std_reply) == structure(lxml_reply)
+    assert std_handler.get_active_events() == lxml_handler.get_active_events()
+
+
+def test_conversions_pass_through():
+    lxml_elem = lxml_etree.Element("{urn:a}root")
+    std_elem = std_ElementTree.Element("{urn:a}root")
+
+    assert xmlconv.to_lxml(lxml_elem) is lxml_elem
+    assert xmlconv.to_std(std_elem) is std_elem
+    assert xmlconv.to_std(lxml_elem).tag == "{urn:a}root"
+    assert xmlconv.is_lxml(xmlconv.to_lxml(std_elem))
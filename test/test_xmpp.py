@@ -0,0 +1,119 @@
+from test.adr_event_generator import TEST_DB_ADDR, generate_payload, make_event
+from unittest import mock
+from xml.etree import ElementTree
+
+import pytest
+from lxml import etree
+
+from oadr2 import dispatch, xmlconv
+from oadr2.schemas import NS_A
+
+try:
+    from oadr2 import xmpp
+except (ImportError, AttributeError) as ex:  # sleekxmpp 1.3 doesn't import on Python 3.10 and later
+    pytest.skip("needs a working sleekxmpp: %s" % ex, allow_module_level=True)
+
+sleekxmpp = xmpp.sleekxmpp
+
+VTN_JID = "vtn@localhost/vtn"
+
+
+@pytest.fixture
+def client(tmpdir, monkeypatch):
+    # Record the stanza handlers and stay off the network
+    masks = []
+    add_handler = sleekxmpp.ClientXMPP.add_handler
+
+    def record(xmpp_client, mask, pointer, *args, **kwargs):
+        masks.append((mask, pointer))
+        return add_handler(xmpp_client, mask, pointer, *args, **kwargs)
+
+    monkeypatch.setattr(sleekxmpp.ClientXMPP, "add_handler", record)
+    monkeypatch.setattr(sleekxmpp.ClientXMPP, "connect", lambda *args, **kwargs: True)
+    monkeypatch.setattr(sleekxmpp.ClientXMPP, "process", lambda *args, **kwargs: None)
+    monkeypatch.setattr(sleekxmpp.ClientXMPP, "sendPresence", lambda *args, **kwargs: None)
+
+    client = xmpp.OpenADR2(
+        event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir),
+        user="ven@localhost/python",
+        password="secret",
+        vtn_jid=VTN_JID,
+        workers=1,
+        max_queued=1,
+    )
+    client.send_reply = mock.MagicMock()
+    client.handler_masks = masks
+    yield client
+    client.exit()
+
+
+def distribute_iq(iq_type="set", events=None):
+    payload = generate_payload(events if events is not None else [make_event()])
+    xml = ElementTree.Element("{jabber:client}iq", {"type": iq_type, "id": "1", "from": VTN_JID})
+    xml.append(ElementTree.fromstring(etree.tostring(payload)))
+    return xmpp.Iq(None, xml=xml)
+
+
+def handler_for(client, iq):
+    return [pointer for mask, pointer in client.handler_masks if sleekxmpp.xmlstream.matcher.MatchXMLMask(mask).match(iq)]
+
+
+def test_plugins_and_element_maker(client):
+    assert client.xmpp_client.plugin["xep_0198"].allow_resume
+    assert "xep_0199" in client.xmpp_client.plugin
+    assert client.event_handler.element_maker is xmlconv.StdElementMaker
+
+
+def test_distribute_set_and_result_are_handled(client):
+    for iq_type in ("set", "result"):
+        iq = distribute_iq(iq_type)
+        handlers = handler_for(client, iq)
+        assert len(handlers) == 1
+        handlers[0](iq)
+        assert client.dispatcher.join(5)
+
+        # The payload is a copy, SleekXMPP reuses the stanza
+        msg = client.send_reply.call_args[0][0]
+        assert client.send_reply.call_args[0][1] == VTN_JID
+        assert isinstance(msg, ElementTree.Element)
+        assert msg.find("pyld:eiCreatedEvent", namespaces=NS_A) is not None
+    assert [evt.id for evt in client.event_handler.get_active_events()] == ["FooEvent"]
+    assert not handler_for(client, distribute_iq("get"))
+
+
+def test_payload_is_copied(client):
+    iq = distribute_iq()
+    with mock.patch.object(client.dispatcher, "submit") as submit:
+        handler_for(client, iq)[0](iq)
+    msg = submit.call_args[0][2]
+    assert msg.payload is not iq.xml[0]
+    assert msg.payload.tag == iq.xml[0].tag
+    assert msg.from_ == VTN_JID
+
+
+def test_refused_when_full_or_stopped(client):
+    iq = distribute_iq()
+    handler = handler_for(client, iq)[0]
+    with mock.patch.object(client.dispatcher, "submit", side_effect=dispatch.QueueFull("full")):
+        with pytest.raises(xmpp.XMPPError) as error:
+            handler(iq)
+    assert (error.value.condition, error.value.etype) == ("resource-constraint", "wait")
+
+    client.dispatcher.stop(dispatch.DEFAULT_STOP_TIMEOUT)
+    with pytest.raises(xmpp.XMPPError) as error:
+        handler(iq)
+    assert (error.value.condition, error.value.etype) == ("service-unavailable", "cancel")
+
+
+def test_new_session_resyncs_resumed_does_not(client):
+    client.xmpp_session_start({})
+    assert client.send_reply.call_count == 0
+
+    client.xmpp_session_resumed({})
+    assert client.send_reply.call_count == 0
+
+    client.xmpp_session_start({})
+    payload, to = client.send_reply.call_args[0]
+    assert to == VTN_JID
+    assert payload.find("pyld:eiRequestEvent/ei:venID", namespaces=NS_A).text == "VEN_ID"
+    assert client.sessions == 2
@@ -0,0 +1,232 @@
+import ssl
+from datetime import timedelta
+from test.adr_event_generator import TEST_DB_ADDR, AdrEventStatus, generate_payload, make_event
+from test.certificate import make_certificate, needs_openssl
+from test.mock_xmpp import MockXMPPServer
+
+import pytest
+from lxml import etree
+
+from oadr2 import xmpp_async
+from oadr2.schemas import NS_A
+from oadr2.xmpp_async import NS_DISCO_INFO, NS_PING, NS_STANZAS
+
+optType = 'pyld:eiCreatedEvent/ei:eventResponses/ei:eventResponse/ei:optType'
+
+test_event = make_event(duration=timedelta(seconds=10), status=AdrEventStatus.PENDING)
+
+
+@pytest.fixture
+def server():
+    server = MockXMPPServer(users=dict(ven_a="secret_a", ven_b="secret_b"))
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def make_client(server, tmpdir):
+    clients = []
+
+    def make_client(user="ven_a", password="secret_a", **kwargs):
+        client = xmpp_async.OpenADR2(
+            event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir.mkdir(user)),
+            control_opts=dict(start_thread=False),
+            user="%s@localhost/python" % user,
+            password=password,
+            server_addr=server.host,
+            server_port=server.port,
+            allow_unencrypted_plain=True,
+            vtn_jid=server.vtn_jid,
+            **kwargs
+        )
+        clients.append(client)
+        return client
+
+    yield make_client
+    for client in clients:
+        client.exit()
+
+
+def test_split_jid():
+    assert xmpp_async.split_jid("ven@example.com/python") == ("ven", "example.com", "python")
+    assert xmpp_async.split_jid("ven@example.com") == ("ven", "example.com", None)
+
+
+def test_xml_stream_detaches_stanzas():
+    stream = xmpp_async.XMLStream()
+    header = b"<stream:stream xmlns='jabber:client' xmlns:stream='http://etherx.jabber.org/streams'>"
+
+    first = stream.feed(header + b"<iq id='1'/><iq id")
+    second = stream.feed(b"='2'><a/></iq>")
+
+    assert [stanza.get('id') for stanza in first] == ['1']
+    assert [stanza.get('id') for stanza in second] == ['2']
+    assert second[0][0].tag == '{jabber:client}a'
+    assert len(stream.root) == 0
+    with pytest.raises(xmpp_async.StreamError):
+        stream.feed(b"</stream:stream>")
+
+
+def test_xml_stream_limits_stanza_size():
+    stream = xmpp_async.XMLStream(max_stanza_size=100)
+    stream.feed(b"<stream:stream xmlns:stream='http://etherx.jabber.org/streams'>")
+
+    with pytest.raises(xmpp_async.StreamError):
+        stream.feed(b"<iq>" + b"x" * 200)
+
+
+def test_distribute_event_on_shared_loop(server, make_client):
+    ven_a = make_client("ven_a", "secret_a")
+    ven_b = make_client("ven_b", "secret_b")
+    assert ven_a.connected.wait(5) and ven_b.connected.wait(5)
+    assert ven_a.loop is ven_b.loop
+
+    for client in (ven_a, ven_b):
+        iq_id = server.send_iq(client.jid, generate_payload([test_event]))
+        assert server.wait_for(lambda: server.stanzas(client.jid, type='set'))
+
+        assert server.stanzas(client.jid, type='result', id=iq_id)
+        reply = server.stanzas(client.jid, type='set')[0]
+        assert reply.get('to') == server.vtn_jid
+        assert reply[0].findtext(optType, namespaces=NS_A) == "optIn"
+        assert [evt.id for evt in client.event_handler.get_active_events()] == ["FooEvent"]
+
+
+def test_disco_ping_and_unknown_iq(server, make_client):
+    client = make_client()
+    assert client.connected.wait(5)
+
+    disco_id = server.send_iq(client.jid, etree.Element('{%s}query' % NS_DISCO_INFO), iq_type='get')
+    ping_id = server.send_iq(client.jid, etree.Element('{%s}ping' % NS_PING), iq_type='get')
+    other_id = server.send_iq(client.jid, etree.Element('{urn:example}unknown'), iq_type='get')
+    assert server.wait_for(lambda: len(server.stanzas(client.jid)) >= 3)
+
+    disco = server.stanzas(client.jid, type='result', id=disco_id)[0]
+    identity = disco.find('{%(disco)s}query/{%(disco)s}identity' % dict(disco=NS_DISCO_INFO))
+    assert identity.get('name') == 'OpenADR2 Python VEN'
+    assert server.stanzas(client.jid, type='result', id=ping_id)
+    error = server.stanzas(client.jid, type='error', id=other_id)[0]
+    assert error.find('{jabber:client}error/{%s}service-unavailable' % NS_STANZAS) is not None
+
+
+def test_refuses_distribute_once_dispatcher_stopped(server, make_client):
+    client = make_client()
+    assert client.connected.wait(5)
+    client.dispatcher.stop()
+
+    iq_id = server.send_iq(client.jid, generate_payload([test_event]))
+    assert server.wait_for(lambda: server.stanzas(client.jid, type='error', id=iq_id))
+    error = server.stanzas(client.jid, type='error', id=iq_id)[0]
+    assert error.find('{jabber:client}error/{%s}service-unavailable' % NS_STANZAS) is not None
+    assert client.event_handler.get_active_events() == []
+
+
+def test_keepalive_reconnects(server, make_client, monkeypatch):
+    monkeypatch.setattr(xmpp_async, 'RECONNECT_DELAY', 0.01)
+    client = make_client(keepalive_interval=0.05, keepalive_timeout=0.1)
+    assert client.connected.wait(5)
+
+    assert server.wait_for(lambda: server.pings >= 2)
+    server.answer_pings = False
+    assert server.wait_for(lambda: server.resumptions >= 1)
+    assert client.connected.wait(5)
+
+
+def test_stream_management_ack():
+    sm = xmpp_async.StreamManagement("sm-1", resume=True)
+    for data in (b"<a/>", b"<b/>", b"<c/>"):
+        sm.sending(data)
+
+    sm.acked(2)
+    assert list(sm.unacked) == [b"<c/>"]
+    sm.acked(2)  # repeated acks change nothing
+    assert list(sm.unacked) == [b"<c/>"]
+    sm.acked(3)
+    assert not sm.unacked
+
+
+def test_resumes_and_receives_missed_distribute(server, make_client, monkeypatch):
+    monkeypatch.setattr(xmpp_async, 'RECONNECT_DELAY', 0.01)
+    client = make_client()
+    assert client.connected.wait(5)
+    jid = client.jid
+
+    # Written to the closed connection, so only re-sent on resuming
+    server.drop(jid)
+    server.send_iq(jid, generate_payload([test_event]))
+
+    assert server.wait_for(lambda: server.stanzas(jid, type='set'))
+    assert server.resumptions == 1
+    assert server.sessions == 1
+    assert client.resumptions == 1
+    assert client.sessions == 1
+    reply = server.stanzas(jid, type='set')[0]
+    assert reply[0].findtext(optType, namespaces=NS_A) == "optIn"
+
+
+def test_resyncs_when_not_resumed(server, make_client, monkeypatch):
+    monkeypatch.setattr(xmpp_async, 'RECONNECT_DELAY', 0.01)
+    server.allow_resume = False
+    client = make_client()
+    assert client.connected.wait(5)
+    assert not server.stanzas(client.jid, type='set')
+
+    server.drop(client.jid)
+    assert server.wait_for(lambda: server.sessions == 2 and server.stanzas(client.jid, type='set'))
+
+    request = server.stanzas(client.jid, type='set')[0]
+    assert request.get('to') == server.vtn_jid
+    assert request[0].findtext('pyld:eiRequestEvent/ei:venID', namespaces=NS_A) == "VEN_ID"
+    assert client.sessions == 2
+    assert client.resumptions == 0
+
+    # The VTN answers the oadrRequestEvent with the current events
+    server.send_iq(client.jid, generate_payload([test_event]), iq_type='result')
+    assert server.wait_for(lambda: len(server.stanzas(client.jid, type='set')) == 2)
+    created = server.stanzas(client.jid, type='set')[1]
+    assert created[0].findtext(optType, namespaces=NS_A) == "optIn"
+    assert [evt.id for evt in client.event_handler.get_active_events()] == ["FooEvent"]
+
+
+def test_refuses_plain_password_without_tls(server, tmpdir):
+    client = xmpp_async.OpenADR2(
+        event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir),
+        control_opts=dict(start_thread=False),
+        user="ven_a@localhost/python",
+        password="secret_a",
+        server_addr=server.host,
+        server_port=server.port,
+    )
+    try:
+        assert not client.connected.wait(0.5)
+        assert server.sessions == 0
+    finally:
+        client.exit()
+
+
+@needs_openssl
+def test_starttls_before_authenticating(tmpdir):
+    cert, key = make_certificate(tmpdir, host="localhost")
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert, key)
+    server = MockXMPPServer(users=dict(ven_a="secret_a"), tls_context=server_context)
+    client = xmpp_async.OpenADR2(
+        event_config=dict(ven_id="VEN_ID", db_path=TEST_DB_ADDR % tmpdir),
+        control_opts=dict(start_thread=False),
+        user="ven_a@localhost/python",
+        password="secret_a",
+        server_addr=server.host,
+        server_port=server.port,
+        ssl_context=ssl.create_default_context(cafile=cert),
+        vtn_jid=server.vtn_jid,
+    )
+    try:
+        assert client.connected.wait(5)
+        assert server.encrypted == 1
+
+        iq_id = server.send_iq(client.jid, generate_payload([test_event]))
+        assert server.wait_for(lambda: server.stanzas(client.jid, type='result', id=iq_id))
+        assert [evt.id for evt in client.event_handler.get_active_events()] == ["FooEvent"]
+    finally:
+        client.exit()
+        server.stop()
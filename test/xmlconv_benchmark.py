@@ -0,0 +1,77 @@
+'''
+Micro-benchmark of the XML handling on the XMPP path for a large
+oadrDistributeEvent: the old lxml <-> standard library round trips against
+passing standard library elements straight through (see `oadr2.xmlconv`).
+
+    python -m test.xmlconv_benchmark --events 50 --intervals 24
+'''
+import argparse
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+from test.adr_event_generator import AdrEvent, AdrEventStatus, generate_payload
+from xml.etree import ElementTree as std_ElementTree
+
+from lxml import etree as lxml_etree
+from lxml.builder import ElementMaker
+
+from oadr2 import event, xmlconv
+
+
+def build_stanza_payload(events, intervals):
+    '''
+    Returns: A large oadrDistributeEvent as a standard library element, the
+             way SleekXMPP hands it to `OpenADR2Plugin._handle_iq`
+    '''
+    adr_events = [
+        AdrEvent(
+            id=f"Event{index}",
+            start=datetime.utcnow() + timedelta(hours=index),
+            signals=[
+                dict(index=interval, duration=timedelta(minutes=15), level=float(interval % 3))
+                for interval in range(intervals)
+            ],
+            status=AdrEventStatus.PENDING,
+        ) for index in range(events)
+    ]
+    return std_ElementTree.fromstring(lxml_etree.tostring(generate_payload(adr_events)))
+
+
+def round_trip(handler, payload):
+    # What the XMPP transport used to do for every message
+    reply = handler.handle_payload(lxml_etree.XML(std_ElementTree.tostring(payload)))
+    return std_ElementTree.XML(lxml_etree.tostring(reply))
+
+
+def pass_through(handler, payload):
+    return xmlconv.to_std(handler.handle_payload(payload))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark XML conversions on the XMPP path")
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--intervals', type=int, default=24)
+    parser.add_argument('--number', type=int, default=20, help="runs per measurement")
+    args = parser.parse_args()
+
+    payload = build_stanza_payload(args.events, args.intervals)
+    print(f"payload: {len(std_ElementTree.tostring(payload))} bytes, "
+          f"{args.events} events x {args.intervals} intervals")
+
+    def measure(name, func):
+        seconds = min(timeit.repeat(func, number=args.number, repeat=3)) / args.number
+        print(f"{name:>28}: {seconds * 1000:8.2f} ms")
+
+    measure("std -> lxml (serialize+parse)", lambda: lxml_etree.XML(std_ElementTree.tostring(payload)))
+    measure("std pass-through", lambda: xmlconv.to_std(payload))
+
+    with tempfile.TemporaryDirectory() as db_dir:
+        old_handler = event.EventHandler("VEN_ID", db_path=f"{db_dir}/old.db", element_maker=ElementMaker)
+        new_handler = event.EventHandler("VEN_ID", db_path=f"{db_dir}/new.db",
+                                         element_maker=xmlconv.StdElementMaker)
+        measure("round trip + handle_payload", lambda: round_trip(old_handler, payload))
+        measure("pass-through + handle_payload", lambda: pass_through(new_handler, payload))
+
+
+if __name__ == '__main__':
+    main()
@@ -11,15 +11,16 @@ logging.basicConfig(
         level=logging.DEBUG,
         format="%(asctime)s  %(message)s" )
 
-from oadr2 import xmpp
 
 # Constants
 VEN_ID = 'ven_py'
 VTN_IDS = 'vtn_1,vtn_2,vtn_3,TH_VTN,vtn_rsa' 
 USER_JID = 'ven_py@localhost/python'
 USER_PASS = 'asdf'
+VTN_JID = 'vtn@localhost/python'  # asked for the events after a reconnect
 SERVER_ADDR = 'localhost'
 SERVER_PORT = 5222
+USE_ASYNCIO = False  # use xmpp_async.OpenADR2 instead of the SleekXMPP client
 
 
 def main():
@@ -30,13 +31,19 @@ def main():
         'password': USER_PASS,
         'server_addr': SERVER_ADDR,
         'server_port': SERVER_PORT,
+        'vtn_jid': VTN_JID,
         'event_config': {
             'ven_id': VEN_ID,
             'vtn_ids': VTN_IDS
         }
     }
      
-    xmpper = xmpp.OpenADR2(**config)
+    if USE_ASYNCIO:
+        from oadr2 import xmpp_async
+        xmpper = xmpp_async.OpenADR2(**config)
+    else:
+        from oadr2 import xmpp
+        xmpper = xmpp.OpenADR2(**config)
 
     # Some sort of loop thingy here
     _exit = threading.Event()